@@ -210,7 +210,7 @@ resource "aws_iam_policy" "ecs_task_policy" {
     Version = "2012-10-17"
     Statement = [
       {
-        Action   = ["s3:GetObject", "s3:PutObject"]
+        Action   = ["s3:GetObject", "s3:PutObject", "s3:DeleteObject", "s3:ListBucket", "s3:AbortMultipartUpload"]
         Effect   = "Allow"
         Resource = [
           aws_s3_bucket.model_outputs.arn,
@@ -218,7 +218,7 @@ resource "aws_iam_policy" "ecs_task_policy" {
         ]
       },
       {
-        Action   = ["sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:GetQueueAttributes"]
+        Action   = ["sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:GetQueueAttributes", "sqs:ChangeMessageVisibility"]
         Effect   = "Allow"
         Resource = aws_sqs_queue.parquet_file_queue.arn
       },
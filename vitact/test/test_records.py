@@ -0,0 +1,65 @@
+import struct
+import numpy as np
+import pytest
+
+from vitact.records import RECORD_MAGIC, HEADER_SIZE, open_records, record_batches, shard_suffix
+
+def write_shard(path, images, partial=0):
+    header = RECORD_MAGIC + struct.pack('<III', *images.shape[1:])
+    with open(path, 'wb') as f:
+        f.write(header + b'\0' * (HEADER_SIZE - len(header)))
+        f.write(images.tobytes())
+        f.write(b'\0' * partial)
+
+def yield_into(batches, generator):
+    while True:
+        try:
+            batches.append(next(generator))
+        except StopIteration as stop:
+            return stop.value
+
+@pytest.fixture
+def images():
+    return np.random.randint(0, 256, (7, 8, 8, 3), dtype=np.uint8)
+
+def test_open_records(tmp_path, images):
+    path = str(tmp_path / 'a.ready.rec')
+    write_shard(path, images, partial=10)
+
+    records = open_records(path)
+
+    assert isinstance(records, np.memmap)
+    assert records.shape == (7, 8, 8, 3)
+    np.testing.assert_array_equal(records, images)
+
+def test_open_empty_records(tmp_path, images):
+    path = str(tmp_path / 'a.ready.rec')
+    write_shard(path, images[:0])
+    assert open_records(path).shape == (0, 8, 8, 3)
+
+def test_open_records_rejects_other_files(tmp_path):
+    path = tmp_path / 'a.ready.rec'
+    path.write_bytes(b'\0' * 1000)
+    with pytest.raises(ValueError):
+        open_records(str(path))
+
+def test_record_batches_carry_across_shards(images):
+    batches = []
+    carry = None
+    for shard in [images[:3], images[3:]]:
+        carry = yield_into(batches, record_batches(shard, 2, carry))
+
+    assert [len(b) for b in batches] == [2, 2, 2]
+    np.testing.assert_array_equal(np.concatenate(batches), images[:6])
+    np.testing.assert_array_equal(carry, images[6:])
+
+def test_record_batches_small_shard_only_grows_carry(images):
+    batches = []
+    carry = yield_into(batches, record_batches(images[:2], 5))
+    carry = yield_into(batches, record_batches(images[2:4], 5, carry))
+    assert batches == []
+    np.testing.assert_array_equal(carry, images[:4])
+
+def test_shard_suffix():
+    assert shard_suffix() == '.tar'
+    assert shard_suffix(record_shards=True) == '.rec'
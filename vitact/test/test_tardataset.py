@@ -10,7 +10,10 @@ import hashlib
 import tarfile
 import numpy as np
 
-from vitact.tardataset import StreamingDataset, StreamingPILDataset
+import struct
+
+from vitact.tardataset import StreamingDataset, StreamingPILDataset, StreamingRecordDataset
+from vitact.records import RECORD_MAGIC, HEADER_SIZE
 
 def create_random_image(width, height, mode='RGB'):
     """
@@ -314,3 +317,19 @@ def test_multi_worker_loads_tar(multi_worker_tar_dir):
 if __name__ == "__main__":
     # This allows the tests to be run directly without using the pytest command
     pytest.main([__file__])
+
+def test_record_dataset_yields_leftover_records_when_stopped(tmp_path):
+    images = np.random.randint(0, 256, (5, 8, 8, 3), dtype=np.uint8)
+    header = RECORD_MAGIC + struct.pack('<III', 8, 8, 3)
+    with open(tmp_path / 'a.ready.rec', 'wb') as f:
+        f.write(header + b'\0' * (HEADER_SIZE - len(header)) + images.tobytes())
+
+    dataset = StreamingRecordDataset(str(tmp_path), batch_size=2)
+    batches = []
+    for batch in dataset:
+        batches.append(batch)
+        if len(batches) == 2:
+            dataset.stop()
+
+    assert [len(b) for b in batches] == [2, 2, 1]
+    np.testing.assert_array_equal(np.concatenate(batches), images)
@@ -0,0 +1,81 @@
+import io
+import json
+import tarfile
+import pytest
+
+from vitact.tarindex import TarIndex, split_samples, read_member, byte_ranges, fetch_members, load_s3_index
+
+class RangeS3:
+    def __init__(self, objects):
+        self.objects = objects
+        self.ranges = []
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self.objects[Key]
+        if Range is not None:
+            start, end = Range.replace('bytes=', '').split('-')
+            self.ranges.append((int(start), int(end)))
+            data = data[int(start):int(end) + 1]
+        return {'Body': io.BytesIO(data)}
+
+@pytest.fixture
+def indexed_tar(tmp_path):
+    tar_path = tmp_path / '00001-0-10.tar'
+    contents = {}
+    with tarfile.open(tar_path, 'w') as tar:
+        for i in range(5):
+            for extension, content in [('jpg', f'image {i}'.encode() * 100), ('json', b'{}')]:
+                name = f'00001-0-10--{i}.{extension}'
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+                contents[name] = content
+
+    index = TarIndex.from_tar(str(tar_path))
+    # as vitsae would have recorded it, with the third image unreadable
+    index.statuses = ['invalid' if n == '00001-0-10--2.jpg' else ('ok' if n.endswith('.jpg') else '') for n in index.names]
+    return str(tar_path), index, contents
+
+def test_read_member(indexed_tar):
+    tar_path, index, contents = indexed_tar
+    with open(tar_path, 'rb') as f:
+        for i in reversed(range(len(index))):
+            assert read_member(f, index, i) == contents[index.names[i]]
+
+def test_samples_skip_invalid(indexed_tar):
+    _, index, _ = indexed_tar
+    keys = [key for key, _ in index.samples()]
+    assert keys == [f'00001-0-10--{i}' for i in [0, 1, 3, 4]]
+    assert len(index.samples(skip_invalid=False)) == 5
+    assert set(index.samples()[0][1]) == {'jpg', 'json'}
+
+def test_split_samples():
+    samples = list(range(10))
+    shares = [split_samples(samples, w, 3) for w in range(3)]
+    assert shares == [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]]
+
+def test_byte_ranges_merge_close_members(indexed_tar):
+    _, index, _ = indexed_tar
+    assert len(byte_ranges(index, range(len(index)))) == 1
+    assert len(byte_ranges(index, [0, 4, 8], max_gap=0)) == 3
+
+def test_fetch_members(indexed_tar):
+    tar_path, index, contents = indexed_tar
+    s3 = RangeS3({
+        'wds/00001-0-10.tar': open(tar_path, 'rb').read(),
+        'wds/00001-0-10.tar.idx': json.dumps({
+            'names': index.names, 'offsets': index.offsets, 'sizes': index.sizes, 'widths': index.widths,
+            'heights': index.heights, 'statuses': index.statuses, 'tar_size': index.tar_size,
+        }).encode(),
+    })
+
+    loaded = load_s3_index(s3, 'bucket', 'wds/00001-0-10.tar')
+    jpgs = [members['jpg'] for _, members in loaded.samples()]
+    fetched = dict(fetch_members(s3, 'bucket', 'wds/00001-0-10.tar', loaded, jpgs, max_gap=0))
+
+    assert fetched == {loaded.names[i]: contents[loaded.names[i]] for i in jpgs}
+    assert len(s3.ranges) == 4
+    assert max(end for _, end in s3.ranges) < loaded.tar_size
+
+def test_missing_s3_index():
+    assert load_s3_index(RangeS3({}), 'bucket', 'wds/00001-0-10.tar') is None
@@ -8,7 +8,7 @@ import randomname
 from torch.utils.data import DataLoader
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from vitact.tardataset import StreamingPILDataset
+from vitact.tardataset import StreamingPILDataset, StreamingRecordDataset
 from utils import load_config
 from pull import keep_pulling
 from threading import Thread, Event
@@ -25,21 +25,26 @@ def generate_activations(
         n_hooks=None,
         input_tensor_shape=None,
         num_cache_workers=4,
-        num_data_workers=3
+        num_data_workers=3,
+        record_shards=False
     ):
 
     tar_dir = 'cruft/tars'
     stop_event = Event()
-    pull_thread = Thread(target=keep_pulling, args=(tar_dir, stop_event))
+    pull_thread = Thread(target=keep_pulling, args=(tar_dir, stop_event, record_shards))
     pull_thread.start()
 
     if run_name is None:
         run_name = randomname.generate('adj/', 'n/')
     print('run_name:', run_name)
 
-    dataset = StreamingPILDataset(tar_dir)
-
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_data_workers, collate_fn=lambda x: x)
+    if record_shards:
+        # shards of already decoded 224x224 images, batched by the dataset itself
+        dataset = StreamingRecordDataset(tar_dir, batch_size)
+        dataloader = DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_data_workers, collate_fn=lambda x: list(x))
+    else:
+        dataset = StreamingPILDataset(tar_dir)
+        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_data_workers, collate_fn=lambda x: x)
     
     hook_locations = [
         (2, 'resid'),
@@ -4,19 +4,30 @@ import time
 import logging
 
 from utils import load_config
+from tarindex import INDEX_SUFFIX
+from records import shard_suffix
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def get_local_tar_count(local_dir):
-    """Counts the number of .tar files in the local directory."""
-    return len([f for f in os.listdir(local_dir) if f.endswith('.tar')])
+def get_local_tar_count(local_dir, record_shards=False):
+    """Counts the shards waiting in the local directory, of the format the run reads."""
+    suffix = shard_suffix(record_shards)
+    return len([f for f in os.listdir(local_dir) if f.endswith(suffix)])
 
 def download_from_s3(s3, local_dir, bucket_name, key):
     local_filename = os.path.join(local_dir, os.path.basename(key))
     s3.download_file(bucket_name, key, local_filename)
     logging.info(f'Downloaded {key} to {local_filename}')
-    os.rename(local_filename, local_filename.replace('.tar', '.ready.tar'))
+    stem, extension = os.path.splitext(local_filename)
+    ready_filename = f'{stem}.ready{extension}'
+    if extension == '.tar':
+        try:
+            # the index has to be in place before the tar is marked ready
+            s3.download_file(bucket_name, key + INDEX_SUFFIX, ready_filename + INDEX_SUFFIX)
+        except Exception as e:
+            logging.info(f'No index for {key}, it will be read sequentially: {e}')
+    os.rename(local_filename, ready_filename)
 
 def get_next_s3_key_from_sqs(sqs, queue_url):
     """Fetches the next S3 key from the SQS queue."""
@@ -51,7 +62,7 @@ def delete_message_from_sqs(sqs, queue_url, receipt_handle):
     except Exception as e:
         logging.error(f'Error deleting message from SQS: {e}')
 
-def keep_pulling(local_dir, stop_event=None):
+def keep_pulling(local_dir, stop_event=None, record_shards=False):
     config = load_config()
     bucket_name = config['S3_BUCKET_NAME']
     queue_url = config['SQS_TAR_QUEUE_URL']
@@ -64,7 +75,7 @@ def keep_pulling(local_dir, stop_event=None):
         logging.info(f'Created local directory {local_dir}')
 
     while stop_event is None or not stop_event.is_set():
-        local_tar_count = get_local_tar_count(local_dir)
+        local_tar_count = get_local_tar_count(local_dir, record_shards)
         logging.debug(f'Number of local .tar files: {local_tar_count}')
 
         if local_tar_count >= 9:
@@ -78,6 +89,12 @@ def keep_pulling(local_dir, stop_event=None):
             time.sleep(20)
             continue
 
+        if not s3_key.endswith(shard_suffix(record_shards)):
+            # indexes are downloaded with their tar, and the run only reads one shard format
+            logging.info(f'Skipping {s3_key}')
+            delete_message_from_sqs(sqs, queue_url, receipt_handle)
+            continue
+
         try:
             response = s3.list_objects_v2(Bucket=bucket_name, Prefix=s3_key)
 
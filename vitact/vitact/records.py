@@ -0,0 +1,48 @@
+import os
+import struct
+import numpy as np
+
+RECORD_SUFFIX = '.rec'
+RECORD_MAGIC = b'VITREC01'
+HEADER_SIZE = 64
+
+def shard_suffix(record_shards=False):
+    """
+    The suffix of the shards an activation run reads, record shards or tars.
+    """
+    return RECORD_SUFFIX if record_shards else '.tar'
+
+def open_records(path):
+    """
+    Memory map a record shard written by vitsae as an (n, height, width, 3)
+    uint8 array. A partly written last record is left out.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if header[:len(RECORD_MAGIC)] != RECORD_MAGIC:
+        raise ValueError(f'{path} is not a record shard')
+    shape = struct.unpack_from('<III', header, len(RECORD_MAGIC))
+
+    count = (os.path.getsize(path) - HEADER_SIZE) // int(np.prod(shape))
+    if count == 0:
+        return np.zeros((0, *shape), dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER_SIZE, shape=(count, *shape))
+
+def record_batches(records, batch_size, carry=None):
+    """
+    Yield (batch_size, height, width, 3) arrays copied out of records,
+    starting with the leftover carry of a previous shard. Returns what is left
+    over once there isn't enough for a full batch.
+    """
+    start = 0
+    if carry is not None and len(carry):
+        needed = batch_size - len(carry)
+        if len(records) < needed:
+            return np.concatenate([carry, records])
+        yield np.concatenate([carry, records[:needed]])
+        start = needed
+
+    while start + batch_size <= len(records):
+        yield np.array(records[start:start + batch_size])
+        start += batch_size
+    return np.array(records[start:])
@@ -1,9 +1,11 @@
 import boto3
+import fire
 import logging
 import sys
 from botocore.exceptions import ClientError
 
 from utils import load_config
+from records import shard_suffix
 
 def initialize_boto3_clients(config):
     """
@@ -97,7 +99,7 @@ def enqueue_messages(sqs, queue_url, messages):
 
     logging.info(f"Enqueued {sent} out of {total} messages to SQS queue.")
 
-def main():
+def main(record_shards=False):
     # Setup logging
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -113,6 +115,10 @@ def main():
     # List all S3 object keys under the specified prefix
     s3_keys = list_s3_objects(s3, config['S3_BUCKET_NAME'], 'webdataset')
 
+    # only the shard format the activation run reads, the indexes next to the tars are fetched with them
+    suffix = shard_suffix(record_shards)
+    s3_keys = [key for key in s3_keys if key.endswith(suffix)]
+
     if not s3_keys:
         logging.info("No objects found in S3 to enqueue.")
         sys.exit(0)
@@ -123,4 +129,4 @@ def main():
     logging.info("All messages have been enqueued successfully.")
 
 if __name__ == '__main__':
-    main()
+    fire.Fire(main)
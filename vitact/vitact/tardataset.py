@@ -9,20 +9,56 @@ import torchvision.transforms as transforms
 from PIL import Image
 import io
 
+from vitact.tarindex import TarIndex, read_member, INDEX_SUFFIX
+from vitact.records import open_records, record_batches
+
 class StreamingDataset(IterableDataset):
+    ready_suffix = '.ready.tar'
+
     def __init__(self, data_dir):
         self.data_dir = data_dir
         self._stop = False
 
     def _get_tar_files(self):
-        """Retrieve the list of .ready.tar files in the data directory."""
-        tar_files = glob.glob(os.path.join(self.data_dir, '*.ready.tar'))
+        """Retrieve the list of ready shards in the data directory."""
+        tar_files = glob.glob(os.path.join(self.data_dir, '*' + self.ready_suffix))
         tar_files.sort()
         return tar_files
 
     def stop(self):
         self._stop = True
 
+    def _read_sequential(self, tar_path, worker_id):
+        with tarfile.open(tar_path, 'r') as tar:
+            for member in tar:
+                if member.isfile() and member.name.lower().endswith('.jpg'):
+                    try:
+                        with tar.extractfile(member) as file_obj:
+                            if file_obj is not None:
+                                sample = {'jpg': file_obj.read()}
+                                yield sample
+                    except Exception as img_e:
+                        print(f'Worker {worker_id}: Error reading {member.name} in {tar_path}: {img_e}')
+
+    def _read_indexed(self, tar_path, index, worker_id):
+        """Seek straight to every jpg listed in the tar's index, skipping the ones the downloader found invalid."""
+        with open(tar_path, 'rb') as f:
+            for _, members in index.samples():
+                if 'jpg' not in members:
+                    continue
+                try:
+                    yield {'jpg': read_member(f, index, members['jpg'])}
+                except Exception as img_e:
+                    print(f'Worker {worker_id}: Error reading {index.names[members["jpg"]]} in {tar_path}: {img_e}')
+
+    def _read_file(self, tar_file, processing_tar_file, worker_id):
+        index_file = tar_file + INDEX_SUFFIX
+        if os.path.exists(index_file):
+            yield from self._read_indexed(processing_tar_file, TarIndex.load(index_file), worker_id)
+            os.remove(index_file)
+        else:
+            yield from self._read_sequential(processing_tar_file, worker_id)
+
     def __iter__(self):
         worker_info = torch.utils.data.get_worker_info()
         
@@ -51,16 +87,7 @@ class StreamingDataset(IterableDataset):
                     continue
 
                 try:
-                    with tarfile.open(processing_tar_file, 'r') as tar:
-                        for member in tar:
-                            if member.isfile() and member.name.lower().endswith('.jpg'):
-                                try:
-                                    with tar.extractfile(member) as file_obj:
-                                        if file_obj is not None:
-                                            sample = {'jpg': file_obj.read()}
-                                            yield sample
-                                except Exception as img_e:
-                                    print(f'Worker {worker_id}: Error reading {member.name} in {processing_tar_file}: {img_e}')
+                    yield from self._read_file(tar_file, processing_tar_file, worker_id)
 
                     # After processing, remove the tar file to prevent re-processing
                     os.remove(processing_tar_file)
@@ -104,4 +131,31 @@ class StreamingPILDataset(StreamingDataset):
                     error_message = str(e)
                     if len(error_message) > 1000:
                         error_message = error_message[:1000] + '... [truncated]'
-                    print(f'Error processing image: {error_message}')
\ No newline at end of file
+                    print(f'Error processing image: {error_message}')
+
+class StreamingRecordDataset(StreamingDataset):
+    """
+    Reads the pre-decoded record shards vitsae writes with record_shards=True,
+    yielding (batch_size, 224, 224, 3) uint8 arrays straight out of a memory
+    map, with no jpeg decoding or resizing. Use it with batch_size=None in the
+    DataLoader. Records left over at the end of a shard are carried into the
+    first batch of the next one, and come out as a last, smaller batch once
+    the stream stops.
+    """
+    ready_suffix = '.ready.rec'
+
+    def __init__(self, data_dir, batch_size):
+        super().__init__(data_dir)
+        self.batch_size = batch_size
+        self._carry = None
+
+    def _read_file(self, tar_file, processing_tar_file, worker_id):
+        records = open_records(processing_tar_file)
+        self._carry = yield from record_batches(records, self.batch_size, self._carry)
+        del records
+
+    def __iter__(self):
+        yield from super().__iter__()
+        if self._carry is not None and len(self._carry):
+            yield self._carry
+        self._carry = None
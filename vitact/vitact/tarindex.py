@@ -0,0 +1,117 @@
+import os
+import json
+import tarfile
+from collections import OrderedDict
+
+INDEX_SUFFIX = '.idx'
+
+class TarIndex:
+    """
+    The offset index vitsae uploads next to every webdataset tar, as
+    {tar key}.idx. Member i has its data at offsets[i] for sizes[i] bytes, and
+    jpgs also list their width, height and a status of 'ok' or 'invalid'.
+    """
+    def __init__(self, names, offsets, sizes, widths, heights, statuses, tar_size=None):
+        self.names = names
+        self.offsets = offsets
+        self.sizes = sizes
+        self.widths = widths
+        self.heights = heights
+        self.statuses = statuses
+        self.tar_size = tar_size
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_bytes(cls, data):
+        fields = json.loads(data)
+        return cls(fields['names'], fields['offsets'], fields['sizes'], fields['widths'], fields['heights'], fields['statuses'], fields.get('tar_size'))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+    @classmethod
+    def from_tar(cls, tar_path):
+        """
+        Build an index by walking a tar that has none, without image dimensions.
+        """
+        names, offsets, sizes = [], [], []
+        with tarfile.open(tar_path, 'r') as tar:
+            for member in tar:
+                if member.isfile():
+                    names.append(member.name)
+                    offsets.append(member.offset_data)
+                    sizes.append(member.size)
+        unknown = [None] * len(names)
+        return cls(names, offsets, sizes, unknown, list(unknown), [''] * len(names), os.path.getsize(tar_path))
+
+    def samples(self, skip_invalid=True):
+        """
+        Members grouped into webdataset samples, as an ordered list of
+        (key, {extension: member number}). Samples whose jpg is marked invalid
+        are left out unless skip_invalid is False.
+        """
+        samples = OrderedDict()
+        for i, name in enumerate(self.names):
+            key, _, extension = name.rpartition('.')
+            samples.setdefault(key, {})[extension] = i
+        return [
+            (key, members) for key, members in samples.items()
+            if not (skip_invalid and 'jpg' in members and self.statuses[members['jpg']] == 'invalid')
+        ]
+
+def split_samples(samples, worker_id, num_workers):
+    """
+    A contiguous share of samples for one of num_workers readers of the same tar,
+    e.g. workers fetching members of one S3 tar with fetch_members. The local
+    StreamingDataset doesn't use it, each of its workers claims whole tars.
+    """
+    per_worker, extra = divmod(len(samples), num_workers)
+    start = worker_id * per_worker + min(worker_id, extra)
+    return samples[start:start + per_worker + (1 if worker_id < extra else 0)]
+
+def read_member(f, index, i):
+    """
+    Read member i of an open, seekable tar without walking the members before it.
+    """
+    f.seek(index.offsets[i])
+    return f.read(index.sizes[i])
+
+def byte_ranges(index, members, max_gap=64 * 1024):
+    """
+    Group members into (start, end, members) ranges of the tar, merging members
+    less than max_gap bytes apart so a subset can be fetched with few requests.
+    """
+    ranges = []
+    for i in sorted(members, key=lambda i: index.offsets[i]):
+        start, end = index.offsets[i], index.offsets[i] + index.sizes[i]
+        if ranges and start - ranges[-1][1] <= max_gap:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end), ranges[-1][2] + [i])
+        else:
+            ranges.append((start, end, [i]))
+    return ranges
+
+def fetch_members(s3, bucket, key, index, members, max_gap=64 * 1024):
+    """
+    Yield (name, bytes) for members of the tar at s3://bucket/key using range
+    GETs, without downloading the rest of the tar.
+    """
+    for start, end, group in byte_ranges(index, members, max_gap):
+        response = s3.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end - 1}')
+        data = response['Body'].read()
+        for i in group:
+            offset = index.offsets[i] - start
+            yield index.names[i], data[offset:offset + index.sizes[i]]
+
+def load_s3_index(s3, bucket, key):
+    """
+    The index of the tar at s3://bucket/key, or None if it has none.
+    """
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key + INDEX_SUFFIX)
+    except Exception:
+        return None
+    return TarIndex.from_bytes(response['Body'].read())
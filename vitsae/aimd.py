@@ -0,0 +1,150 @@
+import asyncio
+import time
+from collections import deque
+
+class ConcurrencyLimiter:
+    """
+    An asyncio semaphore whose limit can be changed while it is in use. Lowering
+    the limit doesn't cancel anything, new acquisitions just wait until enough
+    holders have released.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.held = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.held < self.limit)
+            self.held += 1
+
+    async def release(self):
+        async with self._condition:
+            self.held -= 1
+            self._condition.notify()
+
+    async def set_limit(self, limit):
+        async with self._condition:
+            grew = limit - self.limit
+            self.limit = limit
+            if grew > 0:
+                self._condition.notify(grew)
+
+class AIMDController:
+    """
+    Additive-increase / multiplicative-decrease control of download concurrency,
+    driven by a sliding window of download_image outcomes.
+
+    Every interval seconds update() compares the current window with the one
+    before it. If the error or timeout rate climbed by more than the allowed
+    step, or the timeout rate is above max_timeout_rate, the limit is
+    multiplied by decrease. Otherwise, if successful images
+    per second improved, the limit grows by increase. Flat throughput holds the
+    limit where it is, and after probe_after holds in a row it tries another
+    increase. The base failure rate of LAION URLs is high, so the controller
+    reacts to changes in the error rate rather than its level.
+    """
+    def __init__(
+            self,
+            initial=200,
+            minimum=50,
+            maximum=2000,
+            increase=25,
+            decrease=0.7,
+            window=30.0,
+            interval=5.0,
+            error_rate_step=0.05,
+            timeout_rate_step=0.03,
+            max_timeout_rate=0.3,
+            improvement=0.02,
+            min_samples=50,
+            probe_after=6
+        ):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.window = window
+        self.interval = interval
+        self.error_rate_step = error_rate_step
+        self.timeout_rate_step = timeout_rate_step
+        self.max_timeout_rate = max_timeout_rate
+        self.improvement = improvement
+        self.min_samples = min_samples
+        self.probe_after = probe_after
+
+        self.outcomes = deque()
+        self.last = None
+        self.holds = 0
+        self.history = []
+
+    def record(self, succeeded, timed_out=False, now=None):
+        self.outcomes.append((now if now is not None else time.time(), succeeded, timed_out))
+
+    def window_stats(self, now=None):
+        now = now if now is not None else time.time()
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            self.outcomes.popleft()
+
+        total = len(self.outcomes)
+        if total == 0:
+            return None
+
+        succeeded = sum(1 for _, ok, _ in self.outcomes if ok)
+        timed_out = sum(1 for _, _, t in self.outcomes if t)
+        span = max(now - self.outcomes[0][0], 1e-3)
+
+        return {
+            'samples': total,
+            'success_per_second': succeeded / span,
+            'error_rate': 1 - succeeded / total,
+            'timeout_rate': timed_out / total,
+        }
+
+    def _decide(self, current):
+        if current['timeout_rate'] > self.max_timeout_rate:
+            return 'decrease', f"timeout rate {current['timeout_rate']:.2f} is above {self.max_timeout_rate:.2f}"
+        if self.last is None:
+            return 'increase', 'probing from the initial limit'
+
+        if current['timeout_rate'] - self.last['timeout_rate'] > self.timeout_rate_step:
+            return 'decrease', f"timeout rate rose from {self.last['timeout_rate']:.2f} to {current['timeout_rate']:.2f}"
+        if current['error_rate'] - self.last['error_rate'] > self.error_rate_step:
+            return 'decrease', f"error rate rose from {self.last['error_rate']:.2f} to {current['error_rate']:.2f}"
+        if current['success_per_second'] > self.last['success_per_second'] * (1 + self.improvement):
+            return 'increase', f"success rate improved from {self.last['success_per_second']:.1f}/s to {current['success_per_second']:.1f}/s"
+
+        if self.holds + 1 >= self.probe_after:
+            return 'increase', f"probing after {self.holds + 1} flat windows"
+
+        return 'hold', f"success rate flat at {current['success_per_second']:.1f}/s"
+
+    def update(self, now=None):
+        """
+        Re-evaluate the window and return the new concurrency limit.
+        """
+        current = self.window_stats(now)
+        if current is None or current['samples'] < self.min_samples:
+            return self.limit
+
+        decision, reason = self._decide(current)
+        previous = self.limit
+        if decision == 'decrease':
+            self.limit = max(self.minimum, int(self.limit * self.decrease))
+        elif decision == 'increase':
+            self.limit = min(self.maximum, self.limit + self.increase)
+
+        self.history.append((now if now is not None else time.time(), decision, previous, self.limit, reason))
+        if self.limit != previous:
+            print(f"Concurrency {decision} {previous} -> {self.limit}: {reason}")
+
+        # the limit changed, so start the next comparison from a clean window
+        self.last = current
+        if decision == 'hold':
+            self.holds += 1
+        else:
+            self.holds = 0
+            self.outcomes.clear()
+
+        return self.limit
@@ -0,0 +1,278 @@
+import bisect
+import math
+
+from checkpoint import parse_prefix
+
+# jpeg bytes per pixel of a row's listed WIDTH x HEIGHT, averaged over rows that
+# download and rows that don't, so the estimate is per row of the parquet. It is
+# fixed so resumed runs cut the same batches, observe() logs how far off it is
+BYTES_PER_PIXEL = 0.1
+DEFAULT_ROW_BYTES = 16 * 1024
+
+def estimate_row_bytes(row, bytes_per_pixel=BYTES_PER_PIXEL, max_side=None):
+    """
+    Rough number of bytes a LAION row will add to a tar, from its WIDTH and
+    HEIGHT. None if the row doesn't list a usable size.
+    """
+    try:
+        width, height = float(row.get('WIDTH')), float(row.get('HEIGHT'))
+    except (TypeError, ValueError):
+        return None
+    if not (math.isfinite(width) and math.isfinite(height)) or width <= 0 or height <= 0:
+        return None
+
+    # images are shrunk to max_side before they are written
+    if max_side and max(width, height) > max_side:
+        scale = max_side / max(width, height)
+        width, height = width * scale, height * scale
+    return width * height * bytes_per_pixel
+
+def _merge(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class BatchPlanner:
+    """
+    Groups the rows of a parquet, read in order, into the batches behind the
+    {pq_id}-{start}-{end} prefixes.
+
+    Without target_bytes a batch is the max_rows rows starting at a multiple of
+    max_rows, and with row_ranges every range is a batch. With target_bytes a
+    batch is cut as soon as its rows' estimated bytes reach target_bytes, with
+    at least min_rows and at most max_rows rows, so tars come out roughly the
+    same size however big the images are. The rows of a batch are held back
+    until it is cut, since its prefix isn't known before then.
+
+    Rows inside a batch that was already processed are skipped and a batch
+    never runs into one, so cutting restarts from the same row after a resume
+    and the same prefixes come out, even if the processed batches were cut
+    with other settings.
+
+    add() and finish() return events for the producer: ('start', prefix),
+    ('row', prefix, index, row), ('close', prefix) and ('skip', prefix) the
+    first time a row of an already processed batch is seen.
+
+    bytes_per_pixel never changes during a run, since the prefixes have to come
+    out the same for any worker. observe() logs the bytes a batch actually got
+    against its estimate, and the bytes per pixel seen so far, to tune it by.
+    """
+    def __init__(self, pq_id, max_rows, min_rows=1, target_bytes=None, bytes_per_pixel=BYTES_PER_PIXEL, max_side=None, already_processed=(), row_ranges=None):
+        self.pq_id = pq_id
+        self.max_rows = max_rows
+        self.min_rows = min(min_rows, max_rows)
+        self.target_bytes = target_bytes
+        self.bytes_per_pixel = bytes_per_pixel
+        self.max_side = max_side
+
+        self.processed = {}
+        for prefix in already_processed:
+            try:
+                pq_id, start, end = parse_prefix(prefix)
+            except ValueError:
+                continue
+            if pq_id == self.pq_id:
+                self.processed[(start, end)] = prefix
+        self.covered = _merge(self.processed)
+        self.covered_starts = [s for s, _ in self.covered]
+        self.row_ranges = sorted(row_ranges) if row_ranges is not None else None
+
+        self.prefix = None
+        self.start = None
+        self.end = None
+        self.rows = []
+        self.pixels = 0.0
+        self.known_pixels = 0.0
+        self.known_rows = 0
+        self.skipped = None
+
+        # pixels and estimated bytes of the batches cut by size, until observed, and the totals observed
+        self.estimated = {}
+        self.observed_pixels = 0.0
+        self.observed_bytes = 0
+
+    def _prefix(self, start, end):
+        return f"{self.pq_id}-{start}-{end}"
+
+    def _covering(self, index, intervals, starts):
+        i = bisect.bisect_right(starts, index) - 1
+        if i >= 0 and index < intervals[i][1]:
+            return intervals[i]
+        return None
+
+    def _next_covered_start(self, index):
+        i = bisect.bisect_right(self.covered_starts, index)
+        return self.covered_starts[i] if i < len(self.covered_starts) else None
+
+    def _skip(self, index):
+        interval = self._covering(index, self.covered, self.covered_starts)
+        if interval == self.skipped:
+            return []
+        self.skipped = interval
+        prefix = next(p for (s, e), p in self.processed.items() if s <= index < e)
+        return [('skip', prefix)]
+
+    def add(self, index, row):
+        if self.covered and self._covering(index, self.covered, self.covered_starts) is not None:
+            return self._skip(index)
+
+        if self.row_ranges is not None or self.target_bytes is None:
+            return self._add_known(index, row)
+        return self._add_by_bytes(index, row)
+
+    def _add_known(self, index, row):
+        # the end of the batch is known up front, so rows go out as soon as they are read
+        events = []
+        if self.prefix is None or not self.start <= index < self.end:
+            events += self.finish()
+            if self.row_ranges is not None:
+                starts = [s for s, _ in self.row_ranges]
+                interval = self._covering(index, self.row_ranges, starts)
+                if interval is None:
+                    return events
+                self.start, self.end = interval
+            else:
+                self.start = (index // self.max_rows) * self.max_rows
+                self.end = self.start + self.max_rows
+            self.prefix = self._prefix(self.start, self.end)
+            events.append(('start', self.prefix))
+
+        events.append(('row', self.prefix, index, row))
+        return events
+
+    def _add_by_bytes(self, index, row):
+        events = []
+        if self.start is not None and index != self.start + len(self.rows):
+            events += self.finish()  # rows aren't contiguous, e.g. a slice of the parquet
+
+        if self.start is None:
+            self.start = index
+        pixels = estimate_row_bytes(row, 1, self.max_side)
+        if pixels is None:
+            # rows without a size count as the average of the batch's rows with one
+            pixels = self.known_pixels / self.known_rows if self.known_rows else DEFAULT_ROW_BYTES / self.bytes_per_pixel
+        else:
+            self.known_pixels += pixels
+            self.known_rows += 1
+        self.rows.append((index, row))
+        self.pixels += pixels
+
+        full = len(self.rows) >= self.max_rows or (self.pixels * self.bytes_per_pixel >= self.target_bytes and len(self.rows) >= self.min_rows)
+        if full:
+            events += self._cut(index + 1)
+        else:
+            # cut short where an already processed batch begins
+            next_covered = self._next_covered_start(index)
+            if next_covered is not None and next_covered == index + 1:
+                events += self._cut(index + 1)
+        return events
+
+    def _cut(self, end):
+        prefix = self._prefix(self.start, end)
+        estimate = self.pixels * self.bytes_per_pixel
+        print(f"Planned batch {prefix}: {len(self.rows)} rows, about {estimate / 1e6:.0f} MB")
+        self.estimated[prefix] = (self.pixels, estimate)
+        events = [('start', prefix)]
+        events += [('row', prefix, index, row) for index, row in self.rows]
+        events.append(('close', prefix))
+        self.start = None
+        self.rows = []
+        self.pixels = 0.0
+        self.known_pixels = 0.0
+        self.known_rows = 0
+        return events
+
+    def observe(self, prefix, nbytes):
+        """
+        Log the bytes written for a batch cut by size against its estimate.
+        Returns the bytes per pixel of every batch observed so far, the cut
+        points themselves are left alone.
+        """
+        if prefix not in self.estimated:
+            return None
+        pixels, estimate = self.estimated.pop(prefix)
+        self.observed_pixels += pixels
+        self.observed_bytes += nbytes
+        observed = self.observed_bytes / self.observed_pixels if self.observed_pixels else None
+        print(f"Batch {prefix}: {nbytes / 1e6:.0f} MB written, estimated {estimate / 1e6:.0f} MB, {observed or 0:.3f} bytes per pixel so far against {self.bytes_per_pixel}")
+        return observed
+
+    def forget(self, prefix):
+        """
+        Drop the estimate of a batch whose written bytes don't reflect its rows,
+        e.g. one sealed partial by a drain or resumed from a checkpoint.
+        """
+        self.estimated.pop(prefix, None)
+
+    def finish(self, flush=True):
+        """
+        Close the open batch, at the end of the parquet or of a run of rows.
+        With flush=False rows held back for a batch that wasn't cut yet are
+        dropped instead.
+        """
+        if self.prefix is not None:
+            prefix = self.prefix
+            self.prefix = None
+            return [('close', prefix)]
+        if self.rows and not flush:
+            self.start = None
+            self.rows = []
+            self.pixels = 0.0
+            self.known_pixels = 0.0
+            self.known_rows = 0
+            return []
+        if self.rows:
+            # a batch left short by the end of the rows keeps a nominal end, like the last count-sized batch
+            end = self.start + self.max_rows
+            next_covered = self._next_covered_start(self.start)
+            if next_covered is not None:
+                end = min(end, next_covered)
+            return self._cut(end)
+        return []
+
+def leftover_batches(remaining_rows, max_rows):
+    """
+    The batches for the rows a drain left over: each of remaining_rows, merged,
+    cut where the count-sized batches of max_rows rows begin. They never reach
+    into the partial shards the drain uploaded, whose rows aren't remaining.
+    """
+    batches = []
+    for start, end in _merge(remaining_rows):
+        while start < end:
+            cut = min(end, (start // max_rows + 1) * max_rows)
+            batches.append((start, cut))
+            start = cut
+    return batches
+
+def remaining_row_ranges(pq_id, row_ranges, already_processed):
+    """
+    The parts of row_ranges not covered by any already processed batch of
+    pq_id, as sorted, merged (start, end) pairs.
+    """
+    covered = []
+    for prefix in already_processed:
+        try:
+            prefix_pq_id, start, end = parse_prefix(prefix)
+        except ValueError:
+            continue
+        if prefix_pq_id == pq_id:
+            covered.append((start, end))
+    covered = _merge(covered)
+
+    remaining = []
+    for start, end in _merge(row_ranges):
+        for covered_start, covered_end in covered:
+            if covered_end <= start or covered_start >= end:
+                continue
+            if covered_start > start:
+                remaining.append((start, covered_start))
+            start = covered_end
+            if start >= end:
+                break
+        if start < end:
+            remaining.append((start, end))
+    return remaining
@@ -0,0 +1,481 @@
+import io
+import os
+import json
+import time
+import random
+import resource
+import tempfile
+import threading
+import functools
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest.mock import MagicMock
+from urllib.parse import urlparse, parse_qs
+
+import fire
+import pyarrow as pa
+import pyarrow.parquet as pq
+from PIL import Image
+
+# poetry run python benchmark.py --num_rows 20000 --num_hosts 20 --concurrency 400 --latency 0.05
+
+def make_jpeg(width=32, height=32, color='white'):
+    buf = io.BytesIO()
+    Image.new('RGB', (width, height), color=color).save(buf, 'JPEG')
+    return buf.getvalue()
+
+@functools.lru_cache(maxsize=64)
+def cached_jpeg(size):
+    return make_jpeg(size, size)
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves a jpeg for any path. How each path responds is drawn from the
+    server's profile (latency, error_rate, timeout_rate, sizes). The status and
+    image size are seeded by the path so a url always gets the same one, while
+    latency and timeouts vary from request to request. Query parameters override
+    the profile: delay (seconds), status (http status), size (width/height of
+    the image), content_type (the Content-Type header, omitted if empty),
+    body=html to send an html page instead and no_length=1 to leave out
+    Content-Length. If server.capacity is set the delay grows with the number
+    of requests in flight beyond it, to emulate a congested host.
+    """
+    def _profile(self, query):
+        server = self.server
+        # errors and sizes stick to a url like they do on real hosts, slow responses don't
+        rng = random.Random(f'{server.seed}:{urlparse(self.path).path}')
+        status = rng.choice([403, 404, 500]) if rng.random() < server.error_rate else 200
+        size = rng.choice(server.sizes)
+
+        delay = server.latency + random.uniform(0, server.latency_jitter)
+        if random.random() < server.timeout_rate:
+            delay = server.timeout_delay
+
+        if 'delay' in query:
+            delay = float(query['delay'][0])
+        if 'status' in query:
+            status = int(query['status'][0])
+        if 'size' in query:
+            size = int(query['size'][0])
+        return delay, status, size
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query, keep_blank_values=True)
+        delay, status, size = self._profile(query)
+        content_type = query.get('content_type', ['image/jpeg'])[0]
+        html = query.get('body', [''])[0] == 'html'
+        send_length = query.get('no_length', ['0'])[0] != '1'
+
+        with self.server.lock:
+            self.server.request_count += 1
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+            in_flight = self.server.in_flight
+
+        try:
+            if self.server.capacity:
+                delay *= max(1, in_flight / self.server.capacity)
+            if delay:
+                time.sleep(delay)
+            self.respond(status, size, content_type, html, send_length)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def respond(self, status, size, content_type='image/jpeg', html=False, send_length=True):
+        if status != 200:
+            self.send_response(status)
+            self.end_headers()
+            return
+
+        body = b'<html><body>Not found</body></html>' if html else cached_jpeg(size)
+        self.send_response(200)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        if send_length:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class ImageServer(ThreadingHTTPServer):
+    """
+    A local stand-in for the image hosts in a LAION parquet. With the default
+    profile every request gets a 32x32 jpeg straight away.
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, latency_jitter=0.0, error_rate=0.0, timeout_rate=0.0, timeout_delay=30.0, sizes=(32,), seed=0):
+        super().__init__((host, port), ImageRequestHandler)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_delay = timeout_delay
+        self.sizes = list(sizes)
+        self.seed = seed
+
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.capacity = None
+
+    @property
+    def base_url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def handle_error(self, request, client_address):
+        pass  # clients hanging up on slow responses
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def _serve_images(hosts, connection, profile):
+    servers = [ImageServer(host=host, **profile).start() for host in hosts]
+    connection.send([server.base_url for server in servers])
+    connection.recv()  # block until told to stop
+    for server in servers:
+        server.stop()
+
+class ImageServerProcess:
+    """
+    Runs an ImageServer on each of num_hosts loopback addresses (127.0.0.1,
+    127.0.0.2, ...) in a separate process, so serving images doesn't compete
+    with the pipeline for the GIL and every host counts as its own domain.
+    """
+    def __init__(self, num_hosts=1, **profile):
+        self.hosts = [f'127.0.0.{i + 1}' for i in range(num_hosts)]
+        self.profile = profile
+
+    def __enter__(self):
+        ctx = multiprocessing.get_context('spawn')
+        self.connection, child_connection = ctx.Pipe()
+        self.process = ctx.Process(target=_serve_images, args=(self.hosts, child_connection, self.profile), daemon=True)
+        self.process.start()
+        self.base_urls = self.connection.recv()
+        return self
+
+    def __exit__(self, *exc):
+        self.connection.send('stop')
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+
+def write_parquet(path, urls, row_group_size=None):
+    table = pa.table({
+        'URL': urls,
+        'hash': list(range(len(urls))),
+        'TEXT': [f'caption {i}' for i in range(len(urls))],
+    })
+    pq.write_table(table, path, row_group_size=row_group_size)
+    return str(path)
+
+def write_synthetic_parquet(path, base_urls, num_rows, sizes=(256,), row_group_size=10_000, seed=0):
+    """
+    A parquet with LAION's columns whose URLs are spread at random over
+    base_urls, so some hosts get more rows than others. Every row asks for an
+    image of one of sizes, which is also what it lists as its WIDTH and HEIGHT.
+    """
+    rng = random.Random(seed)
+    weights = [1 / (i + 1) for i in range(len(base_urls))]
+    hosts = rng.choices(base_urls, weights=weights, k=num_rows)
+    row_sizes = [rng.choice(sizes) for _ in range(num_rows)]
+    table = pa.table({
+        'URL': [f'{host}/{i}.jpg?size={size}' for i, (host, size) in enumerate(zip(hosts, row_sizes))],
+        'hash': list(range(num_rows)),
+        'TEXT': [f'caption {i}' for i in range(num_rows)],
+        'WIDTH': [float(size) for size in row_sizes],
+        'HEIGHT': [float(size) for size in row_sizes],
+        'similarity': [rng.random() for _ in range(num_rows)],
+    })
+    pq.write_table(table, path, row_group_size=row_group_size)
+    return str(path)
+
+class FakeS3:
+    """
+    Enough of an S3 client for the pipeline, backed by a dict of key to bytes.
+    """
+    def __init__(self):
+        self.objects = {}
+        self.multipart_uploads = {}
+        self._lock = threading.Lock()
+        self._next_upload = 0
+
+    def upload_fileobj(self, fileobj, bucket, key):
+        data = fileobj.read()
+        with self._lock:
+            self.objects[key] = data
+
+    def upload_file(self, filename, bucket, key):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        with self._lock:
+            self.objects[key] = data
+
+    def download_fileobj(self, bucket, key, fileobj):
+        with self._lock:
+            if key not in self.objects:
+                raise KeyError(key)
+            data = self.objects[key]
+        fileobj.write(data)
+
+    def head_object(self, Bucket, Key):
+        with self._lock:
+            if Key not in self.objects:
+                raise KeyError(Key)
+            return {'ContentLength': len(self.objects[Key])}
+
+    def delete_object(self, Bucket, Key):
+        with self._lock:
+            self.objects.pop(Key, None)
+
+    def create_multipart_upload(self, Bucket, Key):
+        with self._lock:
+            self._next_upload += 1
+            upload_id = f'upload-{self._next_upload}'
+            self.multipart_uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self._lock:
+            self.multipart_uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        with self._lock:
+            parts = self.multipart_uploads.pop(UploadId)
+            self.objects[Key] = b''.join(parts[p['PartNumber']] for p in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        with self._lock:
+            self.multipart_uploads.pop(UploadId, None)
+
+    def get_paginator(self, name):
+        paginator = MagicMock()
+        paginator.paginate.side_effect = lambda Bucket, Prefix: [
+            {'Contents': [{'Key': k} for k in sorted(self.objects) if k.startswith(Prefix)]}
+        ]
+        return paginator
+
+class FakeSQS:
+    """
+    An in-memory SQS client. Received messages stay hidden until they are
+    deleted or their visibility is set back to zero.
+    """
+    def __init__(self):
+        self.queues = {}
+        self.in_flight = {}
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        with self._lock:
+            self._next_id += 1
+            message_id = str(self._next_id)
+            self.queues.setdefault(QueueUrl, []).append({'MessageId': message_id, 'Body': MessageBody})
+        return {'MessageId': message_id}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        with self._lock:
+            queue = self.queues.setdefault(QueueUrl, [])
+            messages = queue[:MaxNumberOfMessages]
+            del queue[:MaxNumberOfMessages]
+            for message in messages:
+                message['ReceiptHandle'] = f"rh-{message['MessageId']}"
+                self.in_flight[message['ReceiptHandle']] = (QueueUrl, message)
+        return {'Messages': messages} if messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        with self._lock:
+            self.in_flight.pop(ReceiptHandle, None)
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        with self._lock:
+            if ReceiptHandle not in self.in_flight:
+                raise KeyError(ReceiptHandle)
+            if VisibilityTimeout == 0:
+                queue_url, message = self.in_flight.pop(ReceiptHandle)
+                self.queues.setdefault(queue_url, []).insert(0, message)
+
+    def bodies(self, queue_url):
+        with self._lock:
+            return [m['Body'] for m in self.queues.get(queue_url, [])]
+
+class FakeDynamoTable:
+    """
+    An in-memory stand-in for the boto3 DynamoDB Table the pipeline writes to,
+    keyed on (parquet_id, batch_id).
+    """
+    def __init__(self):
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def put_item(self, Item):
+        with self._lock:
+            self.items[(Item['parquet_id'], Item['batch_id'])] = dict(Item)
+        return {}
+
+    def get_item(self, Key):
+        with self._lock:
+            item = self.items.get((Key['parquet_id'], Key['batch_id']))
+        return {'Item': dict(item)} if item is not None else {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, **kwargs):
+        # only the "ADD attribute :value" form the upload counter uses
+        _, attribute, placeholder = UpdateExpression.split()
+        with self._lock:
+            item = self.items.setdefault((Key['parquet_id'], Key['batch_id']), dict(Key))
+            item[attribute] = item.get(attribute, 0) + ExpressionAttributeValues[placeholder]
+            return {'Attributes': {attribute: item[attribute]}}
+
+    def query(self, KeyConditionExpression, **kwargs):
+        # boto3's Key('parquet_id').eq(x) keeps the value as its second operand
+        pq_id = KeyConditionExpression.get_expression()['values'][1]
+        with self._lock:
+            return {'Items': [dict(item) for (p, _), item in self.items.items() if p == pq_id]}
+
+    def scan(self, **kwargs):
+        with self._lock:
+            return {'Items': [dict(item) for item in self.items.values()]}
+
+def _usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime, own.ru_maxrss
+
+def run_benchmark(
+    num_rows=5000,
+    num_hosts=8,
+    concurrency=200,
+    max_images_per_tar=1000,
+    min_images_per_tar=500,
+    write_shards=False,
+    stream_uploads=False,
+    upload_workers=4,
+    latency=0.02,
+    latency_jitter=0.05,
+    error_rate=0.1,
+    timeout_rate=0.0,
+    sizes=(64, 128, 256),
+    request_timeout=2,
+    limit_per_host=64,
+    image_processes=0,
+    max_image_side=None,
+    hedge_percentile=None,
+    hedge_budget=0.05,
+    base_dir=None,
+    **process_kwargs
+):
+    """
+    Push a synthetic parquet through the real process_parquet and TarMaker,
+    against local image servers and in-memory SQS, S3 and DynamoDB, and return
+    throughput and resource use.
+    """
+    from generatewds import process_parquet
+    from uploadwds import TarMaker
+    from shards import FileSink, ShardWriter
+    from counter import UploadCounter
+    from hedge import HedgePolicy
+
+    if hedge_percentile is not None:
+        process_kwargs['hedge'] = HedgePolicy(percentile=hedge_percentile, budget=hedge_budget, min_samples=50)
+
+    profile = dict(latency=latency, latency_jitter=latency_jitter, error_rate=error_rate, timeout_rate=timeout_rate, sizes=sizes, timeout_delay=request_timeout * 2)
+    with tempfile.TemporaryDirectory() as tmp, ImageServerProcess(num_hosts, **profile) as servers:
+        base_dir = base_dir or os.path.join(tmp, 'images')
+        os.makedirs(base_dir, exist_ok=True)
+        pq_path = write_synthetic_parquet(os.path.join(tmp, 'bench.parquet'), servers.base_urls, num_rows, sizes=sizes)
+
+        s3, sqs, table = FakeS3(), FakeSQS(), FakeDynamoTable()
+        upload_counter = UploadCounter(table, refresh_interval=1)
+        upload_counter.start()
+        uploader = TarMaker(
+            watch_dir=base_dir,
+            min_images_per_tar=min_images_per_tar,
+            s3_client=s3,
+            s3_bucket_name='bench',
+            s3_prefix='wds',
+            ddb_table=table,
+            sqs_client=sqs,
+            tar_queue_url='tars',
+            wait_after_last_change=5,
+            upload_counter=upload_counter,
+            validate_images=not image_processes,
+            stream_uploads=stream_uploads,
+            upload_workers=upload_workers
+        )
+        t = threading.Thread(target=uploader.keep_monitoring, kwargs={'sleep_time': 0.5})
+        t.start()
+
+        if write_shards:
+            sink = ShardWriter(base_dir, on_seal=uploader.submit_tar, validate=not image_processes)
+        else:
+            sink = FileSink(base_dir, on_seal=uploader.batch_complete, on_write=uploader.files_written)
+
+        cpu_start, children_start, _ = _usage()
+        start = time.time()
+        stats = process_parquet(
+            ddb_table=table,
+            base_dir=base_dir,
+            pq_path=pq_path,
+            pq_id='00000',
+            already_processed=set(),
+            max_images_per_tar=max_images_per_tar,
+            concurrency=concurrency,
+            total_images_required=num_rows * 10,
+            min_images_per_tar=min_images_per_tar,
+            sink=sink,
+            limit_per_host=limit_per_host,
+            request_timeout=request_timeout,
+            upload_counter=upload_counter,
+            image_processes=image_processes,
+            max_image_side=max_image_side,
+            **process_kwargs
+        )
+        download_seconds = time.time() - start
+
+        uploader.finalize()
+        t.join()
+        upload_counter.stop()
+        elapsed = time.time() - start
+        cpu_end, children_end, max_rss = _usage()
+
+        tars = [k for k in s3.objects if k.endswith('.tar')]
+        return {
+            'rows': num_rows,
+            'images': stats['succeeded'],
+            'images_per_second': stats['succeeded'] / download_seconds,
+            'rows_per_second': stats['completed'] / download_seconds,
+            'tars': len(tars),
+            'tars_per_second': len(tars) / elapsed,
+            'tar_bytes': sum(len(s3.objects[k]) for k in tars),
+            'min_tar_mb': min((len(s3.objects[k]) for k in tars), default=0) / 1e6,
+            'max_tar_mb': max((len(s3.objects[k]) for k in tars), default=0) / 1e6,
+            'download_seconds': download_seconds,
+            'elapsed_seconds': elapsed,
+            'cpu_seconds': cpu_end - cpu_start,
+            'child_cpu_seconds': children_end - children_start,
+            'cpu_percent': 100 * (cpu_end - cpu_start) / elapsed,
+            'max_rss_mb': max_rss / 1024,
+            'hedged': stats.get('hedges', {}).get('hedged', 0),
+            'hedge_won': stats.get('hedges', {}).get('hedge_won', 0),
+        }
+
+def main(output=None, **kwargs):
+    results = run_benchmark(**kwargs)
+    for k, v in results.items():
+        print(f'{k}: {v:.2f}' if isinstance(v, float) else f'{k}: {v}')
+    if output is not None:
+        with open(output, 'a') as f:
+            f.write(json.dumps(dict(results, params=kwargs)) + '\n')
+
+if __name__ == "__main__":
+    fire.Fire(main)
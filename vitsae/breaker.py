@@ -0,0 +1,116 @@
+import io
+import json
+import time
+import socket
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class DomainBreakers:
+    """
+    A circuit breaker per image domain. After failure_threshold timeouts or
+    connection errors in a row a domain opens, and its rows are skipped without
+    a request for cooldown seconds. After that it is half open, a single probe
+    request is let through, and the domain closes again if the probe gets any
+    http response or re-opens with double the cooldown (up to max_cooldown) if
+    it doesn't. 404s and other error statuses come from a live host, so they
+    don't count as failures.
+
+    Only domains that have failed are tracked, and their state can be saved to
+    and merged from S3 so every node starts out knowing which domains are dead.
+    """
+    def __init__(self, failure_threshold=5, cooldown=300, max_cooldown=3600, half_open_probes=1):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.half_open_probes = half_open_probes
+
+        self.domains = {}
+        self.stats = {'tripped': 0, 'skipped': 0}
+
+    def _now(self, now):
+        return now if now is not None else time.time()
+
+    def state(self, domain, now=None):
+        entry = self.domains.get(domain)
+        if entry is None:
+            return CLOSED
+        if entry['state'] == OPEN and self._now(now) >= entry['open_until']:
+            entry['state'] = HALF_OPEN
+            entry['probes'] = 0
+        return entry['state']
+
+    def is_open(self, domain, now=None):
+        return self.state(domain, now) == OPEN
+
+    def allow(self, domain, now=None):
+        """
+        Whether a request to domain should be made now. In the half open state
+        this hands out the probe, so call it right before the request.
+        """
+        state = self.state(domain, now)
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and self.domains[domain]['probes'] < self.half_open_probes:
+            self.domains[domain]['probes'] += 1
+            return True
+        self.stats['skipped'] += 1
+        return False
+
+    def _open(self, domain, entry, cooldown, now):
+        entry['state'] = OPEN
+        entry['cooldown'] = cooldown
+        entry['open_until'] = self._now(now) + cooldown
+        self.stats['tripped'] += 1
+        print(f"Circuit open for {domain} for {cooldown} seconds after {entry['failures']} failures.")
+
+    def record(self, domain, succeeded, now=None):
+        entry = self.domains.get(domain)
+        if succeeded:
+            if entry is not None:
+                del self.domains[domain]
+            return
+
+        if entry is None:
+            entry = self.domains[domain] = {'state': CLOSED, 'failures': 0, 'cooldown': self.cooldown, 'open_until': 0, 'probes': 0}
+        entry['failures'] += 1
+
+        state = self.state(domain, now)
+        if state == HALF_OPEN:
+            self._open(domain, entry, min(self.max_cooldown, entry['cooldown'] * 2), now)
+        elif state == CLOSED and entry['failures'] >= self.failure_threshold:
+            self._open(domain, entry, self.cooldown, now)
+
+    def to_dict(self):
+        return {domain: {k: entry[k] for k in ['state', 'failures', 'cooldown', 'open_until']} for domain, entry in self.domains.items()}
+
+    def merge_dict(self, domains):
+        """
+        Merge saved state, keeping whichever side has the domain open for longer.
+        """
+        for domain, saved in domains.items():
+            entry = self.domains.get(domain)
+            if entry is None or saved['open_until'] > entry['open_until']:
+                self.domains[domain] = dict(saved, probes=0)
+
+    def save(self, s3_client, bucket, prefix, node_id=None):
+        node_id = node_id or socket.gethostname()
+        body = json.dumps(self.to_dict()).encode('utf-8')
+        s3_client.upload_fileobj(io.BytesIO(body), bucket, f'{prefix}/{node_id}.json')
+        print(f'Saved {len(self.domains)} domain breakers to s3://{bucket}/{prefix}/{node_id}.json')
+
+    def load(self, s3_client, bucket, prefix):
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=f'{prefix}/'):
+            for obj in page.get('Contents', []):
+                if not obj['Key'].endswith('.json'):
+                    continue
+                buf = io.BytesIO()
+                s3_client.download_fileobj(bucket, obj['Key'], buf)
+                try:
+                    self.merge_dict(json.loads(buf.getvalue()))
+                except (ValueError, KeyError) as e:
+                    print(f"Skipping breaker state {obj['Key']}: {e}")
+
+        print(f'Loaded {len(self.domains)} domain breakers from s3://{bucket}/{prefix}/')
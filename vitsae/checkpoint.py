@@ -0,0 +1,280 @@
+import io
+import os
+import json
+import time
+import struct
+import tarfile
+import threading
+
+import numpy as np
+
+def parse_prefix(prefix):
+    """
+    Split a {pq_id}-{start}-{end} batch prefix into its parts.
+    """
+    pq_id, start, end = prefix.rsplit('-', 2)
+    return pq_id, int(start), int(end)
+
+class RowBitmap:
+    """
+    One bit per row of a batch, set once the row is done, whether or not it
+    produced an image. num_parts is how many checkpoint parts hold the images
+    for the rows that are set.
+    """
+    HEADER = '<QQI'
+
+    def __init__(self, start, end, bits=None, num_parts=0):
+        self.start = start
+        self.end = end
+        self.bits = bits if bits is not None else np.zeros((end - start + 7) // 8, dtype=np.uint8)
+        self.num_parts = num_parts
+
+    def mark(self, index):
+        i = index - self.start
+        self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, index):
+        i = index - self.start
+        if i < 0 or index >= self.end:
+            return False
+        return bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    def count(self):
+        return int(np.unpackbits(self.bits).sum())
+
+    def to_bytes(self):
+        return struct.pack(self.HEADER, self.start, self.end, self.num_parts) + self.bits.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        header_size = struct.calcsize(cls.HEADER)
+        start, end, num_parts = struct.unpack(cls.HEADER, data[:header_size])
+        return cls(start, end, np.frombuffer(data[header_size:], dtype=np.uint8).copy(), num_parts)
+
+class CheckpointingSink:
+    """
+    Wraps a FileSink or ShardWriter so partially downloaded batches survive the
+    instance. Images written to the sink are also appended to a local part tar
+    per batch, and rows are marked in the batch's RowBitmap. Every interval
+    seconds the new part and then the bitmap are uploaded to
+    s3://{bucket}/{s3_prefix}/{batch prefix}/, so the bitmap only ever counts
+    rows whose images are already in S3.
+
+    A part whose upload fails is kept on disk and retried at the next
+    checkpoint, and the bitmap isn't uploaded until every part before it is.
+
+    restore(prefix) replays a batch's checkpointed images into the wrapped sink
+    and returns its bitmap, so process_parquet can skip the rows that are done.
+    The checkpoint outlives the seal, it is only deleted by uploaded(prefix)
+    once the batch's tar is in S3 and DynamoDB.
+    """
+    def __init__(self, sink, s3_client, bucket, s3_prefix, base_dir, interval=300):
+        self.sink = sink
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.s3_prefix = s3_prefix
+        self.base_dir = base_dir
+        self.interval = interval
+
+        self.bitmaps = {}
+        self.parts = {}
+        # closed parts waiting to be uploaded, in order
+        self.unsent = {}
+        self._part_seq = 0
+        self.dirty = set()
+        self._lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _key(self, prefix, name):
+        return f'{self.s3_prefix}/{prefix}/{name}'
+
+    def _bitmap(self, prefix):
+        if prefix not in self.bitmaps:
+            _, start, end = parse_prefix(prefix)
+            self.bitmaps[prefix] = RowBitmap(start, end)
+        return self.bitmaps[prefix]
+
+    def _part(self, prefix):
+        if prefix not in self.parts:
+            # numbered, an earlier part of the batch may still be on disk waiting to be sent
+            self._part_seq += 1
+            path = os.path.join(self.base_dir, f'{prefix}.checkpoint.{self._part_seq}.part')
+            self.parts[prefix] = (tarfile.open(path, 'w'), path, 0)
+        return self.parts[prefix]
+
+    def _add_member(self, tar, name, content):
+        info = tarfile.TarInfo(name=name)
+        info.size = len(content)
+        info.mtime = time.time()
+        tar.addfile(info, io.BytesIO(content))
+
+    def write(self, prefix, index, image_content, metadata):
+        self.sink.write(prefix, index, image_content, metadata)
+        with self._lock:
+            tar, path, count = self._part(prefix)
+            self._add_member(tar, f'{prefix}--{index}.jpg', image_content)
+            self._add_member(tar, f'{prefix}--{index}.json', json.dumps(metadata).encode('utf-8'))
+            self.parts[prefix] = (tar, path, count + 1)
+            self._bitmap(prefix).mark(index)
+            self.dirty.add(prefix)
+
+    def mark(self, prefix, index):
+        """
+        Record a row that finished without an image, so it isn't retried on resume.
+        """
+        with self._lock:
+            self._bitmap(prefix).mark(index)
+            self.dirty.add(prefix)
+
+    def done(self, prefix, index):
+        with self._lock:
+            return prefix in self.bitmaps and index in self.bitmaps[prefix]
+
+    def restore(self, prefix):
+        """
+        Load the checkpoint for prefix, if there is one, replaying its images
+        into the wrapped sink. Returns the RowBitmap or None.
+        """
+        with self._lock:
+            if prefix in self.bitmaps:
+                return self.bitmaps[prefix]
+
+        try:
+            buf = io.BytesIO()
+            self.s3_client.download_fileobj(self.bucket, self._key(prefix, 'bitmap'), buf)
+        except Exception:
+            return None  # nothing checkpointed for this batch
+        bitmap = RowBitmap.from_bytes(buf.getvalue())
+
+        # check every part is there before replaying any, a checkpoint with a missing part is started over
+        for n in range(bitmap.num_parts):
+            try:
+                self.s3_client.head_object(Bucket=self.bucket, Key=self._key(prefix, f'part-{n:05d}.tar'))
+            except Exception as e:
+                print(f'Ignoring checkpoint for {prefix}, part {n} is unavailable: {e}')
+                return None
+
+        # a part can hold thousands of images, so each is spooled to disk and replayed before the next
+        restored = 0
+        path = os.path.join(self.base_dir, f'{prefix}.checkpoint.restore')
+        try:
+            for n in range(bitmap.num_parts):
+                with open(path, 'w+b') as f:
+                    self.s3_client.download_fileobj(self.bucket, self._key(prefix, f'part-{n:05d}.tar'), f)
+                    f.seek(0)
+                    restored += self._replay(f)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+        with self._lock:
+            self.bitmaps[prefix] = bitmap
+        print(f'Restored {prefix} from checkpoint: {bitmap.count()} rows done, {restored} images.')
+        return bitmap
+
+    def _replay(self, fileobj):
+        # each image is followed by its metadata, so only one image is held at a time
+        images = {}
+        restored = 0
+        with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+            for member in tar:
+                name, ext = os.path.splitext(member.name)
+                prefix, index = name.split('--')
+                content = tar.extractfile(member).read()
+                if ext == '.jpg':
+                    images[(prefix, int(index))] = content
+                elif (prefix, int(index)) in images:
+                    self.sink.write(prefix, int(index), images.pop((prefix, int(index))), json.loads(content))
+                    restored += 1
+
+        for (prefix, index), content in images.items():
+            self.sink.write(prefix, index, content, {})
+        return restored + len(images)
+
+    def checkpoint(self):
+        """
+        Upload the new images and the bitmap of every batch that changed since the last checkpoint.
+        """
+        with self._checkpoint_lock:
+            with self._lock:
+                changes = []
+                for prefix in self.dirty:
+                    part = self.parts.pop(prefix, None)
+                    if part is not None:
+                        part[0].close()
+                        self.unsent.setdefault(prefix, []).append(part[1])
+                    # only rows whose images are in the parts closed so far
+                    bitmap = self.bitmaps[prefix]
+                    changes.append((prefix, list(self.unsent.get(prefix, ())), RowBitmap(bitmap.start, bitmap.end, bitmap.bits.copy())))
+                self.dirty.clear()
+
+            checkpointed = 0
+            for prefix, paths, snapshot in changes:
+                try:
+                    for path in paths:
+                        num_parts = self.bitmaps[prefix].num_parts
+                        self.s3_client.upload_file(path, self.bucket, self._key(prefix, f'part-{num_parts:05d}.tar'))
+                        # counted only once it is in S3, a failed part keeps its number and is sent again
+                        with self._lock:
+                            self.bitmaps[prefix].num_parts += 1
+                            self.unsent[prefix].remove(path)
+                        os.remove(path)
+                    snapshot.num_parts = self.bitmaps[prefix].num_parts
+                    self.s3_client.upload_fileobj(io.BytesIO(snapshot.to_bytes()), self.bucket, self._key(prefix, 'bitmap'))
+                    checkpointed += 1
+                except Exception as e:
+                    print(f'Failed to checkpoint {prefix}, retrying at the next checkpoint: {e}')
+                    with self._lock:
+                        self.dirty.add(prefix)
+            if changes:
+                print(f'Checkpointed {checkpointed} of {len(changes)} batches.')
+
+    def seal(self, prefix):
+        # the checkpoint is kept until the batch is uploaded, the next checkpoint sends the rest of it
+        self.sink.seal(prefix)
+
+    def uploaded(self, prefix):
+        """
+        Delete the checkpoint of prefix once its tar has been uploaded and recorded.
+        """
+        with self._checkpoint_lock:
+            with self._lock:
+                bitmap = self.bitmaps.pop(prefix, None)
+                part = self.parts.pop(prefix, None)
+                unsent = self.unsent.pop(prefix, [])
+                self.dirty.discard(prefix)
+            if part is not None:
+                part[0].close()
+                unsent.append(part[1])
+            for path in unsent:
+                if os.path.exists(path):
+                    os.remove(path)
+            if bitmap is not None:
+                self._delete(prefix)
+
+    def _delete(self, prefix):
+        try:
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=f'{self.s3_prefix}/{prefix}/'):
+                for obj in page.get('Contents', []):
+                    self.s3_client.delete_object(Bucket=self.bucket, Key=obj['Key'])
+        except Exception as e:
+            print(f'Failed to delete checkpoint for {prefix}: {e}')
+
+    def _keep_checkpointing(self):
+        while not self._stop.wait(self.interval):
+            self.checkpoint()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._keep_checkpointing, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join()
+
+    def close(self):
+        self.sink.close()
@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+import pytest
+
+from benchmark import make_jpeg, write_parquet, FakeS3, ImageServer
+
+@pytest.fixture
+def image_server():
+    server = ImageServer().start()
+
+    yield server.base_url, server
+
+    server.stop()
+
+class RangeFileHandler(BaseHTTPRequestHandler):
+    """
+    Serves files from server.directory with HEAD and single-range GET support,
+    recording every requested range in server.ranges.
+    """
+    def _path(self):
+        return os.path.join(self.server.directory, os.path.basename(urlparse(self.path).path))
+
+    def do_HEAD(self):
+        path = self._path()
+        if not os.path.exists(path):
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        path = self._path()
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        range_header = self.headers.get('Range')
+        if range_header is None:
+            self.server.ranges.append((0, len(data)))
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        start, end = range_header.replace('bytes=', '').split('-')
+        start, end = int(start), min(int(end) + 1, len(data))
+        self.server.ranges.append((start, end))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end - 1}/{len(data)}')
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        self.wfile.write(data[start:end])
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def file_server(tmp_path):
+    directory = tmp_path / 'served'
+    directory.mkdir()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeFileHandler)
+    server.daemon_threads = True
+    server.directory = str(directory)
+    server.ranges = []
+    server.delay = 0
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+
+    yield f'http://127.0.0.1:{server.server_address[1]}', directory, server
+
+    server.shutdown()
+    server.server_close()
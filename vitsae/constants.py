@@ -1,2 +1,18 @@
 COUNTER_PQ_ID = 'COUNTER'
-COUNTER_BATCH_ID = 'COUNTER'
\ No newline at end of file
+COUNTER_BATCH_ID = 'COUNTER'
+
+# LAION parquet columns carried through to the per-image json metadata
+METADATA_COLUMNS = [
+    'URL',
+    'hash',
+    'TEXT',
+    'WIDTH',
+    'HEIGHT',
+    'similarity',
+    'LANGUAGE',
+    'pwatermark',
+    'punsafe',
+    'ENG TEXT',
+    '__index_level_0__',
+    'prediction',
+]
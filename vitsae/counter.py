@@ -0,0 +1,72 @@
+import threading
+
+from constants import COUNTER_BATCH_ID, COUNTER_PQ_ID
+
+def get_upload_count(ddb_table):
+    try:
+        # Query the counter item using the 'upload_counter' and 'counter' identifiers
+        response = ddb_table.get_item(
+            Key={
+                'parquet_id': COUNTER_PQ_ID,
+                'batch_id': COUNTER_BATCH_ID
+            }
+        )
+        
+        # Extract the upload_count if it exists in the response
+        if 'Item' in response and 'upload_count' in response['Item']:
+            return response['Item']['upload_count']
+        else:
+            # If the item or upload_count attribute does not exist, return 0
+            return 0
+
+    except Exception as e:
+        print(f'Failed to get upload count: {e}')
+        return None
+
+
+class UploadCounter:
+    """
+    Local cache of the fleet-wide tar upload count kept in DynamoDB. A
+    background thread refreshes it every refresh_interval seconds, so reading
+    value never does any I/O, and increment() lets our own uploads show up
+    straight away rather than on the next refresh.
+    """
+    def __init__(self, ddb_table, refresh_interval=60):
+        self.ddb_table = ddb_table
+        self.refresh_interval = refresh_interval
+        self._value = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def value(self):
+        with self._lock:
+            return self._value
+
+    def increment(self, n=1):
+        with self._lock:
+            self._value += n
+
+    def refresh(self):
+        count = get_upload_count(self.ddb_table)
+        if count is None:
+            return  # keep the cached value if DynamoDB is unavailable
+
+        with self._lock:
+            # never go backwards if a local increment is ahead of the read
+            self._value = max(self._value, int(count))
+
+    def _keep_refreshing(self):
+        while not self._stop.wait(self.refresh_interval):
+            self.refresh()
+
+    def start(self):
+        self.refresh()
+        self._thread = threading.Thread(target=self._keep_refreshing, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join()
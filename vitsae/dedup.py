@@ -0,0 +1,251 @@
+import io
+import math
+import struct
+import hashlib
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+class BloomFilter:
+    """
+    A fixed size Bloom filter over bytes keys. Filters with the same num_bits
+    and num_hashes can be merged, which is how indexes from different nodes
+    are combined.
+    """
+    HEADER = '<QI'
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else np.zeros((num_bits + 7) // 8, dtype=np.uint8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        a, b = struct.unpack('<QQ', digest)
+        return [(a + i * b) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        """
+        Add key, returning False if it was (probably) already present.
+        """
+        added = False
+        for p in self._positions(key):
+            mask = 1 << (p & 7)
+            if not self.bits[p >> 3] & mask:
+                self.bits[p >> 3] |= mask
+                added = True
+        return added
+
+    def merge(self, other):
+        if (other.num_bits, other.num_hashes) != (self.num_bits, self.num_hashes):
+            raise ValueError(f'Cannot merge a {other.num_bits} bit filter into a {self.num_bits} bit filter')
+        np.bitwise_or(self.bits, other.bits, out=self.bits)
+
+    def to_bytes(self):
+        return struct.pack(self.HEADER, self.num_bits, self.num_hashes) + self.bits.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        header_size = struct.calcsize(cls.HEADER)
+        num_bits, num_hashes = struct.unpack(cls.HEADER, data[:header_size])
+        bits = np.frombuffer(data[header_size:], dtype=np.uint8).copy()
+        return cls(num_bits, num_hashes, bits)
+
+def content_digest(image_content):
+    return hashlib.blake2b(image_content, digest_size=16).digest()
+
+class DedupIndex:
+    """
+    Remembers which images have been seen, by the LAION hash column before a
+    row is downloaded and by a digest of its bytes once it has been. Keys are
+    spread over num_shards Bloom filters so each can be stored and merged as a
+    separate S3 object. A false positive means a unique image is skipped, at a
+    rate of error_rate.
+
+    Keys are staged under the batch prefix and row index they were seen at,
+    and only go into the filters once commit(prefix) is called after the
+    batch's tar has been uploaded. Until then a retry of the same row isn't a
+    duplicate of itself, and discard(prefix) forgets a batch that won't be
+    uploaded.
+
+    The fleet shares one copy of the shards under the S3 prefix. save() merges
+    the copy in S3 into this index before overwriting it, so two nodes saving
+    at once can lose each other's latest keys until their next save, but
+    never more than that.
+    """
+    def __init__(self, num_shards=16, capacity=100_000_000, error_rate=0.01):
+        self.num_shards = num_shards
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.shards = [BloomFilter.for_capacity(max(1, capacity // num_shards), error_rate) for _ in range(num_shards)]
+
+        # key to the (prefix, index) that staged it, and prefix to index to the keys it staged
+        self.staged = {}
+        self.pending = defaultdict(lambda: defaultdict(list))
+        self._lock = threading.Lock()
+
+    def _shard(self, key):
+        return self.shards[hashlib.blake2b(key, digest_size=4).digest()[0] % self.num_shards]
+
+    def _hash_key(self, row_hash):
+        return b'h:' + str(row_hash).encode('utf-8')
+
+    def _content_key(self, image_content):
+        return b'c:' + content_digest(image_content)
+
+    def _seen(self, key, prefix, index):
+        owner = self.staged.get(key)
+        if owner is not None and owner != (prefix, index):
+            return True
+        return key in self._shard(key)
+
+    def _stage(self, key, prefix, index):
+        if prefix is None:
+            self._shard(key).add(key)
+        elif key not in self.staged:
+            self.staged[key] = (prefix, index)
+            self.pending[prefix][index].append(key)
+
+    def seen_hash(self, row_hash, prefix=None, index=None):
+        key = self._hash_key(row_hash)
+        with self._lock:
+            return self._seen(key, prefix, index)
+
+    def add_hash(self, row_hash, prefix=None, index=None):
+        """
+        Stage row_hash for the row at index of prefix, or add it straight to
+        the filters without a prefix.
+        """
+        with self._lock:
+            self._stage(self._hash_key(row_hash), prefix, index)
+
+    def add_content(self, image_content, prefix=None, index=None):
+        """
+        Record image_content, returning False if identical bytes were already
+        seen, other than at this same row.
+        """
+        key = self._content_key(image_content)
+        with self._lock:
+            if self._seen(key, prefix, index):
+                return False
+            self._stage(key, prefix, index)
+            return True
+
+    def commit(self, prefix):
+        """
+        Add the keys staged for prefix to the filters, once its tar is uploaded.
+        """
+        with self._lock:
+            for keys in self.pending.pop(prefix, {}).values():
+                for key in keys:
+                    self.staged.pop(key, None)
+                    self._shard(key).add(key)
+
+    def discard(self, prefix, index=None):
+        """
+        Forget the keys staged for prefix, or for just the row at index of it.
+        """
+        with self._lock:
+            if prefix not in self.pending:
+                return
+            rows = self.pending[prefix]
+            for i in ([index] if index is not None else list(rows)):
+                for key in rows.pop(i, ()):
+                    self.staged.pop(key, None)
+            if not rows:
+                del self.pending[prefix]
+
+    def merge(self, other):
+        with self._lock:
+            for shard, other_shard in zip(self.shards, other.shards):
+                shard.merge(other_shard)
+
+    def _shard_key(self, prefix, i):
+        return f'{prefix}/shard-{i:04d}.bloom'
+
+    def _download_shard(self, s3_client, bucket, key):
+        buf = io.BytesIO()
+        try:
+            s3_client.download_fileobj(bucket, key, buf)
+        except Exception:
+            return None
+        try:
+            return BloomFilter.from_bytes(buf.getvalue())
+        except ValueError as e:
+            print(f"Skipping dedup shard {key}: {e}")
+            return None
+
+    def _merge_shard(self, i, bloom, key):
+        try:
+            with self._lock:
+                self.shards[i].merge(bloom)
+            return True
+        except ValueError as e:
+            print(f"Skipping dedup shard {key}: {e}")
+            return False
+
+    def _node_copies(self, s3_client, bucket, prefix):
+        """
+        (shard number, key) of the per-node copies older versions saved under {prefix}/{node_id}/.
+        """
+        copies = []
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=f'{prefix}/'):
+            for obj in page.get('Contents', []):
+                relative = obj['Key'][len(prefix) + 1:]
+                name = relative.split('/')[-1]
+                if '/' not in relative or not name.startswith('shard-') or not name.endswith('.bloom'):
+                    continue
+                i = int(name[len('shard-'):-len('.bloom')])
+                if i < self.num_shards:
+                    copies.append((i, obj['Key']))
+        return copies
+
+    def save(self, s3_client, bucket, prefix):
+        """
+        Merge the fleet's shards into this index and write them back, folding
+        in and deleting any per-node copies.
+        """
+        node_copies = self._node_copies(s3_client, bucket, prefix)
+        for i, key in node_copies:
+            bloom = self._download_shard(s3_client, bucket, key)
+            if bloom is not None:
+                self._merge_shard(i, bloom, key)
+
+        for i in range(self.num_shards):
+            key = self._shard_key(prefix, i)
+            bloom = self._download_shard(s3_client, bucket, key)
+            if bloom is not None:
+                self._merge_shard(i, bloom, key)
+            with self._lock:
+                data = self.shards[i].to_bytes()
+            s3_client.upload_fileobj(io.BytesIO(data), bucket, key)
+
+        for _, key in node_copies:
+            s3_client.delete_object(Bucket=bucket, Key=key)
+        print(f'Saved dedup index to s3://{bucket}/{prefix}/, folded in {len(node_copies)} node shards.')
+
+    def load(self, s3_client, bucket, prefix):
+        """
+        Merge the fleet's shards under prefix into this index.
+        """
+        # per-node copies are only left until the next save folds them in
+        shards = [(i, self._shard_key(prefix, i)) for i in range(self.num_shards)]
+        loaded = 0
+        for i, key in shards + self._node_copies(s3_client, bucket, prefix):
+            bloom = self._download_shard(s3_client, bucket, key)
+            if bloom is not None and self._merge_shard(i, bloom, key):
+                loaded += 1
+
+        print(f'Loaded {loaded} dedup shards from s3://{bucket}/{prefix}/')
+        return loaded
@@ -0,0 +1,145 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import defaultdict
+
+from metrics import REGISTRY
+
+DISK_WRITE_SECONDS = REGISTRY.histogram('vitsae_disk_write_seconds', 'Time to write one image to the sink.', buckets=[0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5])
+DISK_WAIT_SECONDS = REGISTRY.counter('vitsae_disk_wait_seconds_total', 'Time download workers spent waiting for the disk writer to catch up.')
+DISK_WRITE_QUEUE = REGISTRY.gauge('vitsae_disk_write_queue', 'Writes queued for the disk writer threads.')
+DISK_WRITE_FAILURES = REGISTRY.counter('vitsae_disk_write_failures_total', 'Images that could not be written to the sink.')
+
+class DiskWriter:
+    """
+    Moves sink writes off the event loop. Downloaded images are put on a queue
+    that num_threads writer threads drain up to batch_size items at a time, so
+    a slow disk only ever blocks those threads and never the sockets.
+
+    At most max_pending writes can be queued or in progress. Once the disk falls
+    that far behind write() waits for a slot, which holds the download worker
+    and so slows the downloads down to what the disk can take. seal(prefix) is
+    deferred until every write queued for that prefix has finished.
+
+    on_written(prefix, index, ok) is called on the event loop once each write
+    has finished, ok being False if the sink raised.
+    """
+    def __init__(self, sink, num_threads=4, max_pending=1000, batch_size=32, on_written=None):
+        self.sink = sink
+        self.on_written = on_written
+        self.num_threads = num_threads
+        self.batch_size = batch_size
+
+        self.jobs = queue.Queue()
+        self.slots = asyncio.Semaphore(max_pending)
+        self.loop = asyncio.get_running_loop()
+
+        self.stats = {'writes': 0, 'failed': 0, 'write_seconds': 0.0, 'wait_seconds': 0.0, 'max_write_seconds': 0.0}
+        self._lock = threading.Lock()
+        self._outstanding = defaultdict(int)
+        self._seal_requested = set()
+
+        self.threads = [threading.Thread(target=self._drain, daemon=True) for _ in range(num_threads)]
+        for t in self.threads:
+            t.start()
+
+    def qsize(self):
+        return self.jobs.qsize()
+
+    def update_gauges(self):
+        DISK_WRITE_QUEUE.set(self.qsize())
+
+    async def write(self, prefix, index, image_content, metadata):
+        wait_start = time.time()
+        await self.slots.acquire()
+        waited = time.time() - wait_start
+        self.stats['wait_seconds'] += waited
+        if waited > 0.001:
+            DISK_WAIT_SECONDS.inc(waited)
+
+        with self._lock:
+            self._outstanding[prefix] += 1
+        self.jobs.put(('write', prefix, (index, image_content, metadata)))
+
+    def seal(self, prefix):
+        self.jobs.put(('seal', prefix, None))
+
+    def _next_batch(self):
+        batch = [self.jobs.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self):
+        while True:
+            stops = 0
+            for kind, prefix, args in self._next_batch():
+                if kind == 'stop':
+                    stops += 1
+                elif kind == 'seal':
+                    self._request_seal(prefix)
+                else:
+                    self._write(prefix, *args)
+
+            if stops:
+                # leave a stop for each of the other threads
+                for _ in range(stops - 1):
+                    self.jobs.put(('stop', None, None))
+                return
+
+    def _write(self, prefix, index, image_content, metadata):
+        write_start = time.time()
+        failed = False
+        try:
+            self.sink.write(prefix, index, image_content, metadata)
+        except Exception as e:
+            print(f"Failed to write {prefix}--{index}: {e}")
+            failed = True
+            DISK_WRITE_FAILURES.inc()
+        elapsed = time.time() - write_start
+        DISK_WRITE_SECONDS.observe(elapsed)
+
+        with self._lock:
+            self.stats['writes'] += 1
+            self.stats['failed'] += failed
+            self.stats['write_seconds'] += elapsed
+            self.stats['max_write_seconds'] = max(self.stats['max_write_seconds'], elapsed)
+
+            self._outstanding[prefix] -= 1
+            ready = self._outstanding[prefix] == 0 and prefix in self._seal_requested
+            if self._outstanding[prefix] == 0:
+                del self._outstanding[prefix]
+            if ready:
+                self._seal_requested.discard(prefix)
+
+        self.loop.call_soon_threadsafe(self.slots.release)
+        if self.on_written is not None:
+            self.loop.call_soon_threadsafe(self.on_written, prefix, index, not failed)
+        if ready:
+            self._seal(prefix)
+
+    def _request_seal(self, prefix):
+        with self._lock:
+            if self._outstanding.get(prefix, 0) > 0:
+                self._seal_requested.add(prefix)
+                return
+        self._seal(prefix)
+
+    def _seal(self, prefix):
+        try:
+            self.sink.seal(prefix)
+        except Exception as e:
+            print(f"Failed to seal batch {prefix}: {e}")
+
+    def close(self):
+        """
+        Wait for every queued write and seal to finish. Blocks, so call it off the loop.
+        """
+        for _ in self.threads:
+            self.jobs.put(('stop', None, None))
+        for t in self.threads:
+            t.join()
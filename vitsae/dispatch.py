@@ -0,0 +1,150 @@
+import asyncio
+from collections import defaultdict, deque
+from urllib.parse import urlparse
+
+import aiohttp
+
+def get_domain(url):
+    try:
+        return urlparse(url).hostname or ''
+    except ValueError:
+        return ''
+
+def make_connector(limit, limit_per_host=8, ttl_dns_cache=300):
+    """
+    TCP connector sized for the download concurrency rather than aiohttp's default
+    100 connections, with resolved hosts cached for ttl_dns_cache seconds.
+    """
+    return aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        use_dns_cache=True,
+        ttl_dns_cache=ttl_dns_cache,
+    )
+
+class DomainDispatcher:
+    """
+    Sits between the parquet producer and the download workers in place of a
+    FIFO queue. Rows are queued per domain and handed out round-robin across
+    domains, and no domain gets more than per_domain_limit rows in flight, so
+    one slow host cannot take over the whole concurrency budget.
+
+    Only the first max_queued_per_domain rows of each domain count against
+    max_pending. Rows of a domain past that are held, up to max_held across
+    all domains, so a domain that is slow to drain can't fill the dispatcher
+    and the producer keeps reading ahead to the other domains.
+    """
+    def __init__(self, max_pending, per_domain_limit=8, max_queued_per_domain=None, max_held=0):
+        self.max_pending = max_pending
+        self.per_domain_limit = per_domain_limit
+        self.max_queued_per_domain = max_queued_per_domain if max_queued_per_domain is not None else max_pending
+        self.max_held = max_held
+
+        self.queues = defaultdict(deque)
+        self.in_flight = defaultdict(int)
+        self.domain_stats = defaultdict(lambda: {'scheduled': 0, 'succeeded': 0, 'failed': 0})
+
+        # domains with queued rows and spare in-flight budget, in round-robin order
+        self._ready = deque()
+        self._ready_set = set()
+        self._pending = 0
+        self._held = 0
+        self._closed = False
+
+        lock = asyncio.Lock()
+        self._can_get = asyncio.Condition(lock)
+        self._can_put = asyncio.Condition(lock)
+
+    def qsize(self):
+        return self._pending + self._held
+
+    def total_in_flight(self):
+        return sum(self.in_flight.values())
+
+    def _mark_ready(self, domain):
+        if domain not in self._ready_set and self.queues.get(domain) and self.in_flight.get(domain, 0) < self.per_domain_limit:
+            self._ready.append(domain)
+            self._ready_set.add(domain)
+
+    def _has_room(self, domain):
+        if len(self.queues.get(domain, ())) < self.max_queued_per_domain:
+            return self._pending < self.max_pending
+        return self._held < self.max_held
+
+    async def put(self, domain, item):
+        async with self._can_put:
+            await self._can_put.wait_for(lambda: self._has_room(domain))
+            if len(self.queues[domain]) < self.max_queued_per_domain:
+                self._pending += 1
+            else:
+                self._held += 1
+            self.queues[domain].append(item)
+            self._mark_ready(domain)
+            self._can_get.notify()
+
+    async def get(self):
+        """
+        Return (domain, item) for the next row to download, or None once the
+        dispatcher is closed and drained.
+        """
+        async with self._can_get:
+            await self._can_get.wait_for(lambda: self._ready or (self._closed and self.qsize() == 0))
+            if not self._ready:
+                self._can_get.notify()  # wake the next worker so it can exit too
+                return None
+
+            domain = self._ready.popleft()
+            self._ready_set.discard(domain)
+
+            # the next held row of the domain takes the place of the one handed out
+            if len(self.queues[domain]) > self.max_queued_per_domain:
+                self._held -= 1
+            else:
+                self._pending -= 1
+            item = self.queues[domain].popleft()
+            if not self.queues[domain]:
+                del self.queues[domain]
+            self.in_flight[domain] += 1
+            self.domain_stats[domain]['scheduled'] += 1
+            self._mark_ready(domain)
+
+            # the producer may be waiting on any domain, so it is always woken
+            self._can_put.notify_all()
+            if self._ready or (self._closed and self.qsize() == 0):
+                self._can_get.notify()
+
+            return domain, item
+
+    async def done(self, domain, succeeded):
+        async with self._can_get:
+            self.in_flight[domain] -= 1
+            if self.in_flight[domain] == 0:
+                del self.in_flight[domain]
+            self.domain_stats[domain]['succeeded' if succeeded else 'failed'] += 1
+            self._mark_ready(domain)
+            if self._ready:
+                self._can_get.notify()
+
+    async def clear(self):
+        """
+        Drop every queued row that hasn't been handed to a worker yet and
+        return them. Rows in flight are left alone.
+        """
+        async with self._can_get:
+            dropped = [item for queue in self.queues.values() for item in queue]
+            self.queues.clear()
+            self._ready.clear()
+            self._ready_set.clear()
+            self._pending = 0
+            self._held = 0
+            self._can_put.notify_all()
+            self._can_get.notify_all()
+            return dropped
+
+    async def close(self):
+        async with self._can_get:
+            self._closed = True
+            self._can_get.notify()
+
+    def busiest_domains(self, n=5):
+        return sorted(self.in_flight.items(), key=lambda x: x[1], reverse=True)[:n]
@@ -0,0 +1,67 @@
+import json
+import time
+import threading
+
+from metrics import REGISTRY
+
+DRAIN_SECONDS = REGISTRY.gauge('vitsae_drain_seconds', 'Seconds from the spot interruption notice to the end of each step of the drain.')
+
+DRAIN_STEPS = ['stopped', 'uploaded', 'requeued']
+
+def parse_message_body(body):
+    """
+    (url, row_ranges) of a parquet message. A plain url has no row ranges, a
+    parquet re-queued by a drain is json with the rows it has left.
+    """
+    try:
+        message = json.loads(body)
+    except ValueError:
+        return body, None
+    if not isinstance(message, dict):
+        return body, None
+    return message['url'], [tuple(r) for r in message['row_ranges']]
+
+def make_message_body(url, row_ranges):
+    return json.dumps({'url': url, 'row_ranges': [list(r) for r in row_ranges]})
+
+class Drain:
+    """
+    Salvages the parquet being processed when the spot instance gets its two
+    minute interruption notice. start() sets event, which process_parquet
+    watches: it stops scheduling rows, lets the downloads in flight finish and
+    seals the batches it didn't get through as partial shards. The parquet's
+    handler then waits for the uploader until timeout seconds after the
+    notice and sets remaining to the rows that still aren't in DynamoDB, and
+    the queued rows that were dropped, which run_message_loop re-queues in
+    place of the message before telling the InterruptionHandler it is drained.
+
+    The time each step finished at, from the notice, is kept in timings.
+    """
+    def __init__(self, timeout=90):
+        self.event = threading.Event()
+        self.timeout = timeout
+        self.started_at = None
+        self.timings = {}
+        self.remaining = None
+
+    def start(self):
+        print('Spot interruption notice, draining.')
+        self.started_at = time.time()
+        self.event.set()
+
+    def draining(self):
+        return self.event.is_set()
+
+    def time_left(self):
+        if self.started_at is None:
+            return self.timeout
+        return max(0.0, self.timeout - (time.time() - self.started_at))
+
+    def mark(self, step):
+        seconds = time.time() - self.started_at
+        self.timings[step] = seconds
+        DRAIN_SECONDS.set(seconds, step=step)
+
+    def report(self):
+        print('Drain: ' + ', '.join(f'{step} after {self.timings[step]:.1f} s' for step in DRAIN_STEPS if step in self.timings))
+        return dict(self.timings)
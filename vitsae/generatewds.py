@@ -1,6 +1,9 @@
 from boto3.dynamodb.conditions import Key
-from threading import Thread
-import json
+from collections import defaultdict
+from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import queue
 import boto3
 import requests
 import os
@@ -11,8 +14,37 @@ import pyarrow.parquet as pq
 
 from utils import load_config
 from uploadwds import TarMaker
+from shards import FileSink, ShardWriter
+from counter import UploadCounter
+from dispatch import DomainDispatcher, get_domain, make_connector
+from aimd import AIMDController, ConcurrencyLimiter
+from diskwriter import DiskWriter
+from imageproc import ImageProcessor
+from dedup import DedupIndex
+from breaker import DomainBreakers
+from guard import ResponseGuard
+from checkpoint import CheckpointingSink, parse_prefix
+from batching import BatchPlanner, BYTES_PER_PIXEL, leftover_batches, remaining_row_ranges
+from hedge import HedgePolicy
+from rangeparquet import RangeStreamedParquet, parquet_id_from_url
 from interruption import InterruptionHandler
-from constants import COUNTER_BATCH_ID, COUNTER_PQ_ID
+from drain import Drain, parse_message_body, make_message_body
+from visibility import VisibilityExtender
+from constants import METADATA_COLUMNS
+from metrics import REGISTRY, start_metrics_server, MetricsDumper
+
+IMAGE_REQUEST_SECONDS = REGISTRY.histogram('vitsae_image_request_seconds', 'Time from sending an image request to having read its body.')
+IMAGE_BYTES = REGISTRY.counter('vitsae_image_bytes_total', 'Bytes of image bodies downloaded.')
+IMAGE_RESPONSES = REGISTRY.counter('vitsae_image_responses_total', 'Image responses by http status.')
+IMAGE_EXCEPTIONS = REGISTRY.counter('vitsae_image_exceptions_total', 'Image requests that raised, by exception type.')
+IMAGE_OUTCOMES = REGISTRY.counter('vitsae_images_total', 'Rows that were scheduled or skipped, by outcome.')
+IN_FLIGHT = REGISTRY.gauge('vitsae_images_in_flight', 'Image requests in progress.')
+CONCURRENCY_LIMIT = REGISTRY.gauge('vitsae_concurrency_limit', 'Current limit on image requests in flight.')
+DISPATCH_QUEUE_DEPTH = REGISTRY.gauge('vitsae_dispatch_queue_depth', 'Rows read from the parquet and waiting for a download worker.')
+DOMAIN_SUCCESS_RATIO = REGISTRY.gauge('vitsae_domain_success_ratio', 'Share of completed requests that succeeded, for the busiest domains.')
+MESSAGES = REGISTRY.counter('vitsae_sqs_messages_total', 'Parquet messages by what happened to them.')
+PARQUET_FETCH_SECONDS = REGISTRY.histogram('vitsae_parquet_fetch_seconds', 'Time to download or open a parquet.')
+PARQUET_PROCESS_SECONDS = REGISTRY.histogram('vitsae_parquet_process_seconds', 'Time to process every row of a parquet.', buckets=[60, 300, 600, 1200, 1800, 3600, 7200, 14400])
 
 def initialize_boto3_clients(config):
     """
@@ -73,7 +105,7 @@ def download_parquet(base_dir, url, hf_token):
         response.raise_for_status()
 
         # Generate the file name from the URL and save to the specified directory
-        pq_id = os.path.basename(url).split('part-')[1].split('-')[0]
+        pq_id = parquet_id_from_url(url)
         final_file_path = os.path.join(base_dir, f'{pq_id}.parquet')
         temp_file_path = final_file_path + temp_suffix
 
@@ -94,6 +126,35 @@ def download_parquet(base_dir, url, hf_token):
             os.remove(temp_file_path)
         return None
 
+def close_parquet(pq_id, pq_path, *args):
+    """
+    Stop streaming pq_path if it is a RangeStreamedParquet.
+    """
+    if isinstance(pq_path, RangeStreamedParquet):
+        pq_path.close()
+
+def remove_parquet(pq_id, pq_path, *args):
+    """
+    Close a streamed parquet or delete a downloaded one, once it is no longer needed.
+    """
+    close_parquet(pq_id, pq_path)
+    if isinstance(pq_path, str) and os.path.exists(pq_path):
+        os.remove(pq_path)
+
+def stream_parquet(url, hf_token, lookahead=2):
+    """
+    Open the parquet at url as a RangeStreamedParquet, which can be passed to
+    process_parquet as pq_path. Only the footer has been downloaded when this returns.
+    """
+    headers = {
+        'Authorization': f'Bearer {hf_token}'
+    }
+    try:
+        return parquet_id_from_url(url), RangeStreamedParquet(url, headers=headers, lookahead=lookahead)
+    except Exception as e:
+        print(f"Error opening parquet stream from {url}: {e}")
+        return None
+
 def iterate_parquet_rows(file_path, chunk_size=30000):
     try:
         pf = pq.ParquetFile(file_path)
@@ -118,27 +179,83 @@ def iterate_parquet_rows(file_path, chunk_size=30000):
         print(f"Error reading parquet file in chunks from {file_path}: {e}")
         return
 
-def get_upload_count(ddb_table):
+def iterate_parquet_records(file_path, chunk_size=30000, columns=METADATA_COLUMNS, row_ranges=None):
+    """
+    Yield (start_index, records) for each record batch in the parquet, where records
+    is a list of plain dicts built column-wise from the Arrow batch. This avoids
+    materializing a pandas DataFrame and a Series per row when scheduling downloads.
+
+    If row_ranges is a list of (start, end) pairs only rows inside those ranges
+    are yielded, and row groups that don't overlap any range are never read.
+    """
     try:
-        # Query the counter item using the 'upload_counter' and 'counter' identifiers
-        response = ddb_table.get_item(
-            Key={
-                'parquet_id': COUNTER_PQ_ID,
-                'batch_id': COUNTER_BATCH_ID
-            }
-        )
-        
-        # Extract the upload_count if it exists in the response
-        if 'Item' in response and 'upload_count' in response['Item']:
-            return response['Item']['upload_count']
-        else:
-            # If the item or upload_count attribute does not exist, return 0
-            return 0
+        pf = pq.ParquetFile(file_path)
+        available = [c for c in columns if c in pf.schema_arrow.names]
+        missing = [c for c in columns if c not in available]
+        keys = available + missing
+
+        row_groups = []
+        group_start = 0
+        for i in range(pf.metadata.num_row_groups):
+            group_end = group_start + pf.metadata.row_group(i).num_rows
+            if row_ranges is None or any(s < group_end and e > group_start for s, e in row_ranges):
+                row_groups.append((i, group_start))
+            group_start = group_end
+
+        for i, group_start in row_groups:
+            batch_offset = group_start
+            for batch in pf.iter_batches(batch_size=chunk_size, columns=available, row_groups=[i]):
+                if batch.num_rows == 0:
+                    break
+
+                batch_end = batch_offset + batch.num_rows
+                if row_ranges is None:
+                    slices = [(batch_offset, batch_end)]
+                else:
+                    slices = [(max(s, batch_offset), min(e, batch_end)) for s, e in sorted(row_ranges) if s < batch_end and e > batch_offset]
+
+                for slice_start, slice_end in slices:
+                    part = batch.slice(slice_start - batch_offset, slice_end - slice_start)
+                    values = [part.column(c).to_pylist() for c in available]
+                    values += [[None] * part.num_rows for _ in missing]
+                    records = [dict(zip(keys, row)) for row in zip(*values)]
+
+                    yield slice_start, records
+
+                batch_offset = batch_end
 
     except Exception as e:
-        print(f'Failed to get upload count: {e}')
-        return None
+        print(f"Error reading parquet file in chunks from {file_path}: {e}")
+        return
 
+def batch_row_ranges(num_rows, batch_size):
+    """
+    Split num_rows into the (start, end) row ranges behind the {pq_id}-{start}-{end}
+    batch prefixes. The last range keeps the nominal end so prefixes stay stable.
+    """
+    return [(start, start + batch_size) for start in range(0, num_rows, batch_size)]
+
+def plan_row_ranges(pq_path, pq_id, max_rows, min_rows=1, target_bytes=None, bytes_per_pixel=BYTES_PER_PIXEL, max_side=None, already_processed=()):
+    """
+    The (start, end) row ranges of the batches of the parquet that haven't been
+    processed yet, cut the same way process_parquet cuts them. The WIDTH and
+    HEIGHT columns of the whole parquet are read up front, before anything is
+    downloaded.
+    """
+    planner = BatchPlanner(pq_id, max_rows, min_rows, target_bytes, bytes_per_pixel, max_side, already_processed)
+    ranges = []
+
+    def collect(events):
+        for event in events:
+            if event[0] == 'start':
+                _, start, end = parse_prefix(event[1])
+                ranges.append((start, end))
+
+    for batch_start, records in iterate_parquet_records(pq_path, columns=['WIDTH', 'HEIGHT']):
+        for index, row in enumerate(records, batch_start):
+            collect(planner.add(index, row))
+    collect(planner.finish())
+    return ranges
 
 def process_parquet(
         ddb_table,
@@ -149,93 +266,622 @@ def process_parquet(
         max_images_per_tar=30000, 
         concurrency=500,
         total_images_required=50_000_000,
-        min_images_per_tar=15000
+        min_images_per_tar=15000,
+        report_interval=10,
+        sink=None,
+        limit_per_host=8,
+        ttl_dns_cache=300,
+        row_ranges=None,
+        stop_event=None,
+        progress_callback=None,
+        request_timeout=10,
+        concurrency_controller=None,
+        upload_counter=None,
+        write_threads=4,
+        max_pending_writes=1000,
+        image_processes=0,
+        max_image_side=None,
+        jpeg_quality=90,
+        processor=None,
+        dedup=None,
+        breakers=None,
+        max_image_bytes=10 * 1024 * 1024,
+        check_content_type=True,
+        checkpoints=None,
+        hedge=None,
+        target_tar_bytes=None,
+        bytes_per_pixel=BYTES_PER_PIXEL,
+        drain_event=None,
+        on_partial=None,
+        remaining_rows=None
     ):
-    loop = asyncio.get_event_loop()
+    if sink is None:
+        sink = FileSink(base_dir)
+    if checkpoints is not None:
+        sink = checkpoints  # wraps the real sink, checkpointing what is written to it
 
-    async def download_image(session, base_dir, prefix, index, row):
-        image_url = row.get('URL')
-        if not image_url:
-            print(f"No URL found in row {index}. Skipping.")
-            return False  # Indicate that this image was not processed
+    guard = ResponseGuard(max_bytes=max_image_bytes, check_content_type=check_content_type)
 
-        try:
-            async with session.get(image_url, timeout=10) as response:
-                if response.status == 200:
-                    image_content = await response.read()
-                    metadata = {
-                        "URL": image_url,
-                        "hash": row.get('hash'),
-                        "TEXT": row.get('TEXT'),
-                        "WIDTH": row.get('WIDTH'),
-                        "HEIGHT": row.get('HEIGHT'),
-                        "similarity": row.get('similarity'),
-                        "LANGUAGE": row.get('LANGUAGE'),
-                        "pwatermark": row.get('pwatermark'),
-                        "punsafe": row.get('punsafe'),
-                        "ENG TEXT": row.get('ENG TEXT'),
-                        "__index_level_0__": row.get('__index_level_0__'),
-                        "prediction": row.get('prediction')
-                    }
-
-                    image_filename = os.path.join(base_dir, f"{prefix}--{index}.jpg")
-                    with open(image_filename, 'wb') as f:
-                        f.write(image_content)
-                    with open(image_filename.replace('.jpg', '.json'), 'w') as f:
-                        json.dump(metadata, f)
-                    
-                    return True  # Indicate that the image was successfully processed
-        except Exception as e:
-            return False
-            pass
-            # print(f"Exception while downloading {image_url}: {e}")
-        
-        return False  # Indicate that the image was not processed
+    async def download_image(session, writer, processor, stats, domain, prefix, index, row):
+        # the bytes queued for the disk, 0 if the row has no image
+        image_url = row['URL']
+
+        # the domain may have tripped while this row was waiting in the dispatcher
+        if breakers is not None and not breakers.allow(domain):
+            stats['breaker_skipped'] += 1
+            IMAGE_OUTCOMES.inc(outcome='breaker_skipped')
+            return 0
+
+        async def attempt():
+            # (responded, fetched, image_content, timed_out), never raises so a hedge can race it
+            try:
+                async with session.get(image_url, timeout=aiohttp.ClientTimeout(total=request_timeout)) as response:
+                    IMAGE_RESPONSES.inc(status=response.status)
+                    if response.status != 200:
+                        return True, False, None, False
+                    # None if the body is too big or isn't an image
+                    image_content = await guard.read(response)
+                    if image_content is None:
+                        IMAGE_OUTCOMES.inc(outcome='rejected')
+                    return True, True, image_content, False
+            except asyncio.TimeoutError:
+                IMAGE_EXCEPTIONS.inc(exception='TimeoutError')
+                return False, False, None, True
+            except Exception as e:
+                IMAGE_EXCEPTIONS.inc(exception=type(e).__name__)
+                # print(f"Exception while downloading {image_url}: {e}")
+                return False, False, None, False
+
+        queued = 0
+        request_start = time.time()
+        if hedge is not None:
+            # a second request for stragglers, whichever brings back an image first wins
+            responded, fetched, image_content, timed_out = await hedge.run(attempt, lambda result: result[2] is not None)
+        else:
+            responded, fetched, image_content, timed_out = await attempt()
+        request_seconds = time.time() - request_start
+        stats['network_seconds'] += request_seconds
+        IMAGE_REQUEST_SECONDS.observe(request_seconds)
+        if image_content is not None:
+            IMAGE_BYTES.inc(len(image_content))
+        if breakers is not None:
+            breakers.record(domain, responded)
+
+        if image_content is not None and dedup is not None:
+            # staged under the row, they only count once the batch's tar is uploaded
+            if row.get('hash') is not None:
+                dedup.add_hash(row['hash'], prefix, index)
+            if not dedup.add_content(image_content, prefix, index):
+                stats['duplicates'] += 1
+                IMAGE_OUTCOMES.inc(outcome='duplicate')
+                image_content = None
+
+        if image_content is not None and processor is not None:
+            image_content = await processor.process(image_content)
+            if image_content is None:
+                stats['invalid'] += 1
+                IMAGE_OUTCOMES.inc(outcome='invalid')
+
+        if image_content is not None:
+            metadata = {k: row.get(k) for k in METADATA_COLUMNS}
+            # waits here if the disk has fallen max_pending_writes behind, it is counted once it is written
+            await writer.write(prefix, index, image_content, metadata)
+            queued = len(image_content)
+        elif not fetched:
+            IMAGE_OUTCOMES.inc(outcome='failed')
+
+        if concurrency_controller is not None:
+            # rejected, duplicate and undecodable images are not the host's fault
+            concurrency_controller.record(fetched, timed_out)
+
+        return queued
 
     async def process_images(base_dir, pq_path, pq_id, batch_size, already_processed):
-        start_idx = 0
-        next_idx = start_idx + batch_size
-        prefix = f"{pq_id}-{start_idx}-{next_idx}"
-        
-        async with aiohttp.ClientSession() as session:
-            start = time.time()
-            tasks = set()
-            for df in iterate_parquet_rows(pq_path):
-                total_tar_files_uploaded = get_upload_count(ddb_table)
-                if total_tar_files_uploaded * min_images_per_tar >= total_images_required:
-                    print(f"Uploaded at least {total_tar_files_uploaded * min_images_per_tar}. Job is complete.")
-                    break
-                for index, row in df.iterrows():
-                    if index >= next_idx:
-                        start_idx = next_idx
-                        next_idx = start_idx + batch_size
-                        prefix = f"{pq_id}-{start_idx}-{next_idx}"
+        # with a controller there is a worker for the maximum concurrency and the limiter decides how many run
+        if concurrency_controller is not None:
+            limiter = ConcurrencyLimiter(concurrency_controller.limit)
+            num_workers = concurrency_controller.maximum
+        else:
+            limiter = ConcurrencyLimiter(concurrency)
+            num_workers = concurrency
+
+        # rows are buffered per domain so the dispatcher has enough hosts to interleave, and a domain
+        # that can only have limit_per_host rows in flight is held to a few times that before the rest are held back
+        dispatcher = DomainDispatcher(
+            max_pending=num_workers * 4,
+            per_domain_limit=limit_per_host,
+            max_queued_per_domain=limit_per_host * 4,
+            max_held=num_workers * 16
+        )
+        stats = {'in_flight': 0, 'completed': 0, 'succeeded': 0, 'write_failed': 0, 'invalid': 0, 'duplicates': 0, 'breaker_skipped': 0, 'resumed': 0, 'dropped': 0, 'partial': 0, 'network_seconds': 0.0, 'rejected': guard.rejections}
+
+        def written(prefix, index, ok):
+            # a row whose write failed isn't marked in the checkpoint, so it is downloaded again on resume
+            if ok:
+                stats['succeeded'] += 1
+                IMAGE_OUTCOMES.inc(outcome='succeeded')
+            else:
+                stats['write_failed'] += 1
+                IMAGE_OUTCOMES.inc(outcome='write_failed')
+                if dedup is not None:
+                    dedup.discard(prefix, index)
+
+        writer = DiskWriter(sink, num_threads=write_threads, max_pending=max_pending_writes, on_written=written)
+        # images are checked and shrunk as they arrive, rather than when the tar is made, in the
+        # caller's pool if it passed one so the worker processes aren't spawned again for every parquet
+        own_processor = processor is None and image_processes
+        image_processor = ImageProcessor(image_processes, max_side=max_image_side, quality=jpeg_quality) if own_processor else processor
+
+        # a batch is complete once the producer has moved past it and all of its rows are done
+        pending = defaultdict(int)
+        closed = set()
+
+        # rows a drain left over are batched on their own, so none of them falls in a partial shard's range
+        planned_ranges = row_ranges
+        if planned_ranges is None and remaining_rows is not None:
+            planned_ranges = leftover_batches(remaining_rows, batch_size)
+
+        # the batches behind the prefixes, cut by row count or by estimated bytes, the estimate
+        # is logged against the image bytes of every batch that completes in full
+        planner = BatchPlanner(
+            pq_id,
+            batch_size,
+            min_rows=min_images_per_tar,
+            target_bytes=target_tar_bytes,
+            bytes_per_pixel=bytes_per_pixel,
+            max_side=max_image_side,
+            already_processed=already_processed,
+            row_ranges=planned_ranges
+        )
+        batch_bytes = defaultdict(int)
+        resumed = set()
+
+        # on a drain, batches the producer hadn't finished or that lost queued rows are sealed
+        # as partial shards from the first row that was done up to the first row that wasn't
+        done_rows = {}
+        partial = set()
+        dropped = defaultdict(list)
+
+        def row_done(prefix, index):
+            first, last = done_rows.get(prefix, (index, index))
+            done_rows[prefix] = (min(first, index), max(last, index))
+
+        def close_batch(prefix):
+            if prefix not in pending:
+                return
+            closed.add(prefix)
+            if pending[prefix] == 0:
+                complete_batch(prefix)
+
+        def complete_batch(prefix):
+            pending.pop(prefix, None)
+            closed.discard(prefix)
+            rows = done_rows.pop(prefix, None)
+            nbytes = batch_bytes.pop(prefix, 0)
+            if prefix in partial or prefix in resumed:
+                planner.forget(prefix)
+            else:
+                planner.observe(prefix, nbytes)
+            resumed.discard(prefix)
+            if prefix in partial:
+                if rows is None or on_partial is None:
+                    print(f"Not sealing partial batch {prefix}.")
+                    return
+                # a dropped row inside the range would be recorded as processed and never re-queued
+                end = min([rows[1] + 1] + [index for index in dropped.pop(prefix, []) if index > rows[0]])
+                partial_prefix = f"{pq_id}-{rows[0]}-{end}"
+                print(f"Sealing partial batch {prefix} as {partial_prefix}.")
+                stats['partial'] += 1
+                on_partial(prefix, partial_prefix)
+            # sealed by the writer once the batch's queued writes are on disk
+            writer.seal(prefix)
+
+        def draining():
+            return drain_event is not None and drain_event.is_set()
+
+        async def produce():
+            checkpointed = None
+
+            async def schedule(prefix, index, row):
+                # rows checkpointed by a worker that was interrupted part way through the batch
+                if checkpointed is not None and index in checkpointed:
+                    stats['resumed'] += 1
+                    resumed.add(prefix)
+                    row_done(prefix, index)
+                    return
+
+                # the same image often appears under several urls across the parquets
+                if dedup is not None and row.get('hash') is not None and dedup.seen_hash(row['hash'], prefix, index):
+                    stats['duplicates'] += 1
+                    IMAGE_OUTCOMES.inc(outcome='duplicate')
+                    if checkpoints is not None:
+                        checkpoints.mark(prefix, index)
+                    row_done(prefix, index)
+                    return
 
-                    if prefix in already_processed:
+                # never dispatched, they would all share the '' domain and its in-flight limit
+                if not row.get('URL'):
+                    print(f"No URL found in row {index}. Skipping.")
+                    stats['completed'] += 1
+                    if checkpoints is not None:
+                        checkpoints.mark(prefix, index)
+                    row_done(prefix, index)
+                    return
+
+                domain = get_domain(row['URL'])
+                if breakers is not None and breakers.is_open(domain):
+                    stats['breaker_skipped'] += 1
+                    IMAGE_OUTCOMES.inc(outcome='breaker_skipped')
+                    if checkpoints is not None:
+                        checkpoints.mark(prefix, index)
+                    row_done(prefix, index)
+                    return
+
+                # blocks once the dispatcher is full, so at most num_workers * 4 rows wait ahead of the workers,
+                # plus the rows held back for domains that are slow to drain
+                pending[prefix] += 1
+                await dispatcher.put(domain, (prefix, index, row))
+
+            async def handle(events):
+                nonlocal checkpointed
+                for event in events:
+                    kind, prefix = event[0], event[1]
+                    if kind == 'skip':
                         print('Skipping already processed batch:', prefix)
-                        continue
-
-                    # discard completed tasks to avoid memory leak
-                    if len(tasks) >= concurrency:
-                        while len(tasks) >= concurrency // 2:
-                            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-                            for completed_task in done:
-                                try:
-                                    _ = completed_task.result()
-                                except Exception as e:
-                                    print(f"Task resulted in an exception: {e}")
-                            tasks = set(pending)
-                            time.sleep(0.5)
-                        print(f"Completed {concurrency // 2} images in {time.time() - start:.2f} seconds.")
-                        start = time.time()
-
-
-                    tasks.add(asyncio.create_task(download_image(session, base_dir, prefix, index, row)))
-                    
-            if tasks:
-                await asyncio.gather(*tasks)
-
-    loop.run_until_complete(process_images(base_dir, pq_path, pq_id, max_images_per_tar, already_processed))
+                    elif kind == 'start':
+                        pending[prefix] += 0  # so the batch is still sealed if every row is skipped
+                        if remaining_rows is not None and on_partial is not None:
+                            # left over by a drain, it is uploaded however few of its rows it got
+                            on_partial(prefix, prefix, 0)
+                        if checkpoints is not None:
+                            checkpointed = await asyncio.to_thread(checkpoints.restore, prefix)
+                    elif kind == 'close':
+                        close_batch(prefix)
+                    else:
+                        await schedule(prefix, event[2], event[3])
+
+            stopped = False
+            # record batches are read off the loop, so a parquet that is still streaming in never stalls downloads
+            # rows left over by a drained run are the only ones read
+            records_iter = iterate_parquet_records(pq_path, row_ranges=planned_ranges)
+            while True:
+                next_batch = await asyncio.to_thread(next, records_iter, None)
+                if next_batch is None:
+                    break
+                batch_start, records = next_batch
+
+                if draining():
+                    stopped = True
+                    break
+                if stop_event is not None and stop_event.is_set():
+                    print("Stop requested, no longer scheduling downloads.")
+                    stopped = True
+                    break
+                if upload_counter is not None:
+                    total_tar_files_uploaded = upload_counter.value
+                    if total_tar_files_uploaded * min_images_per_tar >= total_images_required:
+                        print(f"Uploaded at least {total_tar_files_uploaded * min_images_per_tar}. Job is complete.")
+                        stopped = True
+                        break
+                for index, row in enumerate(records, batch_start):
+                    # checked per row, a drain has to fit in the two minute spot notice
+                    if draining():
+                        stopped = True
+                        break
+                    await handle(planner.add(index, row))
+                if stopped:
+                    break
+
+            if draining():
+                await drain()
+
+            # rows held back for a batch that was never cut aren't scheduled after a stop
+            await handle(planner.finish(flush=not stopped))
+
+        async def drain():
+            print("Draining, no longer scheduling downloads.")
+            partial.update(prefix for prefix in pending if prefix not in closed)
+            # rows still waiting for a worker are given up on, only downloads in flight are finished
+            for prefix, index, row in await dispatcher.clear():
+                stats['dropped'] += 1
+                dropped[prefix].append(index)
+                pending[prefix] -= 1
+                partial.add(prefix)
+            for prefix in list(closed):
+                if pending[prefix] == 0:
+                    complete_batch(prefix)
+
+        async def consume(session):
+            while True:
+                await limiter.acquire()
+                item = await dispatcher.get()
+                if item is None:
+                    await limiter.release()
+                    break
+
+                domain, (prefix, index, row) = item
+                stats['in_flight'] += 1
+                queued = 0
+                try:
+                    queued = await download_image(session, writer, image_processor, stats, domain, prefix, index, row)
+                    batch_bytes[prefix] += queued
+                except Exception as e:
+                    print(f"Task resulted in an exception: {e}")
+                finally:
+                    stats['in_flight'] -= 1
+                    stats['completed'] += 1
+                    # rows with an image are marked by the checkpoint once they are written
+                    if checkpoints is not None and not queued:
+                        checkpoints.mark(prefix, index)
+                    row_done(prefix, index)
+                    pending[prefix] -= 1
+                    if pending[prefix] == 0 and prefix in closed:
+                        complete_batch(prefix)
+                    await dispatcher.done(domain, queued > 0)
+                    await limiter.release()
+
+        async def control():
+            while True:
+                await asyncio.sleep(concurrency_controller.interval)
+                await limiter.set_limit(concurrency_controller.update())
+
+        def update_gauges():
+            IN_FLIGHT.set(stats['in_flight'])
+            CONCURRENCY_LIMIT.set(limiter.limit)
+            DISPATCH_QUEUE_DEPTH.set(dispatcher.qsize())
+            writer.update_gauges()
+
+            # only the busiest domains, a label per domain in the parquet would be millions of series
+            busiest = sorted(dispatcher.domain_stats.items(), key=lambda x: x[1]['scheduled'], reverse=True)[:20]
+            DOMAIN_SUCCESS_RATIO.clear()
+            for domain, counts in busiest:
+                done = counts['succeeded'] + counts['failed']
+                if done:
+                    DOMAIN_SUCCESS_RATIO.set(counts['succeeded'] / done, domain=domain)
+
+        async def report():
+            last_completed = 0
+            last_network_seconds = 0.0
+            last_writes = dict(writer.stats)
+            last_time = time.time()
+            while True:
+                await asyncio.sleep(report_interval)
+                now = time.time()
+                rate = (stats['completed'] - last_completed) / (now - last_time)
+                network_ms = 1000 * (stats['network_seconds'] - last_network_seconds) / max(1, stats['completed'] - last_completed)
+                writes = dict(writer.stats)
+                write_ms = 1000 * (writes['write_seconds'] - last_writes['write_seconds']) / max(1, writes['writes'] - last_writes['writes'])
+                print(f"In flight: {stats['in_flight']}/{limiter.limit}, queue depth: {dispatcher.qsize()}, completions per second: {rate:.1f}, succeeded: {stats['succeeded']}/{stats['completed']}, invalid images: {stats['invalid']}, duplicates: {stats['duplicates']}, skipped on dead domains: {stats['breaker_skipped']}")
+                print(f"Network latency: {network_ms:.1f} ms, disk write latency: {write_ms:.2f} ms, write queue: {writer.qsize()}, waited on disk: {writes['wait_seconds'] - last_writes['wait_seconds']:.1f} s")
+                print(f"Rejected responses: {dict(guard.rejections)}")
+                if hedge is not None:
+                    print(f"Hedged requests: {hedge.stats['hedged']}/{hedge.stats['requests']}, hedges that won: {hedge.stats['hedge_won']}, hedging after {hedge.delay() or 0:.2f} s")
+                print(f"Busiest domains: {dispatcher.busiest_domains()}")
+                update_gauges()
+                if progress_callback is not None:
+                    progress_callback(dict(stats, writes=writes))
+                last_completed = stats['completed']
+                last_network_seconds = stats['network_seconds']
+                last_writes = writes
+                last_time = now
+
+        connector = make_connector(num_workers, limit_per_host=limit_per_host, ttl_dns_cache=ttl_dns_cache)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            workers = [asyncio.create_task(consume(session)) for _ in range(num_workers)]
+            reporter = asyncio.create_task(report())
+            controller = asyncio.create_task(control()) if concurrency_controller is not None else None
+            try:
+                await produce()
+                await dispatcher.close()
+                await asyncio.gather(*workers)
+            finally:
+                reporter.cancel()
+                if controller is not None:
+                    controller.cancel()
+                for w in workers:
+                    w.cancel()
+                await asyncio.to_thread(writer.close)
+                if own_processor:
+                    # waits for the pool's processes to exit, so it is kept off the loop
+                    await asyncio.to_thread(image_processor.close)
+
+        update_gauges()
+        stats['domains'] = dict(dispatcher.domain_stats)
+        stats['writes'] = dict(writer.stats)
+        stats['rejected'] = dict(guard.rejections)
+        if hedge is not None:
+            stats['hedges'] = dict(hedge.stats)
+        if progress_callback is not None:
+            progress_callback(dict(stats))
+        return stats
+
+    # the upload count is read from a background-refreshed cache, never from the event loop
+    own_counter = upload_counter is None and ddb_table is not None
+    if own_counter:
+        upload_counter = UploadCounter(ddb_table)
+        upload_counter.start()
+
+    try:
+        return asyncio.run(process_images(base_dir, pq_path, pq_id, max_images_per_tar, already_processed))
+    finally:
+        if own_counter:
+            upload_counter.stop()
+
+def _sharded_worker(worker_id, events, stop_event, drain_event, base_dir, write_shards, process_kwargs):
+    """
+    Runs process_parquet over one worker's share of the batches in its own process
+    and event loop, forwarding sealed batches and progress to the parent through events.
+    """
+    if write_shards:
+        sink = ShardWriter(
+            base_dir,
+            on_seal=lambda prefix, tar_filename, file_count: events.put(('tar', prefix, tar_filename, file_count)),
+            validate=not process_kwargs.get('image_processes')
+        )
+    else:
+        sink = FileSink(
+            base_dir,
+            on_seal=lambda prefix: events.put(('batch', prefix)),
+            on_write=lambda prefix, paths, size: events.put(('files', prefix, paths, size))
+        )
+
+    process_parquet(
+        ddb_table=None,
+        base_dir=base_dir,
+        sink=sink,
+        stop_event=stop_event,
+        drain_event=drain_event,
+        # ahead of the batch's seal on the same queue, so the uploader knows it is partial in time
+        on_partial=lambda *args: events.put(('partial', *args)),
+        # each worker trips breakers for the domains it sees, they aren't shared with the others
+        breakers=DomainBreakers(),
+        progress_callback=lambda stats: events.put(('progress', worker_id, stats)),
+        **process_kwargs
+    )
+
+def process_parquet_multiprocess(
+        ddb_table,
+        base_dir,
+        pq_path,
+        pq_id,
+        already_processed,
+        uploader,
+        num_processes=2,
+        write_shards=False,
+        max_images_per_tar=30000,
+        concurrency=500,
+        total_images_required=50_000_000,
+        min_images_per_tar=15000,
+        report_interval=10,
+        upload_counter=None,
+        drain_event=None,
+        remaining_rows=None,
+        **kwargs
+    ):
+    """
+    Splits the parquet into its {pq_id}-{start}-{end} batches and deals them out
+    round-robin to num_processes worker processes, each running process_parquet
+    with its share of the concurrency. Batches in already_processed are never
+    assigned. The parent forwards sealed batches to the uploader, aggregates
+    progress and stops the workers once enough tars have been uploaded. With
+    remaining_rows, the rows left by a drain, those rows are split into
+    batches of their own, and setting drain_event drains every worker.
+    """
+    if remaining_rows is not None:
+        # the rows a drain left are batches of their own, clear of the partial shards it uploaded
+        batches = leftover_batches(remaining_rows, max_images_per_tar)
+    elif kwargs.get('target_tar_bytes'):
+        # batches cut by size are planned up front, from the image sizes listed in the parquet
+        batches = plan_row_ranges(
+            pq_path,
+            pq_id,
+            max_images_per_tar,
+            min_rows=min_images_per_tar,
+            target_bytes=kwargs['target_tar_bytes'],
+            bytes_per_pixel=kwargs.get('bytes_per_pixel', BYTES_PER_PIXEL),
+            max_side=kwargs.get('max_image_side'),
+            already_processed=already_processed
+        )
+    else:
+        num_rows = pq.ParquetFile(pq_path).metadata.num_rows
+        batches = [(s, e) for s, e in batch_row_ranges(num_rows, max_images_per_tar) if f"{pq_id}-{s}-{e}" not in already_processed]
+
+    own_counter = upload_counter is None and ddb_table is not None
+    if own_counter:
+        upload_counter = UploadCounter(ddb_table)
+        upload_counter.start()
+
+    ctx = multiprocessing.get_context('spawn')
+    events = ctx.Queue()
+    stop_event = ctx.Event()
+    worker_drain_event = ctx.Event()
+
+    processes = []
+    for worker_id in range(num_processes):
+        row_ranges = batches[worker_id::num_processes]
+        if not row_ranges:
+            continue
+
+        process_kwargs = dict(
+            pq_path=pq_path,
+            pq_id=pq_id,
+            already_processed=already_processed,
+            max_images_per_tar=max_images_per_tar,
+            concurrency=max(1, concurrency // num_processes),
+            total_images_required=total_images_required,
+            min_images_per_tar=min_images_per_tar,
+            report_interval=report_interval,
+            row_ranges=row_ranges,
+            remaining_rows=remaining_rows,
+            **kwargs
+        )
+        p = ctx.Process(target=_sharded_worker, args=(worker_id, events, stop_event, worker_drain_event, base_dir, write_shards, process_kwargs))
+        p.start()
+        processes.append(p)
+
+    print(f"Processing {len(batches)} batches of {pq_id} across {len(processes)} processes.")
+
+    progress = {}
+    last_report = time.time()
+    while True:
+        if drain_event is not None and drain_event.is_set() and not worker_drain_event.is_set():
+            worker_drain_event.set()
+
+        try:
+            event = events.get(timeout=1)
+        except queue.Empty:
+            if any(p.is_alive() for p in processes):
+                continue
+            break
+
+        if event[0] == 'partial':
+            uploader.mark_partial(*event[1:])
+        elif event[0] == 'files':
+            uploader.files_written(*event[1:])
+        elif event[0] == 'batch':
+            uploader.batch_complete(event[1])
+        elif event[0] == 'tar':
+            uploader.submit_tar(*event[1:])
+        elif event[0] == 'progress':
+            progress[event[1]] = event[2]
+
+        if time.time() - last_report > report_interval:
+            last_report = time.time()
+            completed = sum(p['completed'] for p in progress.values())
+            succeeded = sum(p['succeeded'] for p in progress.values())
+            in_flight = sum(p['in_flight'] for p in progress.values())
+            print(f"All processes: in flight: {in_flight}, succeeded: {succeeded}/{completed}")
+
+            if upload_counter is not None and not stop_event.is_set():
+                total_tar_files_uploaded = upload_counter.value
+                if total_tar_files_uploaded * min_images_per_tar >= total_images_required:
+                    print(f"Uploaded at least {total_tar_files_uploaded * min_images_per_tar}. Stopping worker processes.")
+                    stop_event.set()
+
+    for p in processes:
+        p.join()
+        if p.exitcode != 0:
+            print(f"Worker process {p.pid} exited with code {p.exitcode}")
+
+    if own_counter:
+        upload_counter.stop()
+
+    stats = {'in_flight': 0, 'completed': 0, 'succeeded': 0, 'write_failed': 0, 'invalid': 0, 'dropped': 0, 'partial': 0, 'rejected': defaultdict(int), 'hedges': defaultdict(int), 'domains': {}}
+    for worker_stats in progress.values():
+        for k in ['in_flight', 'completed', 'succeeded', 'write_failed', 'invalid', 'dropped', 'partial']:
+            stats[k] += worker_stats.get(k, 0)
+        for reason, count in worker_stats.get('rejected', {}).items():
+            stats['rejected'][reason] += count
+        for k, count in worker_stats.get('hedges', {}).items():
+            stats['hedges'][k] += count
+        for domain, counts in worker_stats.get('domains', {}).items():
+            totals = stats['domains'].setdefault(domain, {'scheduled': 0, 'succeeded': 0, 'failed': 0})
+            for k, v in counts.items():
+                totals[k] += v
+    stats['rejected'] = dict(stats['rejected'])
+    stats['hedges'] = dict(stats['hedges'])
+
+    return stats
 
 def get_already_processed_batches(ddb_table, pq_id):
     try:
@@ -255,6 +901,22 @@ def total_tar_files(ddb_table):
         print(f"Error retrieving already processed batches from DynamoDB: {e}")
         return 0
 
+def finish_drain(drain, uploader, ddb_table, pq_id, pq_path, row_ranges=None):
+    """
+    The rest of a drain once process_parquet has returned: wait for the
+    uploader to upload the partial shards, for as long as the drain has left,
+    then set drain.remaining to the rows of row_ranges, by default the whole
+    parquet, that DynamoDB doesn't have yet.
+    """
+    drain.mark('stopped')
+    if not uploader.finalize(timeout=drain.time_left()):
+        print("Ran out of time to upload every partial shard.")
+    drain.mark('uploaded')
+
+    if row_ranges is None:
+        row_ranges = [(0, pq.ParquetFile(pq_path).metadata.num_rows)]
+    drain.remaining = remaining_row_ranges(pq_id, row_ranges, get_already_processed_batches(ddb_table, pq_id))
+
 def prevent_further_tasks(config):
     cluster_name = config.get('ECS_CLUSTER_NAME')
     service_name = config.get('ECS_SERVICE_NAME')
@@ -284,6 +946,180 @@ def prevent_further_tasks(config):
     except Exception as e:
         print(f"Failed to set desired task count: {e}")
 
+def run_message_loop(
+    sqs,
+    queue_url,
+    fetch_parquet,
+    handle_parquet,
+    continuous=False,
+    initial_wait_time=1200,
+    wait_time=20,
+    visibility_timeout=300,
+    extend_interval=60,
+    interrupt_fn=None,
+    drain=None,
+    release_parquet=close_parquet
+):
+    """
+    Receive parquet messages from the queue and process them one at a time.
+
+    fetch_parquet(url) returns (pq_id, pq_path) or None if the parquet couldn't
+    be fetched, and handle_parquet(pq_id, pq_path) returns False once no more
+    parquets are needed. Messages are deleted after they have been handled, and
+    their visibility is extended while they are held. release_parquet(*fetched)
+    is called once a fetched parquet has been handled or won't be, by default
+    it only closes streamed parquets.
+
+    Without continuous a single message is processed. With continuous the loop
+    keeps going until the queue has been empty for initial_wait_time seconds,
+    and the next message is received and its parquet fetched in the background
+    while the current one is being handled. Every held message, including a
+    prefetched one, is re-queued by the InterruptionHandler on interruption.
+
+    With a Drain, the interruption starts it instead and handle_parquet is
+    expected to return early, setting drain.remaining. The message is then
+    replaced on the queue by one for just the remaining rows, or deleted if
+    there are none.
+    """
+    if drain is not None:
+        ih = InterruptionHandler(None, queue_url, sqs, interrupt_fn=interrupt_fn, on_interrupt=drain.start, drain_timeout=drain.timeout)
+    else:
+        ih = InterruptionHandler(None, queue_url, sqs, interrupt_fn=interrupt_fn)
+    extender = VisibilityExtender(sqs, queue_url, visibility_timeout=visibility_timeout, interval=extend_interval)
+    stopping = Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def receive():
+        total_wait_time = 0
+        while not stopping.is_set() and not ih.interrupted:
+            messages = receive_message(sqs, queue_url, wait_time=wait_time)
+            if messages:
+                message = messages[0]
+                MESSAGES.inc(action='received')
+                ih.hold(message['Body'])
+                extender.add(message['ReceiptHandle'])
+
+                print(f"Fetching parquet file URL: {message['Body']}")
+                fetch_start = time.time()
+                try:
+                    fetched = fetch_parquet(message['Body'])
+                except Exception as e:
+                    print(f"Error fetching parquet {message['Body']}: {e}")
+                    fetched = None
+                PARQUET_FETCH_SECONDS.observe(time.time() - fetch_start)
+                print(f"Fetched parquet in {time.time() - fetch_start:.2f} seconds.")
+                return message, fetched
+
+            total_wait_time += wait_time
+            print(f"No messages available yet. Total wait time: {total_wait_time} seconds.")
+            if total_wait_time > initial_wait_time:
+                print(f"No messages available for {initial_wait_time} seconds terminating")
+                return None
+        return None
+
+    def requeue_remaining(message):
+        try:
+            if drain.remaining is None:
+                return  # the drain didn't get that far, the message goes back as it was
+            url, _ = parse_message_body(message['Body'])
+            if drain.remaining:
+                if not ih.requeue(message['Body'], make_message_body(url, drain.remaining)):
+                    # the drain timed out and the handler put the whole message back, so it is kept
+                    print(f"{url} was already re-queued in full.")
+                    return
+                print(f"Re-queued {url} with {sum(e - s for s, e in drain.remaining)} rows left.")
+            else:
+                ih.release(message['Body'])
+            delete_message(sqs, queue_url, message['ReceiptHandle'])
+            drain.mark('requeued')
+        finally:
+            # the handler stops waiting and puts back whatever is still held, such as a prefetched message
+            ih.drained()
+
+    def release(fetched):
+        if fetched is not None:
+            release_parquet(*fetched)
+
+    def let_go(message, fetched):
+        release(fetched)
+        ih.release(message['Body'])
+        extender.remove(message['ReceiptHandle'])
+
+    processed = 0
+    ih.start_listening()
+    extender.start()
+    next_message = executor.submit(receive)
+    try:
+        while next_message is not None:
+            received = next_message.result()
+            next_message = None
+            if received is None or ih.interrupted:
+                break
+            message, fetched = received
+
+            if continuous:
+                next_message = executor.submit(receive)
+
+            if fetched is None:
+                print(f"Failed to fetch parquet file from URL: {message['Body']}. Message not deleted for retry.")
+                MESSAGES.inc(action='fetch_failed')
+                let_go(message, fetched)
+                continue
+
+            process_start = time.time()
+            try:
+                keep_going = handle_parquet(*fetched)
+            except Exception as e:
+                print(f"Error processing message: {e}")
+                MESSAGES.inc(action='requeued')
+                ih.requeue(message['Body'])
+                let_go(message, fetched)
+                continue
+
+            PARQUET_PROCESS_SECONDS.observe(time.time() - process_start)
+            if ih.interrupted:
+                release(fetched)
+                # the handler has already put the message back on the queue, unless it is draining
+                if drain is not None:
+                    requeue_remaining(message)
+                    extender.remove(message['ReceiptHandle'])
+                MESSAGES.inc(action='interrupted')
+                break
+
+            let_go(message, fetched)
+            processed += 1
+            if not keep_going:
+                break
+
+            delete_message(sqs, queue_url, message['ReceiptHandle'])
+            MESSAGES.inc(action='deleted')
+            print(f"Deleted message from SQS: {message.get('MessageId')}")
+    finally:
+        stopping.set()
+        if next_message is not None:
+            # a prefetched message that won't be processed goes straight back to the queue
+            received = next_message.result()
+            if received is not None:
+                message, fetched = received
+                if ih.interrupted:
+                    # still held, so add_pq_back below re-queues it
+                    extender.remove(message['ReceiptHandle'])
+                    release(fetched)
+                else:
+                    let_go(message, fetched)
+                    extender.give_back(message['ReceiptHandle'])
+                    MESSAGES.inc(action='returned')
+        executor.shutdown()
+
+        if ih.interrupted:
+            ih.add_pq_back()  # anything received after the interruption was noticed
+        ih.stop_listening()
+        extender.stop()
+        if drain is not None and drain.draining():
+            drain.report()
+
+    return processed
+
 def generate_webdatasets(
     min_images_per_tar=15_000,
     wait_after_last_change=600,
@@ -292,8 +1128,42 @@ def generate_webdatasets(
     concurrency=800,
     s3_output_prefix='webdataset',
     total_images_required=50_000_000,
-    base_dir = '../cruft/images'
+    base_dir = '../cruft/images',
+    write_shards=False,
+    limit_per_host=8,
+    ttl_dns_cache=300,
+    num_processes=1,
+    adaptive_concurrency=False,
+    upload_count_refresh_interval=60,
+    stream=False,
+    continuous=False,
+    visibility_timeout=300,
+    image_processes=0,
+    max_image_side=None,
+    jpeg_quality=90,
+    dedup_s3_prefix=None,
+    dedup_capacity=100_000_000,
+    dedup_error_rate=0.01,
+    breaker_s3_prefix=None,
+    max_image_bytes=10 * 1024 * 1024,
+    metrics_port=9100,
+    metrics_jsonl=None,
+    metrics_interval=60,
+    checkpoint_s3_prefix=None,
+    checkpoint_interval=300,
+    hedge_percentile=None,
+    hedge_budget=0.05,
+    stream_uploads=False,
+    watch_files=False,
+    upload_workers=4,
+    target_tar_bytes=None,
+    record_shards=False,
+    drain_timeout=90
 ):
+    if checkpoint_s3_prefix is not None and num_processes > 1:
+        # worker processes write through sinks of their own, which the checkpointing sink can't wrap
+        raise ValueError('checkpoint_s3_prefix only works with num_processes=1')
+
     config = load_config()
     sqs, s3, ddb_table = initialize_boto3_clients(config)
 
@@ -306,6 +1176,21 @@ def generate_webdatasets(
     if not os.path.exists(base_dir):
         os.makedirs(base_dir)
     
+    upload_counter = UploadCounter(ddb_table, refresh_interval=upload_count_refresh_interval)
+    upload_counter.start()
+
+    metrics_server = start_metrics_server(metrics_port) if metrics_port is not None else None
+    metrics_dumper = None
+    if metrics_jsonl is not None:
+        metrics_dumper = MetricsDumper(metrics_jsonl, interval=metrics_interval)
+        metrics_dumper.start()
+
+    # the index lives in this process, so worker processes don't dedup
+    dedup = None
+    if dedup_s3_prefix is not None and num_processes == 1:
+        dedup = DedupIndex(capacity=dedup_capacity, error_rate=dedup_error_rate)
+        dedup.load(s3, s3_bucket_name, dedup_s3_prefix)
+
     uploader = TarMaker(
         watch_dir=base_dir, 
         min_images_per_tar=min_images_per_tar, 
@@ -315,72 +1200,179 @@ def generate_webdatasets(
         ddb_table=ddb_table,
         sqs_client=sqs,
         tar_queue_url=config.get('SQS_TAR_QUEUE_URL'), 
-        wait_after_last_change=wait_after_last_change
+        wait_after_last_change=wait_after_last_change,
+        upload_counter=upload_counter,
+        # images were already decoded at download time
+        validate_images=not image_processes,
+        stream_uploads=stream_uploads,
+        upload_workers=upload_workers,
+        record_shards=record_shards,
+        # images seen in a batch only count as seen once it is uploaded
+        dedup=dedup
     )
+    # files written into base_dir by anything other than this node's producers
+    if watch_files:
+        uploader.start_watching()
     t = Thread(target=uploader.keep_monitoring)
     t.start()
+
+    concurrency_controller = None
+    if adaptive_concurrency:
+        per_process = max(1, concurrency // num_processes)
+        concurrency_controller = AIMDController(initial=per_process, minimum=max(1, per_process // 8), maximum=per_process * 4)
+
+    # either write tar shards directly, or leave per-image files for the uploader to bundle
+    if write_shards:
+        sink = ShardWriter(base_dir, on_seal=uploader.submit_tar, validate=not image_processes)
+    else:
+        sink = FileSink(base_dir, on_seal=uploader.batch_complete, on_write=uploader.files_written)
     
-    print(f"Starting to process messages from SQS queue: {sqs_queue_url}")
-    total_wait_time = 0
-    while True:
-        messages = receive_message(sqs, sqs_queue_url, wait_time=20)
-        if not messages:
-            total_wait_time += 20
-            print(f"No messages available yet. Total wait time: {total_wait_time} seconds.")
+    # partial batches are checkpointed to S3 so a replacement worker can finish them
+    checkpoints = None
+    if checkpoint_s3_prefix is not None:
+        checkpoints = CheckpointingSink(sink, s3, s3_bucket_name, checkpoint_s3_prefix, base_dir, interval=checkpoint_interval)
+        checkpoints.start()
+        # the sink feeds the uploader, so the checkpoint can only be handed to it now
+        uploader.checkpoints = checkpoints
 
-            if total_wait_time > initial_wait_time:
-                print(f"No messages available for {initial_wait_time} seconds terminating")
-                break
-        else:
-            break
+    # started once and shared by every parquet, worker processes start their own
+    processor = None
+    if image_processes and num_processes == 1:
+        processor = ImageProcessor(image_processes, max_side=max_image_side, quality=jpeg_quality)
 
-    for message in messages:
-        parquet_url = message['Body']
-        ih = InterruptionHandler(parquet_url, sqs_queue_url, sqs) # adds the pq message back into the queue if the spot instance is interrupted
-        try:
-            ih.start_listening()
+    # shared by every parquet this node processes, and with the rest of the fleet through S3,
+    # worker processes each keep a set of their own that is never loaded or saved
+    breakers = None
+    if num_processes > 1 and breaker_s3_prefix is not None:
+        print(f"Warning: breaker_s3_prefix is ignored with {num_processes} processes, each process keeps its own circuit breakers.")
+    if num_processes == 1:
+        breakers = DomainBreakers()
+        if breaker_s3_prefix is not None:
+            breakers.load(s3, s3_bucket_name, breaker_s3_prefix)
 
-            print(f"Processing parquet file URL: {parquet_url}")
-            download_start = time.time()
+    # requests slower than hedge_percentile of recent ones get a second attempt
+    hedge = None
+    if hedge_percentile is not None:
+        hedge = HedgePolicy(percentile=hedge_percentile, budget=hedge_budget)
 
-            pq_id, pq_path = download_parquet(base_dir, parquet_url, hf_token)
+    # on a spot interruption notice, partial batches are uploaded and the rows left re-queued
+    drain = Drain(timeout=drain_timeout) if drain_timeout else None
+    drain_event = drain.event if drain is not None else None
 
-            print(f"Processing parquet with ID: {pq_id} downloaded in {time.time() - download_start:.2f} seconds.")
+    # worker processes each read the parquet from disk, so streaming only applies to a single process
+    def fetch_parquet(body):
+        # re-queued by a drain, with only some of its rows left
+        parquet_url, row_ranges = parse_message_body(body)
+        if stream and num_processes == 1:
+            fetched = stream_parquet(parquet_url, hf_token)
+        else:
+            fetched = download_parquet(base_dir, parquet_url, hf_token)
+        return None if fetched is None else (*fetched, row_ranges)
 
-            already_processed = get_already_processed_batches(ddb_table, pq_id)        
+    def handle_parquet(pq_id, pq_path, row_ranges=None):
+        print(f"Processing parquet with ID: {pq_id}")
+        already_processed = get_already_processed_batches(ddb_table, pq_id)
 
-            if pq_path is not None:
-                process_parquet(
-                    ddb_table=ddb_table,
-                    base_dir=base_dir, 
-                    pq_path=pq_path, 
-                    pq_id=pq_id, 
-                    already_processed=already_processed, 
-                    max_images_per_tar=max_images_per_tar, 
-                    concurrency=concurrency,
-                    total_images_required=total_images_required,
-                    min_images_per_tar=min_images_per_tar
-                )
-                ih.stop_listening()
+        if num_processes > 1:
+            process_parquet_multiprocess(
+                ddb_table=ddb_table,
+                base_dir=base_dir,
+                pq_path=pq_path,
+                pq_id=pq_id,
+                already_processed=already_processed,
+                uploader=uploader,
+                num_processes=num_processes,
+                write_shards=write_shards,
+                max_images_per_tar=max_images_per_tar,
+                concurrency=concurrency,
+                total_images_required=total_images_required,
+                min_images_per_tar=min_images_per_tar,
+                limit_per_host=limit_per_host,
+                ttl_dns_cache=ttl_dns_cache,
+                concurrency_controller=concurrency_controller,
+                upload_counter=upload_counter,
+                image_processes=image_processes,
+                max_image_side=max_image_side,
+                jpeg_quality=jpeg_quality,
+                max_image_bytes=max_image_bytes,
+                hedge=hedge,
+                target_tar_bytes=target_tar_bytes,
+                drain_event=drain_event,
+                remaining_rows=row_ranges
+            )
+        else:
+            process_parquet(
+                ddb_table=ddb_table,
+                base_dir=base_dir, 
+                pq_path=pq_path, 
+                pq_id=pq_id, 
+                already_processed=already_processed, 
+                max_images_per_tar=max_images_per_tar, 
+                concurrency=concurrency,
+                total_images_required=total_images_required,
+                min_images_per_tar=min_images_per_tar,
+                sink=sink,
+                limit_per_host=limit_per_host,
+                ttl_dns_cache=ttl_dns_cache,
+                concurrency_controller=concurrency_controller,
+                upload_counter=upload_counter,
+                image_processes=image_processes,
+                max_image_side=max_image_side,
+                jpeg_quality=jpeg_quality,
+                processor=processor,
+                max_image_bytes=max_image_bytes,
+                dedup=dedup,
+                breakers=breakers,
+                checkpoints=checkpoints,
+                hedge=hedge,
+                target_tar_bytes=target_tar_bytes,
+                drain_event=drain_event,
+                on_partial=uploader.mark_partial,
+                remaining_rows=row_ranges
+            )
+            if dedup is not None:
+                dedup.save(s3, s3_bucket_name, dedup_s3_prefix)
+            if breaker_s3_prefix is not None:
+                breakers.save(s3, s3_bucket_name, breaker_s3_prefix)
 
-                total_tar_files_uploaded = get_upload_count(ddb_table)
+        if drain is not None and drain.draining():
+            finish_drain(drain, uploader, ddb_table, pq_id, pq_path, row_ranges)
+            return False
 
-                if total_tar_files_uploaded * min_images_per_tar >= total_images_required:
-                    prevent_further_tasks(config)
-                    break
-                else:
-                    delete_message(sqs, sqs_queue_url, message['ReceiptHandle'])
-                    print(f"Deleted message from SQS: {message.get('MessageId')}")
-            else:
-                print(f"Failed to process parquet file from URL: {parquet_url}. Message not deleted for retry.")
-        except Exception as e:
-            print(f"Error processing message: {e}")
-            ih.stop_listening()
-            ih.add_pq_back()
-            continue
+        total_tar_files_uploaded = upload_counter.value
+        if total_tar_files_uploaded * min_images_per_tar >= total_images_required:
+            prevent_further_tasks(config)
+            return False
+        return True
+
+    print(f"Starting to process messages from SQS queue: {sqs_queue_url}")
+    run_message_loop(
+        sqs,
+        sqs_queue_url,
+        fetch_parquet,
+        handle_parquet,
+        continuous=continuous,
+        initial_wait_time=initial_wait_time,
+        visibility_timeout=visibility_timeout,
+        drain=drain,
+        # in continuous mode every downloaded parquet would otherwise stay on disk
+        release_parquet=remove_parquet
+    )
+
+    if checkpoints is not None:
+        checkpoints.stop()
+        checkpoints.checkpoint()
+    if processor is not None:
+        processor.close()
 
     uploader.finalize()
     t.join()
+    upload_counter.stop()
+
+    if metrics_dumper is not None:
+        metrics_dumper.stop()
+    if metrics_server is not None:
+        metrics_server.shutdown()
 
 if __name__ == "__main__":
     generate_webdatasets()
@@ -0,0 +1,81 @@
+from collections import defaultdict
+
+from metrics import REGISTRY
+
+IMAGES_REJECTED = REGISTRY.counter('vitsae_images_rejected_total', 'Image responses rejected before or while reading the body, by reason.')
+
+MAGIC_BYTES = [
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+]
+
+SNIFF_BYTES = 16
+
+def sniff_image_type(head):
+    """
+    Work out the image format from the first bytes of a file, or None if it isn't one we know.
+    """
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    for magic, image_type in MAGIC_BYTES:
+        if head.startswith(magic):
+            return image_type
+    return None
+
+class ResponseGuard:
+    """
+    Decides whether an image response is worth reading. Responses are rejected
+    before the body is read if Content-Length is over max_bytes or Content-Type
+    is set to something other than an image, and while it is read if it turns
+    out to be longer than max_bytes or its first bytes aren't an image. The
+    count of each rejection reason is kept in rejections.
+    """
+    def __init__(self, max_bytes=10 * 1024 * 1024, check_content_type=True, chunk_size=64 * 1024):
+        self.max_bytes = max_bytes
+        self.check_content_type = check_content_type
+        self.chunk_size = chunk_size
+        self.rejections = defaultdict(int)
+
+    def _reject(self, reason):
+        self.rejections[reason] += 1
+        IMAGES_REJECTED.inc(reason=reason)
+        return None
+
+    def _acceptable_type(self, content_type):
+        if not content_type:
+            return True  # plenty of hosts don't say, let the magic bytes decide
+        content_type = content_type.split(';')[0].strip().lower()
+        return content_type.startswith('image/') or content_type in ('application/octet-stream', 'binary/octet-stream')
+
+    async def read(self, response):
+        """
+        Return the body of an aiohttp response, or None if it was rejected.
+        """
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            return self._reject('content_length')
+        if self.check_content_type and not self._acceptable_type(response.headers.get('Content-Type')):
+            return self._reject('content_type')
+
+        body = bytearray()
+        sniffed = False
+        async for chunk in response.content.iter_chunked(self.chunk_size):
+            body.extend(chunk)
+            if len(body) > self.max_bytes:
+                return self._reject('max_bytes')
+            if not sniffed and len(body) >= SNIFF_BYTES:
+                if sniff_image_type(body[:SNIFF_BYTES]) is None:
+                    return self._reject('magic_bytes')
+                sniffed = True
+
+        if not body:
+            return self._reject('empty')
+        if not sniffed and sniff_image_type(bytes(body)) is None:
+            return self._reject('magic_bytes')
+
+        return bytes(body)
@@ -0,0 +1,93 @@
+import asyncio
+import math
+import time
+from collections import deque
+
+from metrics import REGISTRY
+
+HEDGES = REGISTRY.counter('vitsae_image_hedges_total', 'Hedged image requests, by whether the hedge was launched or won.')
+
+class HedgePolicy:
+    """
+    Decides when a slow image request gets a second, hedged attempt. The
+    trigger is the given percentile of the latencies of the last window
+    requests, never less than min_delay, and at most budget of all requests
+    get a hedge so a slow network can't double the load on every host.
+
+    Only the original attempt's latency is recorded, the time spent waiting
+    for a hedge would push the percentile up. The percentile is recomputed
+    every recompute_every samples rather than on every request.
+    """
+    def __init__(self, percentile=0.95, budget=0.05, window=1000, min_samples=100, min_delay=0.05, recompute_every=100):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.recompute_every = recompute_every
+
+        self.latencies = deque(maxlen=window)
+        self.stats = {'requests': 0, 'hedged': 0, 'hedge_won': 0}
+        self._delay = None
+        self._since_recompute = 0
+
+    def record(self, seconds):
+        self.latencies.append(seconds)
+        self._since_recompute += 1
+        if len(self.latencies) >= self.min_samples and (self._delay is None or self._since_recompute >= self.recompute_every):
+            ordered = sorted(self.latencies)
+            k = min(len(ordered) - 1, math.ceil(self.percentile * len(ordered)) - 1)
+            self._delay = max(self.min_delay, ordered[k])
+            self._since_recompute = 0
+
+    def delay(self):
+        """
+        Seconds to wait on a request before hedging it, or None until there
+        are enough samples.
+        """
+        return self._delay
+
+    def try_hedge(self):
+        if self.stats['hedged'] + 1 > self.budget * self.stats['requests']:
+            return False
+        self.stats['hedged'] += 1
+        HEDGES.inc(outcome='launched')
+        return True
+
+    async def run(self, attempt, succeeded):
+        """
+        Await attempt(), starting a second attempt() if the first is still
+        running after delay(). The first result for which succeeded(result) is
+        true wins and the other attempt is cancelled, otherwise the last result
+        to finish is returned. The first attempt's latency is recorded, up to
+        when it was cancelled if the hedge won.
+        """
+        self.stats['requests'] += 1
+        delay = self.delay()
+        start = time.monotonic()
+        first = asyncio.ensure_future(attempt())
+        first.add_done_callback(lambda _: self.record(time.monotonic() - start))
+        if delay is None:
+            return await first
+
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done or not self.try_hedge():
+            return await first
+
+        tasks = [first, asyncio.ensure_future(attempt())]
+        try:
+            result = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if succeeded(result):
+                        if task is tasks[1]:
+                            self.stats['hedge_won'] += 1
+                            HEDGES.inc(outcome='won')
+                        return result
+            return result
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
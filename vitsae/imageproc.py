@@ -0,0 +1,51 @@
+import io
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+def prepare_image(image_content, max_side=None, quality=90):
+    """
+    Fully decode image_content and return it as jpeg bytes no larger than
+    max_side on its longest side, or None if it isn't a readable image.
+    Jpegs that are already small enough are returned untouched rather than
+    being re-encoded.
+    """
+    try:
+        image = Image.open(io.BytesIO(image_content))
+        image.load()
+    except Exception:
+        return None
+
+    too_big = max_side is not None and max(image.size) > max_side
+    if image.format == 'JPEG' and image.mode == 'RGB' and not too_big:
+        return image_content
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if too_big:
+        image.thumbnail((max_side, max_side), Image.BICUBIC)
+
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+class ImageProcessor:
+    """
+    Runs prepare_image on downloaded bytes in a pool of num_processes worker
+    processes, so decoding and resizing never holds up the event loop or
+    competes with it for the GIL.
+    """
+    def __init__(self, num_processes=4, max_side=None, quality=90):
+        self.max_side = max_side
+        self.quality = quality
+        # spawned rather than forked, the parent has writer and event loop threads running
+        self.pool = ProcessPoolExecutor(max_workers=num_processes, mp_context=multiprocessing.get_context('spawn'))
+
+    async def process(self, image_content):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, prepare_image, image_content, self.max_side, self.quality)
+
+    def close(self):
+        self.pool.shutdown()
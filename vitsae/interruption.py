@@ -14,11 +14,28 @@ def check_for_interruption():
     return False
 
 class InterruptionHandler():
-    def __init__(self, message, queue_url, sqs_client, interrupt_fn=None) -> None:
+    """
+    Puts parquet messages back on the queue if the spot instance is interrupted
+    or the task receives SIGTERM. It starts out holding message, and a long
+    running worker can hold() and release() further messages as it receives
+    and finishes them, every held message is re-queued on interruption.
+
+    With on_interrupt the spot notice first calls on_interrupt(), so the
+    worker can drain and re-queue its messages itself, and only messages still
+    held once the worker calls drained() or drain_timeout runs out are put back
+    as they are.
+    """
+    def __init__(self, message, queue_url, sqs_client, interrupt_fn=None, on_interrupt=None, drain_timeout=None, poll_interval=5) -> None:
         self._stop = False
-        self.message = message
+        self.interrupted = False
+        self.messages = [message] if message is not None else []
         self.queue_url = queue_url
         self.sqs_client = sqs_client
+        self._lock = threading.Lock()
+        self.on_interrupt = on_interrupt
+        self.drain_timeout = drain_timeout
+        self.poll_interval = poll_interval
+        self._drained = threading.Event()
 
         if interrupt_fn is None:
             interrupt_fn = check_for_interruption
@@ -27,22 +44,56 @@ class InterruptionHandler():
 
         signal.signal(signal.SIGTERM, self.handle_sigterm)
 
+    @property
+    def message(self):
+        return self.messages[0] if self.messages else None
+
+    def hold(self, message):
+        with self._lock:
+            self.messages.append(message)
+
+    def release(self, message):
+        with self._lock:
+            if message in self.messages:
+                self.messages.remove(message)
+
     def listen(self):
         while not self._stop:
             if self.interrupt_fn():
+                self.interrupted = True
+                if self.on_interrupt is not None:
+                    self.on_interrupt()
+                    self._drained.wait(self.drain_timeout)
                 self.add_pq_back()
                 break
-            time.sleep(5)
+            time.sleep(self.poll_interval)
+
+    def drained(self):
+        self._drained.set()
 
     def add_pq_back(self):
-        if self.message is not None:
-            url = self.message
-            self.message = None
+        with self._lock:
+            messages = self.messages
+            self.messages = []
 
-            self.sqs_client.send_message(QueueUrl=self.queue_url, MessageBody=url)
-        else:
+        if not messages:
             print("Message has already been added back to the queue")
 
+        for url in messages:
+            self.sqs_client.send_message(QueueUrl=self.queue_url, MessageBody=url)
+
+    def requeue(self, message, body=None):
+        """
+        Put a single held message back on the queue, e.g. after it failed, or
+        body in its place. Returns False if the message was no longer held.
+        """
+        with self._lock:
+            if message not in self.messages:
+                return False
+            self.messages.remove(message)
+        self.sqs_client.send_message(QueueUrl=self.queue_url, MessageBody=body if body is not None else message)
+        return True
+
     def start_listening(self):
         self.listener_thread = threading.Thread(target=self.listen, daemon=True)
         self.listener_thread.start()
@@ -54,8 +105,10 @@ class InterruptionHandler():
 
     def stop(self):
         self._stop = True
+        self._drained.set()
 
     def handle_sigterm(self, signum, frame):
         print("Received SIGTERM signal. Performing cleanup...")
+        self.interrupted = True
         self.add_pq_back()
         self.stop()
@@ -0,0 +1,202 @@
+import json
+import math
+import time
+import socket
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self.values.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{_format_labels(key)} {_format_value(value)}')
+        return lines
+
+    def snapshot(self):
+        with self._lock:
+            return [{'labels': dict(key), 'value': value} for key, value in self.values.items()]
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[_label_key(labels)] = value
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = list(buckets) + [math.inf]
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['buckets'][i] += 1
+                    break
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, entry in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, entry['buckets']):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{_format_labels(key, [("le", _format_value(bound))])} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(entry["sum"])}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {entry["count"]}')
+        return lines
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                {
+                    'labels': dict(key),
+                    'count': entry['count'],
+                    'sum': entry['sum'],
+                    'buckets': {str(bound): count for bound, count in zip(self.buckets, entry['buckets'])},
+                }
+                for key, entry in self.values.items()
+            ]
+
+class MetricsRegistry:
+    """
+    The metrics for one process, rendered in the Prometheus text format or as
+    a JSON snapshot. Asking for a metric that is already registered returns
+    the existing one, so modules can declare the metrics they use at import.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, documentation, **kwargs):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, documentation, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, documentation):
+        return self._get(Counter, name, documentation)
+
+    def gauge(self, name, documentation):
+        return self._get(Gauge, name, documentation)
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, documentation, buckets=buckets)
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+REGISTRY = MetricsRegistry()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port, registry=REGISTRY, host='0.0.0.0'):
+    """
+    Serve registry at http://host:port/metrics from a daemon thread. Call shutdown() on the result to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'Serving metrics on http://{host}:{server.server_address[1]}/metrics')
+    return server
+
+class MetricsDumper:
+    """
+    Appends a JSON snapshot of registry to path every interval seconds, one
+    line per snapshot, so runs across the fleet can be compared afterwards.
+    """
+    def __init__(self, path, interval=60, registry=REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.host = socket.gethostname()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def dump(self):
+        line = json.dumps({'time': time.time(), 'host': self.host, 'metrics': self.registry.snapshot()})
+        with open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+    def _keep_dumping(self):
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._keep_dumping, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join()
+        self.dump()
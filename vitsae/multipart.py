@@ -0,0 +1,86 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 rejects smaller parts, except for the last one
+
+class MultipartUploadWriter(io.RawIOBase):
+    """
+    A write-only file that streams into an S3 multipart upload. Writes are
+    buffered into part_size parts which are uploaded by upload_threads threads
+    while the caller keeps writing, with at most max_pending_parts held in
+    memory. complete() uploads the last part and completes the upload, abort()
+    (or an error in any part) aborts it so no orphaned parts are left behind.
+    """
+    def __init__(self, s3_client, bucket, key, part_size=8 * 1024 * 1024, upload_threads=4, max_pending_parts=None):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+
+        self.upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.executor = ThreadPoolExecutor(max_workers=upload_threads)
+        self.slots = threading.Semaphore(max_pending_parts or upload_threads * 2)
+        self.buffer = bytearray()
+        self.futures = []
+        self.bytes_written = 0
+        self.error = None
+        self.finished = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.error is not None:
+            raise IOError(f'Upload of s3://{self.bucket}/{self.key} failed: {self.error}')
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def _submit(self, body):
+        part_number = len(self.futures) + 1
+        # blocks the writer once max_pending_parts are waiting to be uploaded
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self._upload_part, part_number, body))
+
+    def _upload_part(self, part_number, body):
+        try:
+            response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.slots.release()
+
+    def complete(self):
+        """
+        Upload what is left of the buffer as the last part, wait for every part
+        and complete the upload. Aborts and re-raises if anything failed.
+        """
+        try:
+            if self.buffer or not self.futures:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            parts = [future.result() for future in self.futures]
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': parts})
+            self.finished = True
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def abort(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            print(f'Failed to abort upload of s3://{self.bucket}/{self.key}: {e}')
@@ -0,0 +1,173 @@
+import io
+import os
+import struct
+import threading
+
+import requests
+import pyarrow.parquet as pq
+
+FOOTER_FETCH_SIZE = 64 * 1024
+
+def parquet_id_from_url(url):
+    return os.path.basename(url).split('part-')[1].split('-')[0]
+
+def fetch_range(session, url, headers, start, end, timeout=60):
+    """
+    GET bytes [start, end) of url with a range request.
+    """
+    range_headers = dict(headers or {})
+    range_headers['Range'] = f'bytes={start}-{end - 1}'
+    response = session.get(url, headers=range_headers, timeout=timeout)
+    response.raise_for_status()
+    if response.status_code != 206 and not (start == 0 and len(response.content) == end):
+        raise IOError(f'{url} does not support range requests (status {response.status_code})')
+    return response.content
+
+class RangeStreamedParquet(io.RawIOBase):
+    """
+    A read-only, seekable file over a remote parquet, for passing to
+    pq.ParquetFile in place of a local path. The footer is fetched first, then
+    a background thread downloads row groups in order, staying at most
+    lookahead row groups ahead of the reader. Reads inside a row group wait for
+    that row group to arrive, so rows from the first row group can be scheduled
+    while the rest of the file is still downloading. Row groups are dropped
+    from memory once the reader has moved past them.
+    """
+    def __init__(self, url, headers=None, lookahead=2, timeout=60, footer_fetch_size=FOOTER_FETCH_SIZE):
+        super().__init__()
+        self.url = url
+        self.headers = headers or {}
+        self.lookahead = lookahead
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.size = self._content_length()
+        self.position = 0
+
+        tail_start = max(0, self.size - footer_fetch_size)
+        tail = fetch_range(self.session, url, self.headers, tail_start, self.size, timeout)
+        if tail[-4:] != b'PAR1':
+            raise IOError(f'{url} is not a parquet file')
+        footer_length = struct.unpack('<I', tail[-8:-4])[0]
+        if footer_length + 8 > len(tail):
+            tail_start = self.size - footer_length - 8
+            tail = fetch_range(self.session, url, self.headers, tail_start, self.size, timeout)
+        self.footer = (tail_start, tail)
+
+        self.metadata = pq.read_metadata(self)
+        self.row_group_ranges = [self._row_group_range(i) for i in range(self.metadata.num_row_groups)]
+
+        self.fetched = {}
+        self.current = 0
+        self.error = None
+        self._closed = False
+        self.condition = threading.Condition()
+        self.bytes_fetched = len(tail)
+
+        self.prefetcher = threading.Thread(target=self._prefetch, daemon=True)
+        self.prefetcher.start()
+
+    def _content_length(self):
+        response = self.session.head(self.url, headers=self.headers, allow_redirects=True, timeout=self.timeout)
+        response.raise_for_status()
+        return int(response.headers['Content-Length'])
+
+    def _row_group_range(self, i):
+        row_group = self.metadata.row_group(i)
+        start, end = None, None
+        for c in range(row_group.num_columns):
+            column = row_group.column(c)
+            column_start = column.data_page_offset
+            if column.has_dictionary_page and column.dictionary_page_offset:
+                column_start = min(column_start, column.dictionary_page_offset)
+            column_end = column_start + column.total_compressed_size
+            start = column_start if start is None else min(start, column_start)
+            end = column_end if end is None else max(end, column_end)
+        return start, end
+
+    def _prefetch(self):
+        session = requests.Session()
+        try:
+            for i, (start, end) in enumerate(self.row_group_ranges):
+                with self.condition:
+                    self.condition.wait_for(lambda: i - self.current < self.lookahead or self._closed)
+                    if self._closed:
+                        return
+
+                data = fetch_range(session, self.url, self.headers, start, end, self.timeout)
+
+                with self.condition:
+                    if i >= self.current:
+                        self.fetched[i] = (start, data)
+                    self.bytes_fetched += len(data)
+                    self.condition.notify_all()
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def _row_group_for(self, start, end):
+        for i, (rg_start, rg_end) in enumerate(self.row_group_ranges):
+            if rg_start <= start and end <= rg_end:
+                return i
+        return None
+
+    def _read_range(self, start, end):
+        footer_start, footer = self.footer
+        if footer_start <= start and end <= footer_start + len(footer):
+            return footer[start - footer_start:end - footer_start]
+
+        i = self._row_group_for(start, end) if hasattr(self, 'row_group_ranges') else None
+        if i is None or i < self.current:
+            return fetch_range(self.session, self.url, self.headers, start, end, self.timeout)
+
+        with self.condition:
+            if i > self.current:
+                self.current = i
+                for old in [k for k in self.fetched if k < i]:
+                    del self.fetched[old]
+                self.condition.notify_all()
+
+            self.condition.wait_for(lambda: i in self.fetched or self.error is not None)
+            if i not in self.fetched:
+                raise IOError(f'Failed to stream row group {i} of {self.url}: {self.error}')
+
+            rg_start, data = self.fetched[i]
+            return data[start - rg_start:end - rg_start]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, b):
+        start = self.position
+        end = min(start + len(b), self.size)
+        if end <= start:
+            return 0
+
+        data = self._read_range(start, end)
+        b[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if hasattr(self, 'condition'):
+            with self.condition:
+                self._closed = True
+                self.fetched.clear()
+                self.condition.notify_all()
+        super().close()
@@ -0,0 +1,113 @@
+import io
+import struct
+import tarfile
+
+from PIL import Image
+import fire
+
+RECORD_SUFFIX = '.rec'
+RECORD_MAGIC = b'VITREC01'
+HEADER_SIZE = 64
+RECORD_SIDE = 224
+CHANNELS = 3
+
+def pack_header(side=RECORD_SIDE):
+    header = RECORD_MAGIC + struct.pack('<III', side, side, CHANNELS)
+    return header + b'\0' * (HEADER_SIZE - len(header))
+
+def unpack_header(header):
+    """
+    (height, width, channels) of the records in a shard, from its first HEADER_SIZE bytes.
+    """
+    if header[:len(RECORD_MAGIC)] != RECORD_MAGIC:
+        raise ValueError('Not a record shard')
+    return struct.unpack_from('<III', header, len(RECORD_MAGIC))
+
+def to_record(image_content, side=RECORD_SIDE):
+    """
+    Decode image_content into side x side RGB as raw uint8 bytes, the way the
+    CLIP image processor in vit_generate prepares the PIL images read from tar
+    shards: the shortest side is resized to side with bicubic resampling and
+    the middle side x side cropped out. None if it isn't a readable image.
+    """
+    try:
+        image = Image.open(io.BytesIO(image_content))
+        image.load()
+    except Exception:
+        return None
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    width, height = image.size
+    if width <= height:
+        size = (side, int(side * height / width))
+    else:
+        size = (int(side * width / height), side)
+    image = image.resize(size, Image.BICUBIC)
+    left, top = (size[0] - side) // 2, (size[1] - side) // 2
+    return image.crop((left, top, left + side, top + side)).tobytes()
+
+class RecordWriter:
+    """
+    Writes a shard of pre-decoded images: a HEADER_SIZE byte header followed by
+    fixed size side x side x 3 uint8 records, so readers can memory map it and
+    hand out batches without decoding anything. The number of records follows
+    from the size of the shard, so it can be written to a stream, such as a
+    MultipartUploadWriter, without knowing the count up front.
+    """
+    def __init__(self, fileobj, side=RECORD_SIDE):
+        self.fileobj = fileobj
+        self.side = side
+        self.count = 0
+        self.fileobj.write(pack_header(side))
+
+    def write(self, image_content):
+        """
+        Append image_content as a record. Returns False if it couldn't be decoded.
+        """
+        record = to_record(image_content, self.side)
+        if record is None:
+            return False
+        self.fileobj.write(record)
+        self.count += 1
+        return True
+
+def tar_jpgs(tar_path):
+    """
+    The bytes of every jpg in a webdataset tar, in order.
+    """
+    with tarfile.open(tar_path, 'r') as tar:
+        for member in tar:
+            if member.isfile() and member.name.lower().endswith('.jpg'):
+                yield tar.extractfile(member).read()
+
+def file_jpgs(paths):
+    for path in paths:
+        if path.lower().endswith('.jpg'):
+            with open(path, 'rb') as f:
+                yield f.read()
+
+def write_records(fileobj, jpgs, side=RECORD_SIDE):
+    """
+    Write every readable image in jpgs to fileobj as a record shard. Returns
+    the number of records written.
+    """
+    writer = RecordWriter(fileobj, side)
+    for image_content in jpgs:
+        writer.write(image_content)
+    return writer.count
+
+def convert_tar(tar_path, output_path=None, side=RECORD_SIDE):
+    """
+    Convert an existing webdataset tar into a record shard, by default next
+    to it with a .rec suffix.
+    """
+    if output_path is None:
+        output_path = tar_path[:-len('.tar')] + RECORD_SUFFIX if tar_path.endswith('.tar') else tar_path + RECORD_SUFFIX
+    with open(output_path, 'wb') as f:
+        count = write_records(f, tar_jpgs(tar_path), side)
+    print(f'Converted {count} images from {tar_path} into {output_path}')
+    return output_path
+
+if __name__ == '__main__':
+    fire.Fire(convert_tar)
@@ -0,0 +1,42 @@
+import time
+import fire
+
+from generatewds import iterate_parquet_rows, iterate_parquet_records
+
+# poetry run python scheduling_profile.py --pq_path test/parquet/sample.parquet --repeats 5
+
+def schedule_with_iterrows(pq_path, chunk_size):
+    """
+    The old scheduling path: a pandas DataFrame per chunk and a Series per row.
+    """
+    scheduled = 0
+    for df in iterate_parquet_rows(pq_path, chunk_size=chunk_size):
+        for index, row in df.iterrows():
+            if row.get('URL'):
+                scheduled += 1
+    return scheduled
+
+def schedule_with_records(pq_path, chunk_size):
+    """
+    The Arrow columnar path used by process_parquet.
+    """
+    scheduled = 0
+    for batch_start, records in iterate_parquet_records(pq_path, chunk_size=chunk_size):
+        for index, row in enumerate(records, batch_start):
+            if row.get('URL'):
+                scheduled += 1
+    return scheduled
+
+def main(pq_path='test/parquet/sample.parquet', chunk_size=30000, repeats=5):
+    for name, fn in [('iterrows', schedule_with_iterrows), ('arrow records', schedule_with_records)]:
+        best = None
+        for _ in range(repeats):
+            start = time.time()
+            scheduled = fn(pq_path, chunk_size)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        print(f"{name}: scheduled {scheduled} rows in {best:.3f} seconds ({scheduled / best:.0f} rows per second)")
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,109 @@
+import io
+import os
+import json
+import tarfile
+import threading
+
+from PIL import Image
+import PIL
+
+from tarindex import TarIndex, index_path
+
+def is_valid_image(image_content):
+    try:
+        _ = Image.open(io.BytesIO(image_content))
+        return True
+    except PIL.UnidentifiedImageError:
+        return False
+
+class FileSink:
+    """
+    Writes every downloaded image as a .jpg plus a .json file into base_dir,
+    for TarMaker to bundle. Once both files are written
+    on_write(prefix, paths, size) is called so TarMaker can index them without
+    listing the directory, and when a batch is sealed on_seal(prefix) is called
+    so it can be bundled straight away.
+    """
+    def __init__(self, base_dir, on_seal=None, on_write=None):
+        self.base_dir = base_dir
+        self.on_seal = on_seal
+        self.on_write = on_write
+
+    def write(self, prefix, index, image_content, metadata):
+        image_filename = os.path.join(self.base_dir, f"{prefix}--{index}.jpg")
+        json_filename = image_filename.replace('.jpg', '.json')
+        metadata_content = json.dumps(metadata)
+        with open(image_filename, 'wb') as f:
+            f.write(image_content)
+        with open(json_filename, 'w') as f:
+            f.write(metadata_content)
+
+        if self.on_write is not None:
+            self.on_write(prefix, [image_filename, json_filename], len(image_content) + len(metadata_content))
+
+    def seal(self, prefix):
+        if self.on_seal is not None:
+            self.on_seal(prefix)
+
+    def close(self):
+        pass
+
+class ShardWriter:
+    """
+    Appends every downloaded image and its metadata straight into an open
+    webdataset tar for its batch prefix, so no per-image files touch the disk.
+    When a batch is sealed the tar is handed to on_seal(prefix, tar_filename, file_count),
+    with its TarIndex saved next to it.
+    Safe to write to from several threads. With validate=False images are
+    assumed to have been checked already.
+    """
+    def __init__(self, base_dir, on_seal, validate=True):
+        self.base_dir = base_dir
+        self.on_seal = on_seal
+        self.validate = validate
+        self.open_shards = {}
+        self.indexes = {}
+        self.file_counts = {}
+        self._lock = threading.Lock()
+
+    def _part_filename(self, prefix):
+        return os.path.join(self.base_dir, f'{prefix}.tar.part')
+
+    def _get_shard(self, prefix):
+        if prefix not in self.open_shards:
+            self.open_shards[prefix] = tarfile.open(self._part_filename(prefix), 'w')
+            self.indexes[prefix] = TarIndex()
+            self.file_counts[prefix] = 0
+        return self.open_shards[prefix]
+
+    def write(self, prefix, index, image_content, metadata):
+        if self.validate and not is_valid_image(image_content):
+            return
+
+        with self._lock:
+            tar = self._get_shard(prefix)
+            self.indexes[prefix].add(tar, f"{prefix}--{index}.jpg", image_content)
+            self.indexes[prefix].add(tar, f"{prefix}--{index}.json", json.dumps(metadata).encode('utf-8'))
+            self.file_counts[prefix] += 2
+
+    def seal(self, prefix):
+        with self._lock:
+            tar = self.open_shards.pop(prefix, None)
+            if tar is None:
+                return
+
+            tar.close()
+            file_count = self.file_counts.pop(prefix)
+            tar_filename = os.path.join(self.base_dir, f'{prefix}.tar')
+            os.rename(self._part_filename(prefix), tar_filename)
+            # the index goes alongside the tar, for TarMaker to upload with it
+            index = self.indexes.pop(prefix)
+            index.finish(os.path.getsize(tar_filename))
+            index.save(index_path(tar_filename))
+        print(f'Sealed shard {tar_filename} with {file_count} files.')
+
+        self.on_seal(prefix, tar_filename, file_count)
+
+    def close(self):
+        for prefix in list(self.open_shards.keys()):
+            self.seal(prefix)
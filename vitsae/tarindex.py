@@ -0,0 +1,135 @@
+import io
+import os
+import json
+import tarfile
+import time
+
+from PIL import Image
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.idx'
+
+def index_path(tar_path):
+    """
+    Where the index of tar_path lives, locally or in S3: right next to it.
+    """
+    return tar_path + INDEX_SUFFIX
+
+def image_info(source):
+    """
+    (width, height, status) of an image file or bytes, read from its header only.
+    """
+    try:
+        with Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source) as image:
+            width, height = image.size
+        return width, height, 'ok'
+    except Exception:
+        return None, None, 'invalid'
+
+class TarIndex:
+    """
+    Offsets of the members of a webdataset tar, stored column-wise as json
+    next to it, so a reader can seek to a sample, split a tar between workers
+    or fetch a subset of samples with S3 range requests instead of walking the
+    whole tar. Images also carry their dimensions and whether they could be
+    read, other members have no dimensions and an empty status.
+
+    Members are recorded as they are written, by adding them through add().
+    """
+    def __init__(self):
+        self.names = []
+        self.offsets = []
+        self.sizes = []
+        self.widths = []
+        self.heights = []
+        self.statuses = []
+        self.tar_size = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, tar, name, content=None, file_path=None):
+        """
+        Write content, or the file at file_path, to tar as name and record
+        where its data landed. Works for seekable and streamed tars alike.
+        """
+        if file_path is not None:
+            info = tar.gettarinfo(file_path, arcname=name)
+            with open(file_path, 'rb') as f:
+                tar.addfile(info, f)
+            source = file_path
+        else:
+            info = tarfile.TarInfo(name=name)
+            info.size = len(content)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(content))
+            source = content
+
+        # addfile leaves tar.offset at the end of the data's 512 byte padding
+        padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self.names.append(name)
+        self.offsets.append(tar.offset - padded)
+        self.sizes.append(info.size)
+
+        if name.lower().endswith('.jpg'):
+            width, height, status = image_info(source)
+        else:
+            width, height, status = None, None, ''
+        self.widths.append(width)
+        self.heights.append(height)
+        self.statuses.append(status)
+
+    def finish(self, tar_size):
+        self.tar_size = tar_size
+
+    def to_bytes(self):
+        return json.dumps({
+            'version': INDEX_VERSION,
+            'tar_size': self.tar_size,
+            'names': self.names,
+            'offsets': self.offsets,
+            'sizes': self.sizes,
+            'widths': self.widths,
+            'heights': self.heights,
+            'statuses': self.statuses,
+        }, separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def from_bytes(cls, data):
+        fields = json.loads(data)
+        index = cls()
+        index.tar_size = fields['tar_size']
+        index.names = fields['names']
+        index.offsets = fields['offsets']
+        index.sizes = fields['sizes']
+        index.widths = fields['widths']
+        index.heights = fields['heights']
+        index.statuses = fields['statuses']
+        return index
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+def build_index(tar_path):
+    """
+    Index an existing tar by reading it, for tars that weren't written through
+    a TarIndex.
+    """
+    index = TarIndex()
+    with tarfile.open(tar_path, 'r') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            index.names.append(member.name)
+            index.offsets.append(member.offset_data)
+            index.sizes.append(member.size)
+            if member.name.lower().endswith('.jpg'):
+                width, height, status = image_info(tar.extractfile(member).read())
+            else:
+                width, height, status = None, None, ''
+            index.widths.append(width)
+            index.heights.append(height)
+            index.statuses.append(status)
+    index.finish(os.path.getsize(tar_path))
+    return index
@@ -0,0 +1,132 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from aimd import AIMDController, ConcurrencyLimiter
+from generatewds import process_parquet
+from conftest import write_parquet
+
+def feed(controller, start, seconds, per_second, error_rate=0.0, timeout_rate=0.0):
+    n = int(seconds * per_second)
+    for i in range(n):
+        now = start + i / per_second
+        frac = (i % 100) / 100
+        timed_out = frac < timeout_rate
+        succeeded = frac >= error_rate + timeout_rate
+        controller.record(succeeded, timed_out, now=now)
+    return start + seconds
+
+def make_controller(**kwargs):
+    defaults = dict(initial=100, minimum=10, maximum=400, increase=20, decrease=0.5, window=10, min_samples=10, probe_after=3)
+    defaults.update(kwargs)
+    return AIMDController(**defaults)
+
+def test_increases_while_throughput_improves():
+    controller = make_controller()
+    t = feed(controller, 0, 5, 100)
+    assert controller.update(now=t) == 120  # probe from the initial limit
+
+    t = feed(controller, t, 5, 150)
+    assert controller.update(now=t) == 140
+
+    t = feed(controller, t, 5, 150)
+    assert controller.update(now=t) == 140
+    assert [h[1] for h in controller.history] == ['increase', 'increase', 'hold']
+
+def test_decreases_when_timeouts_climb():
+    controller = make_controller()
+    t = feed(controller, 0, 5, 100, error_rate=0.3, timeout_rate=0.05)
+    controller.update(now=t)
+
+    t = feed(controller, t, 5, 100, error_rate=0.3, timeout_rate=0.15)
+    assert controller.update(now=t) == 60
+    assert 'timeout rate rose' in controller.history[-1][4]
+
+def test_decreases_when_errors_climb():
+    controller = make_controller()
+    t = feed(controller, 0, 5, 100, error_rate=0.3)
+    controller.update(now=t)
+
+    t = feed(controller, t, 5, 100, error_rate=0.5)
+    assert controller.update(now=t) == 60
+
+def test_high_base_error_rate_does_not_decrease():
+    controller = make_controller()
+    t = feed(controller, 0, 5, 100, error_rate=0.6)
+    controller.update(now=t)
+    t = feed(controller, t, 5, 100, error_rate=0.6)
+    assert controller.update(now=t) == 120
+
+def test_limits_are_respected():
+    controller = make_controller(initial=395, maximum=400)
+    t = feed(controller, 0, 5, 100)
+    assert controller.update(now=t) == 400
+
+    controller = make_controller(initial=12, minimum=10)
+    t = feed(controller, 0, 5, 100, timeout_rate=0.5)
+    assert controller.update(now=t) == 10
+
+def test_probes_after_flat_windows():
+    controller = make_controller()
+    t = 0
+    limits = []
+    for _ in range(5):
+        t = feed(controller, t, 5, 100)
+        limits.append(controller.update(now=t))
+    assert limits == [120, 120, 120, 140, 140]
+
+def test_waits_for_enough_samples():
+    controller = make_controller(min_samples=1000)
+    t = feed(controller, 0, 5, 100)
+    assert controller.update(now=t) == 100
+    assert controller.history == []
+
+@pytest.mark.asyncio
+async def test_limiter_adjusts():
+    limiter = ConcurrencyLimiter(2)
+    await limiter.acquire()
+    await limiter.acquire()
+
+    blocked = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+
+    await limiter.set_limit(3)
+    await asyncio.wait_for(blocked, timeout=1)
+    assert limiter.held == 3
+
+    await limiter.set_limit(1)
+    await limiter.release()
+    await limiter.release()
+    blocked = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+    await limiter.release()
+    await asyncio.wait_for(blocked, timeout=1)
+
+def test_controller_backs_off_congested_server(tmp_path, image_server):
+    base_url, server = image_server
+    server.capacity = 4
+    urls = [f'{base_url}/{i}.jpg?delay=0.05' for i in range(400)]
+    pq_path = write_parquet(tmp_path / 'sample.parquet', urls)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+
+    controller = AIMDController(initial=32, minimum=2, maximum=40, increase=4, interval=0.2, window=1, min_samples=10)
+    process_parquet(
+        ddb_table=None,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=1000,
+        concurrency=32,
+        limit_per_host=64,
+        request_timeout=0.15,
+        concurrency_controller=controller,
+    )
+
+    decisions = [h[1] for h in controller.history]
+    assert decisions[0] == 'decrease'
+    assert min(h[3] for h in controller.history) < 32
@@ -0,0 +1,118 @@
+from batching import BatchPlanner, estimate_row_bytes, leftover_batches, remaining_row_ranges
+
+def sized(width, height=None):
+    return {'WIDTH': width, 'HEIGHT': height if height is not None else width}
+
+def run(planner, rows, start=0):
+    events = []
+    for index, row in enumerate(rows, start):
+        events += planner.add(index, row)
+    events += planner.finish()
+    return events
+
+def batches(events):
+    out = {}
+    for event in events:
+        if event[0] == 'row':
+            out.setdefault(event[1], []).append(event[2])
+    return out
+
+def test_estimate_row_bytes():
+    assert estimate_row_bytes(sized(100), bytes_per_pixel=0.5) == 5000
+    assert estimate_row_bytes(sized(1000, 500), bytes_per_pixel=1, max_side=100) == 100 * 50
+    assert estimate_row_bytes({'WIDTH': None, 'HEIGHT': 10}) is None
+    assert estimate_row_bytes({'WIDTH': float('nan'), 'HEIGHT': 10}) is None
+    assert estimate_row_bytes({}) is None
+
+def test_count_batches_keep_the_old_prefixes():
+    planner = BatchPlanner('00001', max_rows=10)
+    events = run(planner, [sized(10)] * 25)
+
+    assert list(batches(events)) == ['00001-0-10', '00001-10-20', '00001-20-30']
+    assert [e[1] for e in events if e[0] == 'close'] == ['00001-0-10', '00001-10-20', '00001-20-30']
+    # rows go out as they are read
+    assert events[:2] == [('start', '00001-0-10'), ('row', '00001-0-10', 0, sized(10))]
+
+def test_count_batches_skip_processed():
+    planner = BatchPlanner('00001', max_rows=10, already_processed={'00001-10-20', '00002-0-10'})
+    events = run(planner, [sized(10)] * 30)
+
+    assert list(batches(events)) == ['00001-0-10', '00001-20-30']
+    assert [e for e in events if e[0] == 'skip'] == [('skip', '00001-10-20')]
+
+def test_byte_batches_are_cut_at_the_target():
+    planner = BatchPlanner('00001', max_rows=100, target_bytes=1000, bytes_per_pixel=1)
+    # 10x10 rows are 100 bytes, 20x20 rows are 400
+    rows = [sized(10)] * 10 + [sized(20)] * 5 + [sized(10)] * 3
+    events = run(planner, rows)
+
+    assert list(batches(events)) == ['00001-0-10', '00001-10-13', '00001-13-17', '00001-17-117']
+    assert batches(events)['00001-17-117'] == [17]
+
+def test_byte_batches_respect_the_row_limits():
+    planner = BatchPlanner('00001', max_rows=4, min_rows=2, target_bytes=100, bytes_per_pixel=1)
+    rows = [sized(100)] * 3 + [sized(1)] * 6
+    assert list(batches(run(planner, rows))) == ['00001-0-2', '00001-2-4', '00001-4-8', '00001-8-12']
+
+def test_rows_without_a_size_count_as_the_batch_average():
+    planner = BatchPlanner('00001', max_rows=100, target_bytes=500, bytes_per_pixel=1)
+    rows = [sized(10), {'WIDTH': None, 'HEIGHT': None}, sized(10), {}, sized(10)]
+    assert list(batches(run(planner, rows))) == ['00001-0-5']
+
+def test_byte_batches_resume_on_the_same_prefixes():
+    rows = [sized(10 + i % 7) for i in range(200)]
+    first = list(batches(run(BatchPlanner('00001', max_rows=50, target_bytes=2000, bytes_per_pixel=1), rows)))
+    assert len(first) > 4
+
+    # the second and fourth batches were uploaded before the worker died
+    done = {first[1], first[3]}
+    second = list(batches(run(BatchPlanner('00001', max_rows=50, target_bytes=2000, bytes_per_pixel=1, already_processed=done), rows)))
+    assert second == [p for p in first if p not in done]
+
+def test_byte_batches_stop_short_of_processed_batches():
+    # processed with count-sized batches before the switch to bytes
+    planner = BatchPlanner('00001', max_rows=100, target_bytes=10_000, bytes_per_pixel=1, already_processed={'00001-5-10'})
+    events = run(planner, [sized(10)] * 15)
+    assert list(batches(events)) == ['00001-0-5', '00001-10-110']
+
+def test_observed_batches_leave_the_cut_points_alone():
+    planner = BatchPlanner('00001', max_rows=100, target_bytes=1000, bytes_per_pixel=1)
+    events = []
+    for index in range(10):
+        events += planner.add(index, sized(10))
+    assert list(batches(events)) == ['00001-0-10']
+
+    # the images came out at a quarter of the estimate, which is logged but not used to cut
+    assert planner.observe('00001-0-10', 250) == 0.25
+    assert planner.bytes_per_pixel == 1
+    assert list(batches(run(planner, [sized(10)] * 40, start=10))) == ['00001-10-20', '00001-20-30', '00001-30-40', '00001-40-50']
+
+    # batches that weren't cut by size, already observed or forgotten aren't logged
+    assert planner.observe('00001-0-10', 10_000) is None
+    planner.forget('00001-10-20')
+    assert planner.observe('00001-10-20', 10_000) is None
+
+def test_row_ranges_are_the_batches():
+    planner = BatchPlanner('00001', max_rows=100, target_bytes=1000, row_ranges=[(0, 3), (7, 12)])
+    events = []
+    for index in [0, 1, 2, 7, 8, 9, 10, 11]:
+        events += planner.add(index, sized(10))
+    events += planner.finish()
+    assert batches(events) == {'00001-0-3': [0, 1, 2], '00001-7-12': [7, 8, 9, 10, 11]}
+
+def test_finish_without_flush_drops_held_rows():
+    planner = BatchPlanner('00001', max_rows=100, target_bytes=10_000, bytes_per_pixel=1)
+    for index in range(5):
+        assert planner.add(index, sized(10)) == []
+    assert planner.finish(flush=False) == []
+
+def test_remaining_row_ranges():
+    processed = {'00001-0-100', '00001-100-137', '00001-300-400', '00002-137-200', 'garbage'}
+    assert remaining_row_ranges('00001', [(0, 500)], processed) == [(137, 300), (400, 500)]
+    assert remaining_row_ranges('00001', [(120, 150), (350, 450), (140, 160)], processed) == [(137, 160), (400, 450)]
+    assert remaining_row_ranges('00001', [(0, 137)], processed) == []
+    assert remaining_row_ranges('00001', [(0, 10)], set()) == [(0, 10)]
+
+def test_leftover_batches_stay_inside_the_remaining_rows():
+    assert leftover_batches([(10, 12), (50, 250), (11, 13)], 100) == [(10, 13), (50, 100), (100, 200), (200, 250)]
+    assert leftover_batches([], 100) == []
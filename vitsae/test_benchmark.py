@@ -0,0 +1,90 @@
+from benchmark import run_benchmark, FakeSQS, FakeDynamoTable, ImageServerProcess
+from counter import get_upload_count
+
+import requests
+
+def test_fake_sqs_hides_received_messages_until_given_back():
+    sqs = FakeSQS()
+    sqs.send_message(QueueUrl='q', MessageBody='a')
+    sqs.send_message(QueueUrl='q', MessageBody='b')
+
+    message = sqs.receive_message(QueueUrl='q')['Messages'][0]
+    assert message['Body'] == 'a'
+    assert sqs.bodies('q') == ['b']
+
+    sqs.change_message_visibility(QueueUrl='q', ReceiptHandle=message['ReceiptHandle'], VisibilityTimeout=0)
+    assert sqs.bodies('q') == ['a', 'b']
+
+    message = sqs.receive_message(QueueUrl='q')['Messages'][0]
+    sqs.delete_message(QueueUrl='q', ReceiptHandle=message['ReceiptHandle'])
+    assert sqs.bodies('q') == ['b']
+
+def test_fake_dynamo_table_counts_uploads():
+    table = FakeDynamoTable()
+    assert get_upload_count(table) == 0
+    for _ in range(3):
+        table.update_item(
+            Key={'parquet_id': 'counter', 'batch_id': 'counter'},
+            UpdateExpression='ADD upload_count :inc',
+            ExpressionAttributeValues={':inc': 1},
+        )
+    assert table.get_item(Key={'parquet_id': 'counter', 'batch_id': 'counter'})['Item']['upload_count'] == 3
+
+def test_image_server_profile_is_deterministic_per_url():
+    with ImageServerProcess(num_hosts=2, error_rate=0.5, seed=1) as servers:
+        assert len(servers.base_urls) == 2
+        urls = [f'{servers.base_urls[0]}/{i}.jpg' for i in range(20)]
+        first = [requests.get(url).status_code for url in urls]
+        second = [requests.get(url).status_code for url in urls]
+
+    assert first == second
+    assert 200 in first and any(status != 200 for status in first)
+
+def test_benchmark_throughput_regression():
+    results = run_benchmark(
+        num_rows=1200,
+        num_hosts=4,
+        max_images_per_tar=300,
+        min_images_per_tar=50,
+        latency=0.01,
+        latency_jitter=0.01,
+        error_rate=0.1,
+    )
+
+    assert 0.8 * 1200 < results['images'] < 1200
+    assert results['tars'] == 4
+    assert results['tar_bytes'] > 0
+    assert results['cpu_seconds'] > 0
+    assert results['max_rss_mb'] > 0
+    # generous floor, a healthy run on a laptop manages several hundred images/s
+    assert results['images_per_second'] > 50
+
+def test_benchmark_with_shard_writer():
+    results = run_benchmark(
+        num_rows=600,
+        num_hosts=2,
+        max_images_per_tar=300,
+        min_images_per_tar=50,
+        latency=0.0,
+        latency_jitter=0.0,
+        error_rate=0.0,
+        write_shards=True,
+    )
+
+    assert results['images'] == 600
+    assert results['tars'] == 2
+
+def test_benchmark_with_streamed_uploads():
+    results = run_benchmark(
+        num_rows=600,
+        num_hosts=2,
+        max_images_per_tar=300,
+        min_images_per_tar=50,
+        latency=0.0,
+        latency_jitter=0.0,
+        error_rate=0.0,
+        stream_uploads=True,
+    )
+
+    assert results['images'] == 600
+    assert results['tars'] == 2
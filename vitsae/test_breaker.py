@@ -0,0 +1,52 @@
+from breaker import DomainBreakers, CLOSED, OPEN, HALF_OPEN
+from conftest import FakeS3
+
+def trip(breakers, domain, now=0):
+    for _ in range(breakers.failure_threshold):
+        breakers.record(domain, False, now=now)
+
+def test_opens_after_consecutive_failures():
+    breakers = DomainBreakers(failure_threshold=3, cooldown=10)
+    breakers.record('a.com', False, now=0)
+    breakers.record('a.com', False, now=0)
+    breakers.record('a.com', True, now=0)
+    breakers.record('a.com', False, now=0)
+    assert breakers.state('a.com', now=0) == CLOSED
+
+    trip(breakers, 'a.com')
+    assert breakers.state('a.com', now=1) == OPEN
+    assert not breakers.allow('a.com', now=1)
+    assert breakers.allow('b.com', now=1)
+
+def test_half_open_probe_closes_on_success():
+    breakers = DomainBreakers(failure_threshold=2, cooldown=10)
+    trip(breakers, 'a.com')
+
+    assert breakers.state('a.com', now=11) == HALF_OPEN
+    assert breakers.allow('a.com', now=11)
+    # only one probe at a time
+    assert not breakers.allow('a.com', now=11)
+
+    breakers.record('a.com', True, now=12)
+    assert breakers.state('a.com', now=12) == CLOSED
+    assert 'a.com' not in breakers.domains
+
+def test_failed_probe_doubles_cooldown():
+    breakers = DomainBreakers(failure_threshold=2, cooldown=10, max_cooldown=15)
+    trip(breakers, 'a.com')
+
+    assert breakers.allow('a.com', now=11)
+    breakers.record('a.com', False, now=11)
+    assert breakers.state('a.com', now=20) == OPEN
+    assert breakers.state('a.com', now=26) == HALF_OPEN
+
+def test_state_is_shared_through_s3():
+    s3 = FakeS3()
+    node_a = DomainBreakers(failure_threshold=1, cooldown=100)
+    node_a.record('dead.com', False, now=0)
+    node_a.save(s3, 'bucket', 'breakers', node_id='a')
+
+    node_b = DomainBreakers()
+    node_b.load(s3, 'bucket', 'breakers')
+    assert node_b.is_open('dead.com', now=50)
+    assert not node_b.is_open('dead.com', now=150)
@@ -0,0 +1,154 @@
+import os
+
+from checkpoint import RowBitmap, CheckpointingSink, parse_prefix
+from generatewds import process_parquet
+from shards import FileSink
+from conftest import FakeS3, make_jpeg, write_parquet
+
+def test_parse_prefix():
+    assert parse_prefix('00001-30000-60000') == ('00001', 30000, 60000)
+
+def test_row_bitmap():
+    bitmap = RowBitmap(100, 120)
+    bitmap.mark(100)
+    bitmap.mark(119)
+    assert 100 in bitmap and 119 in bitmap
+    assert 101 not in bitmap and 120 not in bitmap and 99 not in bitmap
+
+    restored = RowBitmap.from_bytes(bitmap.to_bytes())
+    assert restored.count() == 2
+    assert (restored.start, restored.end) == (100, 120)
+    assert 119 in restored
+
+def test_restore_only_what_was_checkpointed(tmp_path):
+    s3 = FakeS3()
+    first_dir, second_dir = tmp_path / 'first', tmp_path / 'second'
+    first_dir.mkdir()
+    second_dir.mkdir()
+
+    checkpoints = CheckpointingSink(FileSink(str(first_dir)), s3, 'bucket', 'ckpt', str(first_dir))
+    checkpoints.write('00001-0-10', 0, make_jpeg(), {'URL': 'a'})
+    checkpoints.mark('00001-0-10', 1)
+    checkpoints.write('00001-0-10', 2, make_jpeg(), {'URL': 'c'})
+    checkpoints.checkpoint()
+    checkpoints.write('00001-0-10', 3, make_jpeg(), {'URL': 'd'})
+    assert sorted(s3.objects) == ['ckpt/00001-0-10/bitmap', 'ckpt/00001-0-10/part-00000.tar']
+
+    # a new worker picks the batch up
+    resumed = CheckpointingSink(FileSink(str(second_dir)), s3, 'bucket', 'ckpt', str(second_dir))
+    bitmap = resumed.restore('00001-0-10')
+    assert [i for i in range(10) if i in bitmap] == [0, 1, 2]
+    assert sorted(os.listdir(second_dir)) == ['00001-0-10--0.jpg', '00001-0-10--0.json', '00001-0-10--2.jpg', '00001-0-10--2.json']
+
+    # later checkpoints add parts rather than replacing the restored ones
+    resumed.write('00001-0-10', 3, make_jpeg(), {'URL': 'd'})
+    resumed.checkpoint()
+    assert 'ckpt/00001-0-10/part-00001.tar' in s3.objects
+    assert RowBitmap.from_bytes(s3.objects['ckpt/00001-0-10/bitmap']).count() == 4
+
+def test_checkpoint_is_kept_until_the_batch_is_uploaded(tmp_path):
+    s3 = FakeS3()
+    sealed = []
+    checkpoints = CheckpointingSink(FileSink(str(tmp_path), on_seal=sealed.append), s3, 'bucket', 'ckpt', str(tmp_path))
+    checkpoints.write('00001-0-10', 0, make_jpeg(), {})
+    checkpoints.checkpoint()
+    checkpoints.write('00001-0-10', 1, make_jpeg(), {})
+    checkpoints.seal('00001-0-10')
+
+    # the tar isn't uploaded yet, so the rest of the batch still goes to S3
+    assert sealed == ['00001-0-10']
+    checkpoints.checkpoint()
+    assert sorted(s3.objects) == ['ckpt/00001-0-10/bitmap', 'ckpt/00001-0-10/part-00000.tar', 'ckpt/00001-0-10/part-00001.tar']
+
+    checkpoints.write('00001-0-10', 2, make_jpeg(), {})
+    checkpoints.uploaded('00001-0-10')
+    assert s3.objects == {}
+    assert not any('.checkpoint.' in f for f in os.listdir(tmp_path))
+
+    checkpoints.checkpoint()
+    assert s3.objects == {}
+
+def test_failed_part_is_retried_before_the_bitmap(tmp_path):
+    s3 = FakeS3()
+    upload_file = s3.upload_file
+    failures = [IOError('connection reset')]
+    def flaky_upload(filename, bucket, key):
+        if failures:
+            raise failures.pop()
+        upload_file(filename, bucket, key)
+    s3.upload_file = flaky_upload
+
+    checkpoints = CheckpointingSink(FileSink(str(tmp_path)), s3, 'bucket', 'ckpt', str(tmp_path))
+    checkpoints.write('00001-0-10', 0, make_jpeg(), {})
+    checkpoints.checkpoint()
+    assert s3.objects == {}
+    assert checkpoints.bitmaps['00001-0-10'].num_parts == 0
+    assert len([f for f in os.listdir(tmp_path) if f.endswith('.part')]) == 1
+
+    # the kept part goes first, then the one written since
+    checkpoints.write('00001-0-10', 1, make_jpeg(), {})
+    checkpoints.checkpoint()
+    assert sorted(s3.objects) == ['ckpt/00001-0-10/bitmap', 'ckpt/00001-0-10/part-00000.tar', 'ckpt/00001-0-10/part-00001.tar']
+    assert not any(f.endswith('.part') for f in os.listdir(tmp_path))
+
+    (tmp_path / 'resumed').mkdir()
+    bitmap = CheckpointingSink(FileSink(str(tmp_path / 'resumed')), s3, 'bucket', 'ckpt', str(tmp_path)).restore('00001-0-10')
+    assert len(os.listdir(tmp_path / 'resumed')) == 4
+    assert bitmap.num_parts == 2
+    assert [i for i in range(10) if i in bitmap] == [0, 1]
+
+def test_restore_checks_every_part_first(tmp_path):
+    s3 = FakeS3()
+    (tmp_path / 'first').mkdir()
+    (tmp_path / 'resumed').mkdir()
+    checkpoints = CheckpointingSink(FileSink(str(tmp_path / 'first')), s3, 'bucket', 'ckpt', str(tmp_path))
+    for i in range(2):
+        checkpoints.write('00001-0-10', i, make_jpeg(), {})
+        checkpoints.checkpoint()
+    del s3.objects['ckpt/00001-0-10/part-00001.tar']
+
+    resumed_dir = tmp_path / 'resumed'
+    resumed = CheckpointingSink(FileSink(str(resumed_dir)), s3, 'bucket', 'ckpt', str(tmp_path))
+    assert resumed.restore('00001-0-10') is None
+    assert os.listdir(resumed_dir) == []
+    assert not any(f.endswith('.restore') for f in os.listdir(tmp_path))
+
+def test_restore_missing_checkpoint(tmp_path):
+    checkpoints = CheckpointingSink(FileSink(str(tmp_path)), FakeS3(), 'bucket', 'ckpt', str(tmp_path))
+    assert checkpoints.restore('00001-0-10') is None
+
+def test_process_parquet_resumes_from_checkpoint(tmp_path, image_server):
+    base_url, server = image_server
+    urls = [f'{base_url}/{i}.jpg' for i in range(10)]
+    pq_path = write_parquet(tmp_path / 'sample.parquet', urls)
+    first_dir, second_dir = tmp_path / 'first', tmp_path / 'second'
+    first_dir.mkdir()
+    second_dir.mkdir()
+    s3 = FakeS3()
+
+    # the interrupted worker got through the first half of the batch
+    interrupted = CheckpointingSink(FileSink(str(first_dir)), s3, 'bucket', 'ckpt', str(first_dir))
+    for i in range(5):
+        interrupted.write('00001-0-10', i, make_jpeg(), {'URL': urls[i]})
+    interrupted.checkpoint()
+
+    sealed = []
+    checkpoints = CheckpointingSink(FileSink(str(second_dir), on_seal=sealed.append), s3, 'bucket', 'ckpt', str(second_dir))
+    stats = process_parquet(
+        ddb_table=None,
+        base_dir=str(second_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=10,
+        concurrency=4,
+        checkpoints=checkpoints,
+    )
+
+    assert server.request_count == 5
+    assert stats['resumed'] == 5
+    assert stats['succeeded'] == 5
+    assert len([f for f in os.listdir(second_dir) if f.endswith('.jpg')]) == 10
+    assert sealed == ['00001-0-10']
+    checkpoints.uploaded('00001-0-10')
+    assert s3.objects == {}
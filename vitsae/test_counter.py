@@ -0,0 +1,66 @@
+import time
+from decimal import Decimal
+from unittest.mock import MagicMock
+
+from counter import UploadCounter, get_upload_count
+
+def make_table(count):
+    table = MagicMock()
+    table.get_item.return_value = {'Item': {'upload_count': Decimal(count)}}
+    return table
+
+def test_get_upload_count_missing_item():
+    table = MagicMock()
+    table.get_item.return_value = {}
+    assert get_upload_count(table) == 0
+
+def test_get_upload_count_failure():
+    table = MagicMock()
+    table.get_item.side_effect = Exception('boom')
+    assert get_upload_count(table) is None
+
+def test_value_does_no_io():
+    table = make_table(7)
+    counter = UploadCounter(table)
+    counter.refresh()
+    assert counter.value == 7
+
+    for _ in range(10):
+        assert counter.value == 7
+    assert table.get_item.call_count == 1
+
+def test_increment_is_local_and_not_undone_by_stale_reads():
+    table = make_table(7)
+    counter = UploadCounter(table)
+    counter.refresh()
+    counter.increment()
+    assert counter.value == 8
+
+    counter.refresh()
+    assert counter.value == 8
+
+    table.get_item.return_value = {'Item': {'upload_count': Decimal(12)}}
+    counter.refresh()
+    assert counter.value == 12
+
+def test_failed_refresh_keeps_cached_value():
+    table = make_table(5)
+    counter = UploadCounter(table)
+    counter.refresh()
+    table.get_item.side_effect = Exception('throttled')
+    counter.refresh()
+    assert counter.value == 5
+
+def test_background_refresh():
+    table = make_table(1)
+    counter = UploadCounter(table, refresh_interval=0.01)
+    counter.start()
+    assert counter.value == 1
+
+    table.get_item.return_value = {'Item': {'upload_count': Decimal(3)}}
+    deadline = time.time() + 2
+    while counter.value != 3 and time.time() < deadline:
+        time.sleep(0.01)
+    counter.stop()
+
+    assert counter.value == 3
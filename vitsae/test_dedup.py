@@ -0,0 +1,107 @@
+from dedup import BloomFilter, DedupIndex
+from conftest import FakeS3
+
+def test_bloom_filter_add_and_contains():
+    bloom = BloomFilter.for_capacity(1000, error_rate=0.01)
+    assert bloom.add(b'a')
+    assert not bloom.add(b'a')
+    assert b'a' in bloom
+    assert b'b' not in bloom
+
+def test_bloom_filter_error_rate():
+    bloom = BloomFilter.for_capacity(5000, error_rate=0.01)
+    for i in range(5000):
+        bloom.add(f'in-{i}'.encode())
+    false_positives = sum(f'out-{i}'.encode() in bloom for i in range(5000))
+    assert false_positives < 5000 * 0.03
+
+def test_bloom_filter_round_trip_and_merge():
+    a = BloomFilter.for_capacity(100)
+    b = BloomFilter.for_capacity(100)
+    a.add(b'x')
+    b.add(b'y')
+
+    restored = BloomFilter.from_bytes(a.to_bytes())
+    assert b'x' in restored
+    restored.merge(b)
+    assert b'x' in restored and b'y' in restored
+
+def test_dedup_index_hash_and_content():
+    index = DedupIndex(num_shards=4, capacity=1000)
+    assert not index.seen_hash(123)
+    index.add_hash(123)
+    assert index.seen_hash(123)
+
+    assert index.add_content(b'image bytes')
+    assert not index.add_content(b'image bytes')
+    assert index.add_content(b'other bytes')
+
+def test_dedup_index_stages_keys_until_the_batch_is_uploaded():
+    index = DedupIndex(num_shards=4, capacity=1000)
+    index.add_hash(7, '00001-0-10', 3)
+    assert index.add_content(b'image', '00001-0-10', 3)
+
+    # another row is a duplicate, a retry of the same row isn't
+    assert index.seen_hash(7, '00001-10-20', 12)
+    assert not index.add_content(b'image', '00001-10-20', 12)
+    assert not index.seen_hash(7, '00001-0-10', 3)
+    assert index.add_content(b'image', '00001-0-10', 3)
+
+    # a batch that isn't uploaded is forgotten
+    index.discard('00001-0-10')
+    assert not index.seen_hash(7)
+    assert index.add_content(b'image', '00001-0-10', 3)
+
+    index.commit('00001-0-10')
+    assert index.staged == {}
+    assert not index.add_content(b'image', '00001-0-10', 3)
+
+def test_dedup_index_discards_a_single_row():
+    index = DedupIndex(num_shards=4, capacity=1000)
+    index.add_hash(1, 'a', 0)
+    index.add_hash(2, 'a', 1)
+    index.discard('a', 1)
+    index.commit('a')
+    assert index.seen_hash(1)
+    assert not index.seen_hash(2)
+
+def test_dedup_index_nodes_share_one_copy_in_s3():
+    s3 = FakeS3()
+
+    node_a = DedupIndex(num_shards=4, capacity=1000)
+    node_a.add_hash(1)
+    node_a.save(s3, 'bucket', 'dedup')
+
+    node_b = DedupIndex(num_shards=4, capacity=1000)
+    node_b.add_hash(2)
+    node_b.save(s3, 'bucket', 'dedup')
+
+    # node b merged node a's shards before overwriting them
+    assert sorted(s3.objects) == [f'dedup/shard-{i:04d}.bloom' for i in range(4)]
+    node_a.save(s3, 'bucket', 'dedup')
+    assert node_a.seen_hash(2)
+
+    fresh = DedupIndex(num_shards=4, capacity=1000)
+    assert fresh.load(s3, 'bucket', 'dedup') == 4
+    assert fresh.seen_hash(1) and fresh.seen_hash(2)
+    assert not fresh.seen_hash(3)
+
+def test_dedup_index_folds_in_per_node_copies():
+    s3 = FakeS3()
+    for node_id, row_hash in [('host-a', 1), ('host-b', 2)]:
+        node = DedupIndex(num_shards=4, capacity=1000)
+        node.add_hash(row_hash)
+        for i, shard in enumerate(node.shards):
+            s3.objects[f'dedup/{node_id}/shard-{i:04d}.bloom'] = shard.to_bytes()
+
+    index = DedupIndex(num_shards=4, capacity=1000)
+    assert index.load(s3, 'bucket', 'dedup') == 8
+    assert index.seen_hash(1) and index.seen_hash(2)
+
+    index.add_hash(3)
+    index.save(s3, 'bucket', 'dedup')
+    assert sorted(s3.objects) == [f'dedup/shard-{i:04d}.bloom' for i in range(4)]
+
+    fresh = DedupIndex(num_shards=4, capacity=1000)
+    assert fresh.load(s3, 'bucket', 'dedup') == 4
+    assert all(fresh.seen_hash(h) for h in [1, 2, 3])
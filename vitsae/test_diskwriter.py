@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from diskwriter import DiskWriter
+
+class SlowSink:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.events = []
+        self.lock = threading.Lock()
+
+    def write(self, prefix, index, image_content, metadata):
+        time.sleep(self.delay)
+        with self.lock:
+            self.events.append(('write', prefix, index))
+
+    def seal(self, prefix):
+        with self.lock:
+            self.events.append(('seal', prefix))
+
+@pytest.mark.asyncio
+async def test_seal_waits_for_pending_writes():
+    sink = SlowSink(delay=0.02)
+    writer = DiskWriter(sink, num_threads=4)
+    for i in range(20):
+        await writer.write('a', i, b'x', {})
+    writer.seal('a')
+    await asyncio.to_thread(writer.close)
+
+    assert sink.events[-1] == ('seal', 'a')
+    assert sorted(e[2] for e in sink.events[:-1]) == list(range(20))
+    assert writer.stats['writes'] == 20
+    assert writer.stats['write_seconds'] > 0
+
+@pytest.mark.asyncio
+async def test_backpressure_when_disk_falls_behind():
+    sink = SlowSink(delay=0.05)
+    writer = DiskWriter(sink, num_threads=1, max_pending=2, batch_size=1)
+
+    start = time.time()
+    for i in range(6):
+        await writer.write('a', i, b'x', {})
+    # only two writes can be outstanding, so the caller waited for the disk
+    assert time.time() - start >= 0.15
+    assert writer.stats['wait_seconds'] > 0.1
+    await asyncio.to_thread(writer.close)
+
+@pytest.mark.asyncio
+async def test_write_does_not_block_the_loop():
+    sink = SlowSink(delay=0.2)
+    writer = DiskWriter(sink, num_threads=1)
+
+    start = time.time()
+    await writer.write('a', 0, b'x', {})
+    await asyncio.sleep(0)
+    assert time.time() - start < 0.1
+    await asyncio.to_thread(writer.close)
+    assert sink.events == [('write', 'a', 0)]
+
+@pytest.mark.asyncio
+async def test_failed_writes_are_counted():
+    class FailingSink(SlowSink):
+        def write(self, prefix, index, image_content, metadata):
+            raise OSError('disk full')
+
+    sink = FailingSink()
+    writer = DiskWriter(sink, num_threads=2)
+    await writer.write('a', 0, b'x', {})
+    writer.seal('a')
+    await asyncio.to_thread(writer.close)
+
+    assert writer.stats['failed'] == 1
+    assert sink.events == [('seal', 'a')]
+
+@pytest.mark.asyncio
+async def test_on_written_reports_each_write_once_it_finishes():
+    class OddFailingSink(SlowSink):
+        def write(self, prefix, index, image_content, metadata):
+            if index % 2:
+                raise OSError('disk full')
+            super().write(prefix, index, image_content, metadata)
+
+    written = []
+    writer = DiskWriter(OddFailingSink(delay=0.01), num_threads=2, on_written=lambda *args: written.append(args))
+    for i in range(4):
+        await writer.write('a', i, b'x', {})
+    assert written == []
+    await asyncio.to_thread(writer.close)
+    await asyncio.sleep(0)
+
+    assert sorted(written) == [('a', 0, True), ('a', 1, False), ('a', 2, True), ('a', 3, False)]
@@ -0,0 +1,129 @@
+import asyncio
+import pytest
+
+from dispatch import DomainDispatcher, get_domain
+
+def test_get_domain():
+    assert get_domain('https://cdn.example.com/a/b.jpg?x=1') == 'cdn.example.com'
+    assert get_domain('http://EXAMPLE.com:8080/') == 'example.com'
+    assert get_domain('') == ''
+    assert get_domain('http://[::1') == ''
+
+@pytest.mark.asyncio
+async def test_round_robin_across_domains():
+    dispatcher = DomainDispatcher(max_pending=100, per_domain_limit=100)
+    for i in range(3):
+        await dispatcher.put('a.com', f'a{i}')
+    for i in range(3):
+        await dispatcher.put('b.com', f'b{i}')
+    await dispatcher.put('c.com', 'c0')
+
+    order = []
+    for _ in range(7):
+        domain, item = await dispatcher.get()
+        order.append(item)
+
+    assert order == ['a0', 'b0', 'c0', 'a1', 'b1', 'a2', 'b2']
+
+@pytest.mark.asyncio
+async def test_per_domain_limit():
+    dispatcher = DomainDispatcher(max_pending=100, per_domain_limit=2)
+    for i in range(5):
+        await dispatcher.put('slow.com', f's{i}')
+    await dispatcher.put('fast.com', 'f0')
+
+    taken = [await dispatcher.get() for _ in range(3)]
+    assert [d for d, _ in taken].count('slow.com') == 2
+    assert dispatcher.in_flight['slow.com'] == 2
+
+    # slow.com is at its limit so nothing else is ready
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(dispatcher.get(), timeout=0.05)
+
+    await dispatcher.done('slow.com', succeeded=False)
+    domain, item = await asyncio.wait_for(dispatcher.get(), timeout=1)
+    assert domain == 'slow.com'
+    assert dispatcher.domain_stats['slow.com']['failed'] == 1
+    assert dispatcher.domain_stats['slow.com']['scheduled'] == 3
+
+@pytest.mark.asyncio
+async def test_put_blocks_when_full():
+    dispatcher = DomainDispatcher(max_pending=2)
+    await dispatcher.put('a.com', 1)
+    await dispatcher.put('b.com', 2)
+
+    put = asyncio.create_task(dispatcher.put('c.com', 3))
+    await asyncio.sleep(0.01)
+    assert not put.done()
+
+    await dispatcher.get()
+    await asyncio.wait_for(put, timeout=1)
+    assert dispatcher.qsize() == 2
+
+@pytest.mark.asyncio
+async def test_close_releases_all_workers():
+    dispatcher = DomainDispatcher(max_pending=10)
+    results = []
+
+    async def worker():
+        while True:
+            item = await dispatcher.get()
+            if item is None:
+                return
+            results.append(item[1])
+            await dispatcher.done(item[0], succeeded=True)
+
+    workers = [asyncio.create_task(worker()) for _ in range(5)]
+    for i in range(8):
+        await dispatcher.put(f'{i % 3}.com', i)
+    await dispatcher.close()
+
+    await asyncio.wait_for(asyncio.gather(*workers), timeout=1)
+    assert sorted(results) == list(range(8))
+    assert dispatcher.total_in_flight() == 0
+
+@pytest.mark.asyncio
+async def test_clear_drops_queued_rows_only():
+    dispatcher = DomainDispatcher(max_pending=4, per_domain_limit=1)
+    for i in range(3):
+        await dispatcher.put('a.com', i)
+    await dispatcher.put('b.com', 3)
+    domain, item = await dispatcher.get()
+
+    dropped = await dispatcher.clear()
+
+    assert item == 0
+    assert sorted(dropped) == [1, 2, 3]
+    assert dispatcher.qsize() == 0
+    assert dispatcher.in_flight['a.com'] == 1
+
+    # the worker holding a row finishes it, then every worker is released
+    await dispatcher.close()
+    await dispatcher.done(domain, succeeded=True)
+    assert await asyncio.wait_for(dispatcher.get(), timeout=1) is None
+
+@pytest.mark.asyncio
+async def test_busy_domain_is_held_back_instead_of_filling_the_dispatcher():
+    dispatcher = DomainDispatcher(max_pending=4, per_domain_limit=1, max_queued_per_domain=2, max_held=3)
+    for i in range(5):
+        await dispatcher.put('slow.com', f's{i}')
+    # slow.com has 2 rows counted and 3 held, so other domains still get in
+    await asyncio.wait_for(dispatcher.put('a.com', 'a0'), timeout=1)
+    await asyncio.wait_for(dispatcher.put('b.com', 'b0'), timeout=1)
+    assert dispatcher.qsize() == 7
+
+    # the held budget is used up
+    put = asyncio.create_task(dispatcher.put('slow.com', 's5'))
+    await asyncio.sleep(0.01)
+    assert not put.done()
+
+    taken = [await dispatcher.get() for _ in range(3)]
+    assert sorted(item for _, item in taken) == ['a0', 'b0', 's0']
+    # a held slow.com row moved up in place of s0
+    await asyncio.wait_for(put, timeout=1)
+    assert dispatcher.qsize() == 5
+
+    await dispatcher.close()
+    dropped = await dispatcher.clear()
+    assert dropped == ['s1', 's2', 's3', 's4', 's5']
+    assert dispatcher.qsize() == 0
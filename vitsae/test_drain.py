@@ -0,0 +1,239 @@
+import io
+import os
+import json
+import time
+import tarfile
+import threading
+from unittest.mock import MagicMock
+
+from generatewds import process_parquet, run_message_loop, finish_drain, get_already_processed_batches
+from batching import remaining_row_ranges
+from uploadwds import TarMaker, row_index
+from shards import FileSink
+from drain import Drain, parse_message_body, make_message_body
+from conftest import write_parquet, FakeS3
+from benchmark import FakeSQS, FakeDynamoTable
+
+def test_message_bodies():
+    assert parse_message_body('https://hf.co/a/0001.parquet') == ('https://hf.co/a/0001.parquet', None)
+    body = make_message_body('https://hf.co/a/0001.parquet', [(37, 100), (200, 300)])
+    assert parse_message_body(body) == ('https://hf.co/a/0001.parquet', [(37, 100), (200, 300)])
+
+def test_drain_timings():
+    drain = Drain(timeout=90)
+    assert drain.time_left() == 90
+    drain.start()
+    assert drain.draining()
+    drain.mark('stopped')
+    drain.mark('uploaded')
+
+    assert list(drain.report()) == ['stopped', 'uploaded']
+    assert 89 < drain.time_left() <= 90
+
+def drain_after(drain_event, images):
+    """
+    A FileSink on_write that sets drain_event once images images have been written.
+    """
+    written = []
+    def on_write(prefix, paths, size):
+        written.append(prefix)
+        if len(written) == images:
+            drain_event.set()
+    return on_write
+
+def test_process_parquet_drain_seals_partial_batch(tmp_path, image_server):
+    base_url, server = image_server
+    server.latency = 0.02
+    pq_path = write_parquet(tmp_path / 'sample.parquet', [f'{base_url}/{i}.jpg' for i in range(200)])
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+    drain_event = threading.Event()
+    sealed, partials = [], []
+
+    stats = process_parquet(
+        ddb_table=None,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=100,
+        min_images_per_tar=10,
+        concurrency=4,
+        sink=FileSink(str(image_dir), on_seal=sealed.append, on_write=drain_after(drain_event, 20)),
+        drain_event=drain_event,
+        on_partial=lambda prefix, partial_prefix: partials.append((prefix, partial_prefix)),
+    )
+
+    # only the first batch was started, it is sealed under the rows it got to
+    assert sealed == ['00001-0-100']
+    assert len(partials) == 1
+    prefix, partial_prefix = partials[0]
+    end = int(partial_prefix.split('-')[-1])
+    assert prefix == '00001-0-100'
+    assert partial_prefix.startswith('00001-0-')
+    assert 20 <= end < 100
+    assert stats['partial'] == 1
+    assert stats['completed'] + stats['dropped'] < 100
+    assert server.request_count < 100
+
+    # every row of the partial shard's range has its image, rows past it may have been done too
+    indices = {row_index(f) for f in os.listdir(image_dir)}
+    assert set(range(0, end)) <= indices
+
+def test_process_parquet_drain_without_uploader_leaves_batch_unsealed(tmp_path, image_server):
+    base_url, server = image_server
+    pq_path = write_parquet(tmp_path / 'sample.parquet', [f'{base_url}/{i}.jpg' for i in range(50)])
+    drain_event = threading.Event()
+    drain_event.set()
+    sealed = []
+
+    stats = process_parquet(
+        ddb_table=None,
+        base_dir=str(tmp_path),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=100,
+        sink=FileSink(str(tmp_path), on_seal=sealed.append),
+        drain_event=drain_event,
+    )
+
+    assert stats['completed'] == 0
+    assert sealed == []
+
+def make_uploader(image_dir, s3, ddb_table, sqs):
+    uploader = TarMaker(
+        watch_dir=str(image_dir),
+        min_images_per_tar=40,
+        s3_client=s3,
+        s3_bucket_name='bucket',
+        s3_prefix='wds',
+        ddb_table=ddb_table,
+        sqs_client=sqs,
+        tar_queue_url='tars',
+        min_images_per_partial=4,
+    )
+    monitor = threading.Thread(target=uploader.keep_monitoring, args=(0.1,))
+    monitor.start()
+    return uploader, monitor
+
+def tar_rows(s3):
+    rows = []
+    for key, data in s3.objects.items():
+        if key.endswith('.tar'):
+            with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+                rows += [row_index(name) for name in tar.getnames() if name.endswith('.jpg')]
+    return sorted(rows)
+
+def test_interruption_drains_parquet_and_requeues_remaining_rows(tmp_path, image_server):
+    base_url, server = image_server
+    server.latency = 0.05
+    pq_path = write_parquet(tmp_path / 'sample.parquet', [f'{base_url}/{i}.jpg' for i in range(400)])
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+    url = 'https://huggingface.co/datasets/laion/part-00001.parquet'
+
+    sqs = FakeSQS()
+    sqs.send_message(QueueUrl='parquets', MessageBody=url)
+    s3 = FakeS3()
+    ddb_table = FakeDynamoTable()
+    uploader, monitor = make_uploader(image_dir, s3, ddb_table, sqs)
+
+    # the spot notice arrives once some images are on disk, the listener picks it up on its next poll
+    interrupted = threading.Event()
+    drain = Drain(timeout=60)
+    stats = {}
+
+    def handle(pq_id, pq_path, row_ranges):
+        stats.update(process_parquet(
+            ddb_table=None,
+            base_dir=str(image_dir),
+            pq_path=pq_path,
+            pq_id=pq_id,
+            already_processed=get_already_processed_batches(ddb_table, pq_id),
+            max_images_per_tar=200,
+            min_images_per_tar=40,
+            concurrency=4,
+            sink=FileSink(str(image_dir), on_seal=uploader.batch_complete, on_write=uploader.files_written),
+            upload_counter=MagicMock(value=0),
+            drain_event=drain.event,
+            on_partial=uploader.mark_partial,
+            remaining_rows=row_ranges,
+        ))
+        if drain.draining():
+            finish_drain(drain, uploader, ddb_table, pq_id, pq_path, row_ranges)
+            return False
+        return True
+
+    on_write = uploader.files_written
+    def files_written(prefix, paths, size=0):
+        on_write(prefix, paths, size)
+        if len(uploader.indexed_files(prefix)) >= 20:
+            interrupted.set()
+    uploader.files_written = files_written
+
+    run_message_loop(
+        sqs, 'parquets', lambda body: ('00001', pq_path, parse_message_body(body)[1]), handle,
+        wait_time=1, initial_wait_time=0, interrupt_fn=interrupted.is_set, drain=drain
+    )
+    monitor.join()
+    assert stats['dropped'] > 0
+
+    # the batch the notice landed in is in S3 and DynamoDB under the rows it finished, up to the first dropped row
+    partial = [item for item in ddb_table.items.values() if item.get('partial')]
+    assert len(partial) == 1
+    start, end = map(int, partial[0]['batch_id'].split('-'))
+    assert start % 200 == 0 and start < end < start + 200
+    assert f'wds/00001-{start}-{end}.tar' in s3.objects
+    assert sqs.bodies('tars')[-1] == f's3://bucket/wds/00001-{start}-{end}.tar'
+    recorded = sorted(i for pq_id, batch_id in ddb_table.items if pq_id == '00001' for i in range(*map(int, batch_id.split('-'))))
+    assert tar_rows(s3) == recorded
+
+    # the parquet message is replaced by one for the rows that are left
+    assert sqs.in_flight == {}
+    [body] = sqs.bodies('parquets')
+    remaining = remaining_row_ranges('00001', [(0, 400)], get_already_processed_batches(ddb_table, '00001'))
+    assert json.loads(body) == {'url': url, 'row_ranges': [list(r) for r in remaining]}
+
+    assert list(drain.timings) == ['stopped', 'uploaded', 'requeued']
+    assert drain.timings['requeued'] < drain.timeout
+
+    # a replacement worker picks the message up and gets every row that is left, however few
+    uploader, monitor = make_uploader(image_dir, s3, ddb_table, sqs)
+    interrupted.clear()
+    drain = Drain(timeout=60)
+    run_message_loop(
+        sqs, 'parquets', lambda body: ('00001', pq_path, parse_message_body(body)[1]), handle,
+        wait_time=1, initial_wait_time=0, interrupt_fn=lambda: False, drain=drain
+    )
+    uploader.finalize(timeout=10)
+    monitor.join()
+
+    assert tar_rows(s3) == list(range(400))
+    assert remaining_row_ranges('00001', [(0, 400)], get_already_processed_batches(ddb_table, '00001')) == []
+    assert sqs.bodies('parquets') == [] and sqs.in_flight == {}
+
+def test_drain_out_of_time_leaves_the_whole_message_queued(tmp_path):
+    url = 'https://huggingface.co/datasets/laion/part-00001.parquet'
+    sqs = FakeSQS()
+    sqs.send_message(QueueUrl='parquets', MessageBody=url)
+    interrupted = threading.Event()
+    # no time at all, so the handler puts the message back as soon as the notice arrives
+    drain = Drain(timeout=0)
+
+    def handle(pq_id, pq_path, row_ranges):
+        interrupted.set()
+        while not sqs.bodies('parquets'):
+            time.sleep(0.05)
+        drain.remaining = [(10, 400)]
+        return False
+
+    run_message_loop(
+        sqs, 'parquets', lambda body: ('00001', str(tmp_path / 'a.parquet'), None), handle,
+        wait_time=1, initial_wait_time=0, interrupt_fn=interrupted.is_set, drain=drain,
+        release_parquet=lambda *args: None
+    )
+
+    # put back once, as it was, rather than also as the rows that were left
+    assert sqs.bodies('parquets') == [url]
+    assert 'requeued' not in drain.timings
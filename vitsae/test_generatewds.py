@@ -1,4 +1,21 @@
-from generatewds import iterate_parquet_rows
+import os
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from PIL import Image
+
+from generatewds import iterate_parquet_rows, iterate_parquet_records, process_parquet, process_parquet_multiprocess, batch_row_ranges, plan_row_ranges, run_message_loop, remove_parquet
+from shards import FileSink
+from dedup import DedupIndex
+from breaker import DomainBreakers
+from hedge import HedgePolicy
+from imageproc import ImageProcessor
+from metrics import REGISTRY
+from conftest import write_parquet, make_jpeg
+from constants import METADATA_COLUMNS
 
 def test_iterate_parquet_rows():
     file_path = "test/parquet/sample.parquet"
@@ -23,3 +40,556 @@ def test_iterate_parquet_rows():
     assert count_rows == n, f"The number of rows should be equal to {n}"
 
 
+
+def test_iterate_parquet_records():
+    file_path = "test/parquet/sample.parquet"
+    count_rows = 0
+    expected_start = 0
+    for batch_start, records in iterate_parquet_records(file_path, chunk_size=1000):
+        assert batch_start == expected_start
+        expected_start += len(records)
+        count_rows += len(records)
+
+    assert count_rows == 10719
+
+    _, records = next(iterate_parquet_records(file_path, chunk_size=1000))
+    first = records[0]
+    assert set(first.keys()) == set(METADATA_COLUMNS)
+    assert isinstance(first['URL'], str)
+    assert isinstance(first['hash'], int)
+
+def test_iterate_parquet_records_matches_rows():
+    file_path = "test/parquet/sample.parquet"
+    df = next(iterate_parquet_rows(file_path, chunk_size=500))
+    batch_start, records = next(iterate_parquet_records(file_path, chunk_size=500))
+
+    assert batch_start == df.index[0]
+    for (index, row), record in zip(df.iterrows(), records):
+        assert row['URL'] == record['URL']
+        assert row['TEXT'] == record['TEXT']
+
+def test_iterate_parquet_records_missing_columns():
+    file_path = "test/parquet/sample.parquet"
+    _, records = next(iterate_parquet_records(file_path, chunk_size=10, columns=['URL', 'not_a_column']))
+    assert records[0]['not_a_column'] is None
+    assert records[0]['URL'] is not None
+
+def test_process_parquet_downloads_every_row(tmp_path, image_server):
+    base_url, server = image_server
+    urls = [f'{base_url}/{i}.jpg' for i in range(40)]
+    pq_path = write_parquet(tmp_path / 'sample.parquet', urls)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+
+    ddb_table = MagicMock()
+    ddb_table.get_item.return_value = {}
+
+    stats = process_parquet(
+        ddb_table=ddb_table,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=10,
+        concurrency=8,
+        min_images_per_tar=5,
+    )
+
+    assert stats['succeeded'] == 40
+    assert stats['in_flight'] == 0
+    assert stats['domains']['127.0.0.1'] == {'scheduled': 40, 'succeeded': 40, 'failed': 0}
+    files = os.listdir(image_dir)
+    assert len(files) == 80
+    assert '00001-30-40--39.jpg' in files
+    assert '00001-0-10--0.json' in files
+
+def test_process_parquet_counts_failed_writes(tmp_path, image_server):
+    base_url, server = image_server
+    pq_path = write_parquet(tmp_path / 'sample.parquet', [f'{base_url}/{i}.jpg' for i in range(20)])
+
+    class FullDisk(FileSink):
+        def write(self, prefix, index, image_content, metadata):
+            if index >= 15:
+                raise OSError('No space left on device')
+            super().write(prefix, index, image_content, metadata)
+
+    stats = process_parquet(
+        ddb_table=None,
+        base_dir=str(tmp_path),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=20,
+        sink=FullDisk(str(tmp_path)),
+    )
+
+    assert stats['succeeded'] == 15
+    assert stats['write_failed'] == 5
+
+def test_process_parquet_resizes_images(tmp_path, image_server):
+    base_url, server = image_server
+    urls = [f'{base_url}/{i}.jpg?size=64' for i in range(10)]
+    pq_path = write_parquet(tmp_path / 'sample.parquet', urls)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+
+    stats = process_parquet(
+        ddb_table=None,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=10,
+        concurrency=4,
+        image_processes=2,
+        max_image_side=16,
+    )
+
+    assert stats['succeeded'] == 10
+    assert stats['invalid'] == 0
+    assert Image.open(image_dir / '00001-0-10--3.jpg').size == (16, 16)
+
+def test_process_parquet_shares_a_caller_image_processor(tmp_path, image_server):
+    base_url, server = image_server
+    processor = ImageProcessor(2, max_side=16)
+    try:
+        for pq_id in ['00001', '00002']:
+            pq_path = write_parquet(tmp_path / f'{pq_id}.parquet', [f'{base_url}/{i}.jpg?size=64' for i in range(5)])
+            stats = process_parquet(
+                ddb_table=None,
+                base_dir=str(tmp_path),
+                pq_path=pq_path,
+                pq_id=pq_id,
+                already_processed=set(),
+                max_images_per_tar=5,
+                processor=processor,
+            )
+            assert stats['succeeded'] == 5
+            assert Image.open(tmp_path / f'{pq_id}-0-5--0.jpg').size == (16, 16)
+
+        # left running for the next parquet
+        assert processor.pool.submit(max, 1, 2).result() == 2
+    finally:
+        processor.close()
+
+def test_process_parquet_dedup(tmp_path, image_server):
+    base_url, server = image_server
+    # every url serves a different image except the last four, which repeat row 2
+    sizes = list(range(10, 16)) + [12] * 4
+    urls = [f'{base_url}/{i}.jpg?size={size}' for i, size in enumerate(sizes)]
+    pq_path = write_parquet(tmp_path / 'sample.parquet', urls)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+
+    dedup = DedupIndex(num_shards=2, capacity=1000)
+    for row_hash in [0, 1]:
+        dedup.add_hash(row_hash)
+
+    stats = process_parquet(
+        ddb_table=None,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=10,
+        concurrency=1,
+        dedup=dedup,
+    )
+
+    # rows 0 and 1 were never requested, rows 6 to 9 were caught by their content
+    assert server.request_count == 8
+    assert stats['succeeded'] == 4
+    assert stats['duplicates'] == 6
+    assert dedup.seen_hash(5)
+    # nothing uploaded the batch, so its keys are only staged
+    assert list(dedup.pending) == ['00001-0-10']
+    dedup.discard('00001-0-10')
+    assert not dedup.seen_hash(5)
+
+def test_process_parquet_skips_dead_domains(tmp_path, image_server):
+    base_url, server = image_server
+    # nothing listens on port 1, so every request to localhost is refused
+    urls = [f'{base_url}/{i}.jpg' for i in range(10)] + [f'http://localhost:1/{i}.jpg' for i in range(20)]
+    pq_path = write_parquet(tmp_path / 'sample.parquet', urls)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+
+    breakers = DomainBreakers(failure_threshold=5, cooldown=300)
+    stats = process_parquet(
+        ddb_table=None,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=30,
+        concurrency=1,
+        breakers=breakers,
+    )
+
+    assert stats['succeeded'] == 10
+    assert stats['breaker_skipped'] == 15
+    assert breakers.stats['tripped'] == 1
+    assert breakers.is_open('localhost')
+
+def test_process_parquet_rejects_responses(tmp_path, image_server):
+    base_url, server = image_server
+    urls = [
+        f'{base_url}/ok.jpg',
+        f'{base_url}/untyped.jpg?content_type=',
+        f'{base_url}/page.jpg?body=html&content_type=text/html',
+        f'{base_url}/mislabelled.jpg?body=html',
+        f'{base_url}/big.jpg?size=400',
+        f'{base_url}/big-unknown-length.jpg?size=400&no_length=1',
+    ]
+    pq_path = write_parquet(tmp_path / 'sample.parquet', urls)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+
+    stats = process_parquet(
+        ddb_table=None,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=10,
+        concurrency=2,
+        max_image_bytes=len(make_jpeg(100, 100)),
+    )
+
+    assert stats['succeeded'] == 2
+    assert stats['rejected'] == {'content_type': 1, 'magic_bytes': 1, 'content_length': 1, 'max_bytes': 1}
+
+def test_process_parquet_records_metrics(tmp_path, image_server):
+    base_url, server = image_server
+    urls = [f'{base_url}/{i}.jpg' for i in range(5)] + [f'{base_url}/missing.jpg?status=404']
+    pq_path = write_parquet(tmp_path / 'sample.parquet', urls)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+
+    def value(name, **labels):
+        return sum(v['value'] for v in REGISTRY.snapshot().get(name, []) if v['labels'] == {k: str(l) for k, l in labels.items()})
+
+    succeeded = value('vitsae_images_total', outcome='succeeded')
+    not_found = value('vitsae_image_responses_total', status=404)
+
+    process_parquet(
+        ddb_table=None,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=10,
+        concurrency=2,
+    )
+
+    assert value('vitsae_images_total', outcome='succeeded') - succeeded == 5
+    assert value('vitsae_image_responses_total', status=404) - not_found == 1
+    assert 'vitsae_image_request_seconds_bucket' in REGISTRY.render()
+
+def test_process_parquet_skips_already_processed(tmp_path, image_server):
+    base_url, server = image_server
+    urls = [f'{base_url}/{i}.jpg' for i in range(30)]
+    urls[25] = f'{base_url}/{25}.jpg?status=404'
+    pq_path = write_parquet(tmp_path / 'sample.parquet', urls)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+
+    ddb_table = MagicMock()
+    ddb_table.get_item.return_value = {}
+
+    stats = process_parquet(
+        ddb_table=ddb_table,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed={'00001-10-20'},
+        max_images_per_tar=10,
+        concurrency=3,
+        min_images_per_tar=5,
+    )
+
+    assert stats['completed'] == 20
+    assert stats['succeeded'] == 19
+    files = os.listdir(image_dir)
+    assert not any(f.startswith('00001-10-20') for f in files)
+    assert server.request_count == 20
+
+def test_iterate_parquet_records_row_ranges():
+    file_path = "test/parquet/sample.parquet"
+    all_records = [r for _, records in iterate_parquet_records(file_path, chunk_size=1000) for r in records]
+
+    seen = []
+    for batch_start, records in iterate_parquet_records(file_path, chunk_size=1000, row_ranges=[(2500, 3100), (10000, 10800)]):
+        for index, record in enumerate(records, batch_start):
+            seen.append(index)
+            assert record == all_records[index]
+
+    assert seen == list(range(2500, 3100)) + list(range(10000, 10719))
+
+def test_batch_row_ranges():
+    assert batch_row_ranges(25, 10) == [(0, 10), (10, 20), (20, 30)]
+    assert batch_row_ranges(0, 10) == []
+
+def test_process_parquet_row_ranges(tmp_path, image_server):
+    base_url, server = image_server
+    urls = [f'{base_url}/{i}.jpg' for i in range(40)]
+    pq_path = write_parquet(tmp_path / 'sample.parquet', urls)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+    on_seal = MagicMock()
+
+    stats = process_parquet(
+        ddb_table=None,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=10,
+        concurrency=4,
+        row_ranges=[(0, 10), (30, 40)],
+        sink=FileSink(str(image_dir), on_seal=on_seal),
+    )
+
+    assert stats['succeeded'] == 20
+    assert [c.args[0] for c in on_seal.call_args_list] == ['00001-0-10', '00001-30-40']
+
+def test_process_parquet_multiprocess(tmp_path, image_server):
+    base_url, server = image_server
+    urls = [f'{base_url}/{i}.jpg' for i in range(50)]
+    pq_path = write_parquet(tmp_path / 'sample.parquet', urls)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+    uploader = MagicMock()
+
+    stats = process_parquet_multiprocess(
+        ddb_table=None,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed={'00001-20-30'},
+        uploader=uploader,
+        num_processes=2,
+        max_images_per_tar=10,
+        concurrency=8,
+        report_interval=0.1,
+    )
+
+    assert stats['succeeded'] == 40
+    assert stats['domains']['127.0.0.1']['succeeded'] == 40
+    completed = sorted(c.args[0] for c in uploader.batch_complete.call_args_list)
+    assert completed == ['00001-0-10', '00001-10-20', '00001-30-40', '00001-40-50']
+    # every image and its metadata is reported to the uploader, so it never lists the directory
+    assert uploader.files_written.call_count == 40
+    files = os.listdir(image_dir)
+    assert len(files) == 80
+    assert not any(f.startswith('00001-20-30') for f in files)
+
+def test_process_parquet_stops_when_job_complete(tmp_path, image_server):
+    base_url, server = image_server
+    pq_path = write_parquet(tmp_path / 'sample.parquet', [f'{base_url}/{i}.jpg' for i in range(10)])
+    upload_counter = MagicMock()
+    upload_counter.value = 100
+
+    stats = process_parquet(
+        ddb_table=None,
+        base_dir=str(tmp_path),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        min_images_per_tar=10,
+        total_images_required=1000,
+        upload_counter=upload_counter,
+    )
+
+    assert stats['completed'] == 0
+    assert server.request_count == 0
+
+def make_sqs(bodies):
+    sqs = MagicMock()
+    responses = [{'Messages': [{'Body': body, 'ReceiptHandle': f'rh-{body}', 'MessageId': body}]} for body in bodies]
+    sqs.receive_message.side_effect = lambda **kwargs: responses.pop(0) if responses else {}
+    return sqs
+
+def deleted(sqs):
+    return [c.kwargs['ReceiptHandle'] for c in sqs.delete_message.call_args_list]
+
+def test_run_message_loop_single_message():
+    sqs = make_sqs(['a', 'b'])
+    handled = []
+    processed = run_message_loop(
+        sqs, 'queue', lambda url: (url, url), lambda pq_id, pq_path: handled.append(pq_id) or True,
+        wait_time=1, initial_wait_time=0, interrupt_fn=lambda: False
+    )
+
+    assert processed == 1
+    assert handled == ['a']
+    assert deleted(sqs) == ['rh-a']
+
+def fetch_to(directory, fetched):
+    def fetch(url):
+        fetched.append(url)
+        path = directory / f'{url}.parquet'
+        path.write_bytes(b'parquet')
+        return url, str(path)
+    return fetch
+
+def test_run_message_loop_continuous_prefetches_next_parquet(tmp_path):
+    sqs = make_sqs(['a', 'b', 'c'])
+    fetched = []
+    overlapped = []
+
+    def handle(pq_id, pq_path):
+        assert os.path.exists(pq_path)
+        # the next parquet is fetched while this one is being processed
+        deadline = time.time() + 2
+        while pq_id != 'c' and len(fetched) < 'abc'.index(pq_id) + 2 and time.time() < deadline:
+            time.sleep(0.01)
+        overlapped.append(len(fetched))
+        return True
+
+    processed = run_message_loop(
+        sqs, 'queue', fetch_to(tmp_path, fetched), handle, continuous=True,
+        wait_time=1, initial_wait_time=0, interrupt_fn=lambda: False, release_parquet=remove_parquet
+    )
+
+    assert processed == 3
+    assert overlapped == [2, 3, 3]
+    # each parquet is deleted once it has been handled
+    assert os.listdir(tmp_path) == []
+    assert deleted(sqs) == ['rh-a', 'rh-b', 'rh-c']
+    # visibility is pushed out for every message as it is received
+    extended = [c.kwargs['ReceiptHandle'] for c in sqs.change_message_visibility.call_args_list]
+    assert extended == ['rh-a', 'rh-b', 'rh-c']
+
+def test_run_message_loop_returns_prefetched_message_when_done(tmp_path):
+    sqs = make_sqs(['a', 'b'])
+    fetched = []
+
+    def handle(pq_id, pq_path):
+        deadline = time.time() + 2
+        while len(fetched) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        return False
+
+    processed = run_message_loop(
+        sqs, 'queue', fetch_to(tmp_path, fetched), handle, continuous=True,
+        wait_time=1, initial_wait_time=0, interrupt_fn=lambda: False, release_parquet=remove_parquet
+    )
+
+    assert processed == 1
+    # including the prefetched parquet that was never processed
+    assert os.listdir(tmp_path) == []
+    assert deleted(sqs) == []
+    sqs.change_message_visibility.assert_called_with(QueueUrl='queue', ReceiptHandle='rh-b', VisibilityTimeout=0)
+    sqs.send_message.assert_not_called()
+
+def test_run_message_loop_failed_parquet_is_requeued():
+    sqs = make_sqs(['a', 'b'])
+
+    def handle(pq_id, pq_path):
+        if pq_id == 'a':
+            raise ValueError('boom')
+        return True
+
+    processed = run_message_loop(
+        sqs, 'queue', lambda url: (url, url), handle, continuous=True,
+        wait_time=1, initial_wait_time=0, interrupt_fn=lambda: False
+    )
+
+    assert processed == 1
+    assert deleted(sqs) == ['rh-b']
+    sqs.send_message.assert_called_once_with(QueueUrl='queue', MessageBody='a')
+
+def test_run_message_loop_interruption_requeues_every_held_message():
+    sqs = make_sqs(['a', 'b', 'c'])
+    interrupted = threading.Event()
+    fetched = []
+
+    def fetch(url):
+        fetched.append(url)
+        return url, url
+
+    def handle(pq_id, pq_path):
+        deadline = time.time() + 2
+        while len(fetched) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        interrupted.set()
+        # wait for the listener to notice and re-queue
+        time.sleep(6)
+        return True
+
+    processed = run_message_loop(
+        sqs, 'queue', fetch, handle, continuous=True,
+        wait_time=1, initial_wait_time=0, interrupt_fn=interrupted.is_set
+    )
+
+    assert processed == 0
+    assert deleted(sqs) == []
+    requeued = sorted(c.kwargs['MessageBody'] for c in sqs.send_message.call_args_list)
+    assert requeued == ['a', 'b']
+
+def test_process_parquet_hedges_slow_requests(tmp_path, image_server):
+    base_url, server = image_server
+    # one request in ten stalls past the timeout, retrying it will usually be quick
+    server.timeout_rate = 0.1
+    server.timeout_delay = 3
+    urls = [f'{base_url}/{i}.jpg' for i in range(100)]
+    pq_path = write_parquet(tmp_path / 'sample.parquet', urls)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+
+    hedge = HedgePolicy(percentile=0.5, budget=0.5, min_samples=10, min_delay=0.05)
+    stats = process_parquet(
+        ddb_table=None,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=100,
+        concurrency=20,
+        limit_per_host=20,
+        request_timeout=2,
+        hedge=hedge,
+    )
+
+    assert stats['hedges']['hedged'] > 0
+    assert stats['hedges']['hedge_won'] > 0
+    assert stats['succeeded'] > 90
+
+def write_sized_parquet(path, base_url, sizes):
+    table = pa.table({
+        'URL': [f'{base_url}/{i}.jpg?size={size}' for i, size in enumerate(sizes)],
+        'hash': list(range(len(sizes))),
+        'WIDTH': [float(size) for size in sizes],
+        'HEIGHT': [float(size) for size in sizes],
+    })
+    pq.write_table(table, path, row_group_size=7)
+    return str(path)
+
+def test_process_parquet_cuts_batches_by_bytes(tmp_path, image_server):
+    base_url, server = image_server
+    sizes = [32] * 12 + [128] * 6 + [32] * 5
+    pq_path = write_sized_parquet(tmp_path / 'sample.parquet', base_url, sizes)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+    on_seal = MagicMock()
+
+    stats = process_parquet(
+        ddb_table=None,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed={'00001-12-15'},
+        max_images_per_tar=10,
+        min_images_per_tar=2,
+        concurrency=4,
+        sink=FileSink(str(image_dir), on_seal=on_seal),
+        target_tar_bytes=3 * 128 * 128,
+        bytes_per_pixel=1,
+    )
+
+    sealed = sorted(c.args[0] for c in on_seal.call_args_list)
+    # 32px rows are cut by the row limit, 128px rows three at a time
+    assert sealed == ['00001-0-10', '00001-10-12', '00001-15-18', '00001-18-28']
+    assert stats['succeeded'] == 20
+    assert plan_row_ranges(pq_path, '00001', 10, min_rows=2, target_bytes=3 * 128 * 128, bytes_per_pixel=1, already_processed={'00001-12-15'}) == [(0, 10), (10, 12), (15, 18), (18, 28)]
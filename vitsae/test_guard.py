@@ -0,0 +1,23 @@
+import io
+
+from PIL import Image
+
+from guard import sniff_image_type
+from conftest import make_jpeg
+
+def encode(fmt):
+    buf = io.BytesIO()
+    Image.new('RGB', (4, 4)).save(buf, fmt)
+    return buf.getvalue()
+
+def test_sniff_image_type():
+    assert sniff_image_type(make_jpeg()[:16]) == 'jpeg'
+    assert sniff_image_type(encode('PNG')[:16]) == 'png'
+    assert sniff_image_type(encode('GIF')[:16]) == 'gif'
+    assert sniff_image_type(encode('WEBP')[:16]) == 'webp'
+    assert sniff_image_type(encode('BMP')[:16]) == 'bmp'
+
+def test_sniff_rejects_other_content():
+    assert sniff_image_type(b'<!DOCTYPE html><html>') is None
+    assert sniff_image_type(b'{"error": "gone"}') is None
+    assert sniff_image_type(b'') is None
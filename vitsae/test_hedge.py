@@ -0,0 +1,103 @@
+import asyncio
+
+from hedge import HedgePolicy
+
+def test_no_delay_until_enough_samples():
+    hedge = HedgePolicy(percentile=0.9, min_samples=10, min_delay=0.0, recompute_every=10)
+    for i in range(9):
+        hedge.record(i)
+    assert hedge.delay() is None
+
+    hedge.record(9)
+    assert hedge.delay() == 8
+    # only recomputed every ten samples
+    for _ in range(9):
+        hedge.record(0.5)
+    assert hedge.delay() == 8
+    hedge.record(0.5)
+    assert hedge.delay() == 7
+
+def test_delay_has_a_floor():
+    hedge = HedgePolicy(min_samples=1, min_delay=0.2)
+    hedge.record(0.01)
+    assert hedge.delay() == 0.2
+
+def test_budget_caps_hedges():
+    hedge = HedgePolicy(budget=0.1)
+    hedge.stats['requests'] = 25
+    assert hedge.try_hedge()
+    assert hedge.try_hedge()
+    assert not hedge.try_hedge()
+    assert hedge.stats['hedged'] == 2
+
+def make_attempts(durations, started, cancelled):
+    durations = iter(durations)
+
+    async def attempt():
+        n = len(started)
+        started.append(n)
+        try:
+            await asyncio.sleep(next(durations))
+        except asyncio.CancelledError:
+            cancelled.append(n)
+            raise
+        return n
+
+    return attempt
+
+def test_hedge_wins_and_straggler_is_cancelled():
+    hedge = HedgePolicy(min_samples=1, min_delay=0.05, budget=1.0)
+    hedge.record(0.05)
+    started, cancelled = [], []
+
+    async def run():
+        result = await hedge.run(make_attempts([5, 0.01], started, cancelled), lambda result: True)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == 1
+    assert started == [0, 1]
+    assert cancelled == [0]
+    assert hedge.stats == {'requests': 1, 'hedged': 1, 'hedge_won': 1}
+
+def test_fast_request_is_not_hedged():
+    hedge = HedgePolicy(min_samples=1, min_delay=0.5, budget=1.0)
+    hedge.record(0.5)
+    started, cancelled = [], []
+
+    assert asyncio.run(hedge.run(make_attempts([0.01], started, cancelled), lambda result: True)) == 0
+    assert started == [0]
+    assert hedge.stats['hedged'] == 0
+
+def test_failed_first_result_waits_for_the_other_attempt():
+    hedge = HedgePolicy(min_samples=1, min_delay=0.05, budget=1.0)
+    hedge.record(0.05)
+    started, cancelled = [], []
+
+    # the original finishes first but failed, so the hedge's result is used
+    result = asyncio.run(hedge.run(make_attempts([0.1, 0.2], started, cancelled), lambda result: result == 1))
+    assert result == 1
+    assert hedge.stats['hedge_won'] == 1
+
+def test_without_budget_the_original_is_awaited():
+    hedge = HedgePolicy(min_samples=1, min_delay=0.05, budget=0.0)
+    hedge.record(0.05)
+    started, cancelled = [], []
+
+    assert asyncio.run(hedge.run(make_attempts([0.2], started, cancelled), lambda result: True)) == 0
+    assert started == [0]
+
+def test_only_the_original_attempt_is_recorded():
+    hedge = HedgePolicy(min_samples=1, min_delay=0.05, budget=1.0)
+    hedge.record(0.05)
+    started, cancelled = [], []
+
+    async def run():
+        result = await hedge.run(make_attempts([0.5, 0.01], started, cancelled), lambda result: True)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == 1
+    # the original was cancelled once the hedge came back, just after the delay
+    assert len(hedge.latencies) == 2
+    assert 0.05 <= hedge.latencies[-1] < 0.2
@@ -0,0 +1,32 @@
+import io
+
+from PIL import Image
+
+from imageproc import prepare_image
+from conftest import make_jpeg
+
+def image_size(content):
+    return Image.open(io.BytesIO(content)).size
+
+def test_invalid_image():
+    assert prepare_image(b'not an image') is None
+
+def test_truncated_image():
+    assert prepare_image(make_jpeg(64, 64)[:200]) is None
+
+def test_small_jpeg_is_untouched():
+    content = make_jpeg(32, 32)
+    assert prepare_image(content, max_side=64) is content
+
+def test_large_image_is_resized():
+    content = prepare_image(make_jpeg(400, 200), max_side=100, quality=80)
+    assert image_size(content) == (100, 50)
+
+def test_other_formats_become_jpeg():
+    buf = io.BytesIO()
+    Image.new('RGBA', (20, 10)).save(buf, 'PNG')
+    content = prepare_image(buf.getvalue())
+    image = Image.open(io.BytesIO(content))
+    assert image.format == 'JPEG'
+    assert image.mode == 'RGB'
+    assert image.size == (20, 10)
@@ -113,3 +113,24 @@ def test_stop_sets_stop_flag(mock_sqs_client):
     assert not handler._stop
     handler.stop()
     assert handler._stop
+
+def test_listen_waits_for_drain_before_requeueing(mock_sqs_client):
+    on_interrupt = MagicMock()
+    handler = InterruptionHandler("body", "url", mock_sqs_client, interrupt_fn=lambda: True, on_interrupt=on_interrupt, drain_timeout=5)
+
+    listen_thread = threading.Thread(target=handler.listen)
+    listen_thread.start()
+    time.sleep(0.1)
+    on_interrupt.assert_called_once()
+    mock_sqs_client.send_message.assert_not_called()
+
+    handler.drained()
+    listen_thread.join()
+    mock_sqs_client.send_message.assert_called_once_with(QueueUrl="url", MessageBody="body")
+
+def test_requeue_with_body(mock_sqs_client):
+    handler = InterruptionHandler("body", "url", mock_sqs_client)
+
+    assert handler.requeue("body", '{"url": "body", "row_ranges": [[5, 10]]}')
+    assert not handler.requeue("body")
+    mock_sqs_client.send_message.assert_called_once_with(QueueUrl="url", MessageBody='{"url": "body", "row_ranges": [[5, 10]]}')
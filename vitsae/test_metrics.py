@@ -0,0 +1,67 @@
+import json
+import requests
+
+from metrics import MetricsRegistry, MetricsDumper, start_metrics_server
+
+def test_render_counter_and_gauge():
+    registry = MetricsRegistry()
+    counter = registry.counter('requests_total', 'Requests.')
+    counter.inc(status=200)
+    counter.inc(2, status=200)
+    counter.inc(status=404)
+    registry.gauge('queue_depth', 'Depth.').set(7)
+
+    # asking again returns the same metric
+    assert registry.counter('requests_total', 'Requests.') is counter
+
+    text = registry.render()
+    assert '# TYPE requests_total counter' in text
+    assert 'requests_total{status="200"} 3.0' in text
+    assert 'requests_total{status="404"} 1.0' in text
+    assert 'queue_depth 7.0' in text
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.histogram('latency_seconds', 'Latency.', buckets=[0.1, 1])
+    for value in [0.05, 0.5, 0.5, 5]:
+        histogram.observe(value)
+
+    text = registry.render()
+    assert 'latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{le="1.0"} 3' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 4' in text
+    assert 'latency_seconds_count 4' in text
+    assert 'latency_seconds_sum 6.05' in text
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    registry.counter('errors_total', 'Errors.').inc(message='say "hi"\n')
+    assert 'errors_total{message="say \\"hi\\"\\n"} 1.0' in registry.render()
+
+def test_metrics_server():
+    registry = MetricsRegistry()
+    registry.counter('hits_total', 'Hits.').inc()
+    server = start_metrics_server(0, registry=registry, host='127.0.0.1')
+    try:
+        response = requests.get(f'http://127.0.0.1:{server.server_address[1]}/metrics', timeout=5)
+        assert response.status_code == 200
+        assert 'hits_total 1.0' in response.text
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_metrics_dumper(tmp_path):
+    registry = MetricsRegistry()
+    registry.histogram('latency_seconds', 'Latency.', buckets=[1]).observe(0.5, stage='tar')
+    path = tmp_path / 'metrics.jsonl'
+
+    dumper = MetricsDumper(str(path), interval=60, registry=registry)
+    dumper.dump()
+    dumper.dump()
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(lines) == 2
+    snapshot = lines[0]['metrics']['latency_seconds'][0]
+    assert snapshot['labels'] == {'stage': 'tar'}
+    assert snapshot['count'] == 1
+    assert snapshot['buckets'] == {'1': 1, 'inf': 0}
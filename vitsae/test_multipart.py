@@ -0,0 +1,44 @@
+import pytest
+
+from multipart import MultipartUploadWriter, MIN_PART_SIZE
+from conftest import FakeS3
+
+def test_writes_are_split_into_parts():
+    s3 = FakeS3()
+    writer = MultipartUploadWriter(s3, 'bucket', 'out.tar', part_size=MIN_PART_SIZE, upload_threads=2)
+    data = bytes(range(256)) * (MIN_PART_SIZE // 256 * 2 + 10)
+    for i in range(0, len(data), 100_000):
+        writer.write(data[i:i + 100_000])
+
+    assert 'out.tar' not in s3.objects
+    writer.complete()
+
+    assert s3.objects['out.tar'] == data
+    assert writer.bytes_written == len(data)
+    assert s3.multipart_uploads == {}
+
+def test_small_upload_is_a_single_part():
+    s3 = FakeS3()
+    writer = MultipartUploadWriter(s3, 'bucket', 'out.tar')
+    writer.write(b'abc')
+    writer.complete()
+    assert s3.objects['out.tar'] == b'abc'
+
+def test_failed_part_aborts_the_upload():
+    s3 = FakeS3()
+    calls = []
+
+    def upload_part(**kwargs):
+        calls.append(kwargs['PartNumber'])
+        raise IOError('connection reset')
+
+    s3.upload_part = upload_part
+    writer = MultipartUploadWriter(s3, 'bucket', 'out.tar', part_size=MIN_PART_SIZE, upload_threads=1)
+    writer.write(b'x' * (MIN_PART_SIZE + 1))
+
+    with pytest.raises(IOError):
+        writer.complete()
+
+    assert calls
+    assert 'out.tar' not in s3.objects
+    assert s3.multipart_uploads == {}
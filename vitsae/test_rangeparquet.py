@@ -0,0 +1,77 @@
+import os
+import shutil
+from unittest.mock import MagicMock
+
+import pytest
+
+from rangeparquet import RangeStreamedParquet, parquet_id_from_url
+from generatewds import iterate_parquet_records, process_parquet
+from conftest import write_parquet
+
+def test_parquet_id_from_url():
+    url = "https://huggingface.co/datasets/laion/x/resolve/main/part-00017-00478b7a-941e-4176-b569-25f4be656991-c000.snappy.parquet"
+    assert parquet_id_from_url(url) == '00017'
+
+def test_streamed_records_match_local(file_server):
+    base_url, directory, server = file_server
+    shutil.copy('test/parquet/sample.parquet', directory / 'sample.parquet')
+
+    stream = RangeStreamedParquet(f'{base_url}/sample.parquet')
+    streamed = [r for _, records in iterate_parquet_records(stream, chunk_size=1000) for r in records]
+    local = [r for _, records in iterate_parquet_records('test/parquet/sample.parquet', chunk_size=1000) for r in records]
+    stream.close()
+
+    assert streamed == local
+    assert all(end - start < os.path.getsize(directory / 'sample.parquet') for start, end in server.ranges)
+
+def test_row_groups_are_fetched_in_order_with_lookahead(file_server):
+    base_url, directory, server = file_server
+    write_parquet(directory / 'multi.parquet', [f'http://x/{i}.jpg' for i in range(100)], row_group_size=10)
+
+    # a small footer fetch so the tail doesn't already cover the whole test file
+    stream = RangeStreamedParquet(f'{base_url}/multi.parquet', lookahead=2, footer_fetch_size=64)
+    assert len(stream.row_group_ranges) == 10
+
+    records_iter = iterate_parquet_records(stream, chunk_size=10)
+    batch_start, records = next(records_iter)
+    assert batch_start == 0
+    assert records[0]['URL'] == 'http://x/0.jpg'
+
+    # the prefetcher stays within lookahead row groups of the reader
+    assert max(stream.fetched) <= 1
+
+    seen = [batch_start] + [start for start, _ in records_iter]
+    assert seen == list(range(0, 100, 10))
+    assert len(stream.fetched) <= 2
+
+    fetched_starts = [start for start, _ in server.ranges]
+    row_group_starts = [start for start, _ in stream.row_group_ranges]
+    assert [s for s in fetched_starts if s in row_group_starts] == row_group_starts
+    stream.close()
+
+def test_missing_file_raises(file_server):
+    base_url, directory, server = file_server
+    with pytest.raises(Exception):
+        RangeStreamedParquet(f'{base_url}/missing.parquet')
+
+def test_process_parquet_from_stream(tmp_path, file_server, image_server):
+    base_url, directory, server = file_server
+    image_url, _ = image_server
+    write_parquet(directory / 'multi.parquet', [f'{image_url}/{i}.jpg' for i in range(30)], row_group_size=7)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+
+    stream = RangeStreamedParquet(f'{base_url}/multi.parquet', footer_fetch_size=64)
+    stats = process_parquet(
+        ddb_table=None,
+        base_dir=str(image_dir),
+        pq_path=stream,
+        pq_id='00001',
+        already_processed=set(),
+        max_images_per_tar=10,
+        concurrency=4,
+    )
+    stream.close()
+
+    assert stats['succeeded'] == 30
+    assert len(os.listdir(image_dir)) == 60
@@ -0,0 +1,125 @@
+import io
+import os
+import tarfile
+
+import numpy as np
+from PIL import Image
+
+from records import RecordWriter, HEADER_SIZE, RECORD_SIDE, unpack_header, to_record, convert_tar
+from conftest import make_jpeg, FakeS3
+from test_uploadwds import create_test_files, make_tar_maker
+
+RECORD_BYTES = RECORD_SIDE * RECORD_SIDE * 3
+
+def test_to_record_crops_to_side():
+    record = to_record(make_jpeg(500, 100, color='red'))
+    assert len(record) == RECORD_BYTES
+    assert record[:3] == bytes([254, 0, 0])
+    assert len(to_record(make_jpeg(10, 10), side=32)) == 32 * 32 * 3
+    assert to_record(b'not an image') is None
+
+def clip_preprocess(image, side=RECORD_SIDE):
+    """
+    The resize and center crop CLIPImageProcessor applies to the PIL images
+    StreamingPILDataset hands vit_generate, before it normalizes them.
+    """
+    image = image.convert('RGB')
+    width, height = image.size
+    short, long = min(width, height), max(width, height)
+    new_long = int(side * long / short)
+    image = image.resize((side, new_long) if width <= height else (new_long, side), Image.BICUBIC)
+    pixels = np.asarray(image)
+    top, left = (pixels.shape[0] - side) // 2, (pixels.shape[1] - side) // 2
+    return pixels[top:top + side, left:left + side]
+
+def test_records_match_what_vit_generate_gets_from_tars():
+    # a wide image with red edges, squashing it would keep them
+    image = Image.new('RGB', (600, 300), color='blue')
+    for x in range(600):
+        for y in range(300):
+            if x < 100 or x >= 500:
+                image.putpixel((x, y), (255, 0, 0))
+            elif (x + y) % 7 == 0:
+                image.putpixel((x, y), (0, 255, 0))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG')
+    jpg = buffer.getvalue()
+
+    record = np.frombuffer(to_record(jpg), dtype=np.uint8).reshape(RECORD_SIDE, RECORD_SIDE, 3)
+    with Image.open(io.BytesIO(jpg)) as pil_img:
+        pil_img.load()
+        expected = clip_preprocess(pil_img)
+
+    np.testing.assert_array_equal(record, expected)
+    assert record[:, 0, 0].max() < 128
+
+def test_record_writer_streams_fixed_size_records():
+    buffer = io.BytesIO()
+    writer = RecordWriter(buffer)
+    assert writer.write(make_jpeg(64, 48))
+    assert not writer.write(b'not an image')
+    assert writer.write(make_jpeg(300, 300))
+
+    data = buffer.getvalue()
+    assert writer.count == 2
+    assert len(data) == HEADER_SIZE + 2 * RECORD_BYTES
+    assert unpack_header(data[:HEADER_SIZE]) == (RECORD_SIDE, RECORD_SIDE, 3)
+
+def test_convert_tar(tmp_path):
+    tar_path = str(tmp_path / '00001-0-10.tar')
+    with tarfile.open(tar_path, 'w') as tar:
+        for i, content in enumerate([make_jpeg(40, 40), b'{}', make_jpeg(80, 20), b'broken']):
+            info = tarfile.TarInfo(f'00001-0-10--{i}.jpg' if i != 1 else '00001-0-10--0.json')
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+    output_path = convert_tar(tar_path)
+
+    assert output_path == str(tmp_path / '00001-0-10.rec')
+    assert os.path.getsize(output_path) == HEADER_SIZE + 2 * RECORD_BYTES
+
+def test_tar_maker_announces_record_shards(tmp_path):
+    s3 = FakeS3()
+    tar_maker = make_tar_maker(tmp_path)
+    tar_maker.s3_client = s3
+    tar_maker.record_shards = True
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    tar_maker.scan()
+
+    assert tar_maker.bundle_and_upload_files('00001', '0-10')
+
+    assert 'wds/00001-0-10.tar' in s3.objects
+    assert len(s3.objects['wds/00001-0-10.rec']) == HEADER_SIZE + 5 * RECORD_BYTES
+    tar_maker.sqs_client.send_message.assert_called_once_with(QueueUrl='tar-queue', MessageBody='s3://bucket/wds/00001-0-10.rec')
+    assert os.listdir(tmp_path) == []
+
+def test_tar_maker_streams_record_shards(tmp_path):
+    s3 = FakeS3()
+    tar_maker = make_tar_maker(tmp_path)
+    tar_maker.s3_client = s3
+    tar_maker.stream_uploads = True
+    tar_maker.record_shards = True
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    tar_maker.scan()
+
+    assert tar_maker.bundle_and_upload_files('00001', '0-10')
+    assert len(s3.objects['wds/00001-0-10.rec']) == HEADER_SIZE + 5 * RECORD_BYTES
+
+def test_failed_record_upload_is_not_recorded(tmp_path):
+    s3 = FakeS3()
+    upload_file = s3.upload_file
+    def fail_records(filename, bucket, key):
+        if key.endswith('.rec'):
+            raise IOError('connection reset')
+        upload_file(filename, bucket, key)
+    s3.upload_file = fail_records
+    tar_maker = make_tar_maker(tmp_path)
+    tar_maker.s3_client = s3
+    tar_maker.record_shards = True
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    tar_maker.scan()
+
+    assert not tar_maker.bundle_and_upload_files('00001', '0-10')
+    tar_maker.dd_table.put_item.assert_not_called()
+    tar_maker.sqs_client.send_message.assert_not_called()
+    assert not os.path.exists(tmp_path / '00001-0-10.rec')
@@ -0,0 +1,78 @@
+import os
+import json
+import tarfile
+from unittest.mock import MagicMock
+
+from shards import FileSink, ShardWriter
+from generatewds import process_parquet
+from conftest import make_jpeg, write_parquet
+
+def test_file_sink_writes_image_and_metadata(tmp_path):
+    sink = FileSink(str(tmp_path))
+    sink.write('00001-0-10', 3, b'jpgbytes', {'URL': 'http://x'})
+    sink.seal('00001-0-10')
+
+    assert (tmp_path / '00001-0-10--3.jpg').read_bytes() == b'jpgbytes'
+    assert json.loads((tmp_path / '00001-0-10--3.json').read_text()) == {'URL': 'http://x'}
+
+def test_shard_writer_builds_tar(tmp_path):
+    on_seal = MagicMock()
+    writer = ShardWriter(str(tmp_path), on_seal=on_seal)
+
+    for i in range(5):
+        writer.write('00001-0-10', i, make_jpeg(), {'URL': f'http://x/{i}'})
+    writer.write('00001-0-10', 5, b'not an image', {'URL': 'http://x/5'})
+
+    assert os.path.exists(tmp_path / '00001-0-10.tar.part')
+    writer.seal('00001-0-10')
+
+    tar_filename = str(tmp_path / '00001-0-10.tar')
+    on_seal.assert_called_once_with('00001-0-10', tar_filename, 10)
+    assert sorted(os.listdir(tmp_path)) == ['00001-0-10.tar', '00001-0-10.tar.idx']
+
+    with tarfile.open(tar_filename, 'r') as tar:
+        names = tar.getnames()
+        assert len(names) == 10
+        assert '00001-0-10--4.jpg' in names
+        assert '00001-0-10--5.jpg' not in names
+        metadata = json.load(tar.extractfile('00001-0-10--2.json'))
+        assert metadata == {'URL': 'http://x/2'}
+
+def test_shard_writer_seal_unknown_prefix(tmp_path):
+    on_seal = MagicMock()
+    writer = ShardWriter(str(tmp_path), on_seal=on_seal)
+    writer.seal('00001-0-10')
+    on_seal.assert_not_called()
+
+def test_process_parquet_seals_each_batch(tmp_path, image_server):
+    base_url, server = image_server
+    urls = [f'{base_url}/{i}.jpg' for i in range(25)]
+    pq_path = write_parquet(tmp_path / 'sample.parquet', urls)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+
+    ddb_table = MagicMock()
+    ddb_table.get_item.return_value = {}
+    on_seal = MagicMock()
+
+    process_parquet(
+        ddb_table=ddb_table,
+        base_dir=str(image_dir),
+        pq_path=pq_path,
+        pq_id='00001',
+        already_processed={'00001-10-20'},
+        max_images_per_tar=10,
+        concurrency=4,
+        sink=ShardWriter(str(image_dir), on_seal=on_seal),
+    )
+
+    sealed = {c.args[0]: c.args[2] for c in on_seal.call_args_list}
+    assert sealed == {'00001-0-10': 20, '00001-20-30': 10}
+    assert sorted(os.listdir(image_dir)) == ['00001-0-10.tar', '00001-0-10.tar.idx', '00001-20-30.tar', '00001-20-30.tar.idx']
+
+def test_file_sink_signals_sealed_batch(tmp_path):
+    on_seal = MagicMock()
+    sink = FileSink(str(tmp_path), on_seal=on_seal)
+    sink.write('00001-0-10', 3, b'jpgbytes', {})
+    sink.seal('00001-0-10')
+    on_seal.assert_called_once_with('00001-0-10')
@@ -0,0 +1,122 @@
+import io
+import os
+import tarfile
+
+from tarindex import TarIndex, build_index, index_path
+from shards import ShardWriter
+from uploadwds import make_tarfile
+from conftest import make_jpeg, FakeS3
+from test_uploadwds import create_test_files, make_tar_maker
+
+def write_members(tar, index):
+    index.add(tar, 'a--0.jpg', make_jpeg(32, 16))
+    index.add(tar, 'a--0.json', b'{"caption": "x"}')
+    index.add(tar, 'a--1.jpg', b'not an image')
+    index.add(tar, 'a--1.json', b'{}' * 600)
+
+def check_offsets(tar_bytes, index):
+    with tarfile.open(fileobj=io.BytesIO(tar_bytes)) as tar:
+        members = [m for m in tar if m.isfile()]
+        assert index.names == [m.name for m in members]
+        assert index.offsets == [m.offset_data for m in members]
+        assert index.sizes == [m.size for m in members]
+        for i, member in enumerate(members):
+            assert tar_bytes[index.offsets[i]:index.offsets[i] + index.sizes[i]] == tar.extractfile(member).read()
+
+def test_index_matches_seekable_tar(tmp_path):
+    index = TarIndex()
+    with tarfile.open(tmp_path / 'a.tar', 'w') as tar:
+        write_members(tar, index)
+
+    check_offsets((tmp_path / 'a.tar').read_bytes(), index)
+    assert index.widths == [32, None, None, None]
+    assert index.heights == [16, None, None, None]
+    assert index.statuses == ['ok', '', 'invalid', '']
+
+def test_index_matches_streamed_tar():
+    buffer = io.BytesIO()
+    index = TarIndex()
+    with tarfile.open(fileobj=buffer, mode='w|') as tar:
+        write_members(tar, index)
+
+    check_offsets(buffer.getvalue(), index)
+
+def test_index_round_trip(tmp_path):
+    index = TarIndex()
+    with tarfile.open(tmp_path / 'a.tar', 'w') as tar:
+        write_members(tar, index)
+    index.finish(os.path.getsize(tmp_path / 'a.tar'))
+    index.save(index_path(str(tmp_path / 'a.tar')))
+
+    loaded = TarIndex.from_bytes((tmp_path / 'a.tar.idx').read_bytes())
+    assert loaded.to_bytes() == index.to_bytes()
+    assert loaded.tar_size == os.path.getsize(tmp_path / 'a.tar')
+    assert build_index(str(tmp_path / 'a.tar')).to_bytes() == index.to_bytes()
+
+def test_shard_writer_saves_index(tmp_path):
+    sealed = []
+    writer = ShardWriter(str(tmp_path), lambda *args: sealed.append(args))
+    for i in range(3):
+        writer.write('00001-0-10', i, make_jpeg(20 + i, 10), {'i': i})
+    writer.seal('00001-0-10')
+
+    tar_filename = sealed[0][1]
+    index = TarIndex.from_bytes(open(index_path(tar_filename), 'rb').read())
+    assert len(index) == 6
+    assert index.widths[::2] == [20, 21, 22]
+    assert index.tar_size == os.path.getsize(tar_filename)
+    check_offsets(open(tar_filename, 'rb').read(), index)
+
+def test_make_tarfile_saves_index(tmp_path):
+    create_test_files(str(tmp_path), 'test_prefix', 10)
+    tar_filename, _ = make_tarfile(str(tmp_path), 'test_prefix')
+
+    index = TarIndex.from_bytes(open(index_path(tar_filename), 'rb').read())
+    assert len(index) == 10
+    assert set(index.statuses) == {'ok', ''}
+    check_offsets(open(tar_filename, 'rb').read(), index)
+
+def test_index_is_uploaded_next_to_tar(tmp_path):
+    s3 = FakeS3()
+    tar_maker = make_tar_maker(tmp_path)
+    tar_maker.s3_client = s3
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    tar_maker.scan()
+
+    tar_maker.bundle_and_upload_files('00001', '0-10')
+
+    index = TarIndex.from_bytes(s3.objects['wds/00001-0-10.tar.idx'])
+    check_offsets(s3.objects['wds/00001-0-10.tar'], index)
+    assert os.listdir(tmp_path) == []
+
+def test_index_is_uploaded_next_to_streamed_tar(tmp_path):
+    s3 = FakeS3()
+    tar_maker = make_tar_maker(tmp_path)
+    tar_maker.s3_client = s3
+    tar_maker.stream_uploads = True
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    tar_maker.scan()
+
+    tar_maker.bundle_and_upload_files('00001', '0-10')
+
+    index = TarIndex.from_bytes(s3.objects['wds/00001-0-10.tar.idx'])
+    assert index.tar_size == len(s3.objects['wds/00001-0-10.tar'])
+    check_offsets(s3.objects['wds/00001-0-10.tar'], index)
+
+def test_failed_index_upload_does_not_fail_tar(tmp_path):
+    s3 = FakeS3()
+    upload_fileobj = s3.upload_fileobj
+    def fail_index(fileobj, bucket, key):
+        if key.endswith('.idx'):
+            raise IOError('connection reset')
+        upload_fileobj(fileobj, bucket, key)
+    s3.upload_fileobj = fail_index
+    tar_maker = make_tar_maker(tmp_path)
+    tar_maker.s3_client = s3
+    tar_maker.stream_uploads = True
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    tar_maker.scan()
+
+    assert tar_maker.bundle_and_upload_files('00001', '0-10')
+    assert list(s3.objects) == ['wds/00001-0-10.tar']
+    tar_maker.sqs_client.send_message.assert_called_once()
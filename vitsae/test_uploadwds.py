@@ -1,9 +1,15 @@
+import io
 import os
+import threading
+import time
 import tarfile
-from uploadwds import make_tarfile
+from unittest.mock import MagicMock
+from uploadwds import make_tarfile, TarMaker
 from PIL import Image
 import pytest
 
+from conftest import FakeS3
+
 def create_test_files(directory, prefix, num_files):
     os.makedirs(directory, exist_ok=True)
     for i in range(num_files // 2):
@@ -86,3 +92,323 @@ def test_make_tarfile_bad_pair(setup_test_directory):
         assert f'{prefix}_badpair.json' not in tar_contents
         assert f'{prefix}_badpair.jpg' not in tar_contents
     os.remove(tar_filename)
+
+def test_make_tarfile_without_validation(setup_test_directory):
+    test_dir, prefix = setup_test_directory
+    tar_filename, files_to_bundle = make_tarfile(test_dir, prefix, validate=False)
+    with tarfile.open(tar_filename, 'r') as tar:
+        tar_contents = tar.getnames()
+        assert f'{prefix}_invalid.jpg' in tar_contents
+        assert len(tar_contents) == 39
+    os.remove(tar_filename)
+
+def make_tar_maker(watch_dir, min_images_per_tar=4):
+    return TarMaker(
+        watch_dir=str(watch_dir),
+        min_images_per_tar=min_images_per_tar,
+        s3_client=MagicMock(),
+        s3_bucket_name='bucket',
+        s3_prefix='wds',
+        ddb_table=MagicMock(),
+        sqs_client=MagicMock(),
+        tar_queue_url='tar-queue',
+    )
+
+def test_handle_events_sealed_tars(tmp_path):
+    tar_maker = make_tar_maker(tmp_path)
+    tar_filename = str(tmp_path / '00001-0-10.tar')
+    with open(tar_filename, 'wb') as f:
+        f.write(b'tar')
+
+    tar_maker.submit_tar('00001-0-10', tar_filename, 10)
+    tar_maker.handle_events()
+    assert tar_maker.wait_for_jobs(timeout=5)
+
+    tar_maker.s3_client.upload_file.assert_called_once_with(tar_filename, 'bucket', 'wds/00001-0-10.tar')
+    tar_maker.dd_table.put_item.assert_called_once_with(Item={'parquet_id': '00001', 'batch_id': '0-10', 'uploaded': True})
+    tar_maker.sqs_client.send_message.assert_called_once_with(QueueUrl='tar-queue', MessageBody='s3://bucket/wds/00001-0-10.tar')
+    assert not os.path.exists(tar_filename)
+
+def test_handle_events_sealed_tars_discards_small_tars(tmp_path):
+    tar_maker = make_tar_maker(tmp_path, min_images_per_tar=20)
+    tar_filename = str(tmp_path / '00001-0-10.tar')
+    with open(tar_filename, 'wb') as f:
+        f.write(b'tar')
+
+    tar_maker.submit_tar('00001-0-10', tar_filename, 10)
+    tar_maker.handle_events()
+
+    tar_maker.s3_client.upload_file.assert_not_called()
+    assert not os.path.exists(tar_filename)
+
+def test_batch_complete_uploads_without_waiting(tmp_path):
+    tar_maker = make_tar_maker(tmp_path)
+    tar_maker.wait_after_last_change = 600
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    create_test_files(str(tmp_path), '00001-10-20--', 10)
+
+    t = threading.Thread(target=tar_maker.keep_monitoring, kwargs={'sleep_time': 0.05})
+    t.start()
+    tar_maker.batch_complete('00001-0-10')
+
+    deadline = time.time() + 5
+    while any(f.startswith('00001-0-10') for f in os.listdir(tmp_path)) and time.time() < deadline:
+        time.sleep(0.01)
+
+    tar_maker.s3_client.upload_file.assert_called_once()
+    assert tar_maker.s3_client.upload_file.call_args.args[2] == 'wds/00001-0-10.tar'
+    remaining = os.listdir(tmp_path)
+    assert not any(f.startswith('00001-0-10') for f in remaining)
+    assert any(f.startswith('00001-10-20') for f in remaining)
+
+    tar_maker.finalize()
+    t.join()
+
+def test_batch_complete_below_minimum(tmp_path):
+    tar_maker = make_tar_maker(tmp_path, min_images_per_tar=100)
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+
+    tar_maker.batch_complete('00001-0-10')
+    tar_maker.handle_events()
+
+    tar_maker.s3_client.upload_file.assert_not_called()
+    assert len(os.listdir(tmp_path)) > 0
+
+def test_mark_as_uploaded_increments_counter(tmp_path):
+    tar_maker = make_tar_maker(tmp_path)
+    tar_maker.upload_counter = MagicMock()
+    tar_maker.mark_as_uploaded('00001', '0-10')
+    tar_maker.upload_counter.increment.assert_called_once()
+
+    tar_maker.upload_counter.reset_mock()
+    tar_maker.dd_table.put_item.side_effect = Exception('boom')
+    tar_maker.mark_as_uploaded('00001', '10-20')
+    tar_maker.upload_counter.increment.assert_not_called()
+
+def test_dedup_keys_are_committed_once_the_batch_is_recorded(tmp_path):
+    tar_maker = make_tar_maker(tmp_path, min_images_per_tar=4)
+    tar_maker.dedup = MagicMock()
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    tar_maker.scan()
+    tar_maker.dd_table.put_item.side_effect = Exception('throttled')
+
+    assert tar_maker.bundle_and_upload_files('00001', '0-10')
+    tar_maker.dedup.commit.assert_not_called()
+
+    create_test_files(str(tmp_path), '00001-10-20--', 10)
+    tar_maker.scan()
+    tar_maker.dd_table.put_item.side_effect = None
+    assert tar_maker.bundle_and_upload_files('00001', '10-20')
+    tar_maker.dedup.commit.assert_called_once_with('00001-10-20')
+
+def test_dedup_keys_of_small_batches_are_discarded(tmp_path):
+    tar_maker = make_tar_maker(tmp_path, min_images_per_tar=100)
+    tar_maker.dedup = MagicMock()
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    tar_maker.scan()
+
+    tar_maker.batch_complete('00001-0-10')
+    tar_maker.handle_events()
+
+    tar_maker.dedup.discard.assert_called_once_with('00001-0-10')
+    tar_maker.dedup.commit.assert_not_called()
+
+def test_files_written_are_bundled_without_listing(tmp_path):
+    tar_maker = make_tar_maker(tmp_path)
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    indexed = sorted(str(tmp_path / f) for f in os.listdir(tmp_path))
+    # written by something else, so never reported
+    create_test_files(str(tmp_path / 'elsewhere'), '00001-0-10--', 4)
+    with open(tmp_path / '00001-0-10--unreported.json', 'w') as f:
+        f.write('{}')
+
+    tar_maker.files_written('00001-0-10', indexed, size=100)
+    tar_maker.update_file_counts()
+    assert tar_maker.file_counts['00001-0-10'] == len(indexed)
+
+    tar_maker.batch_complete('00001-0-10')
+    tar_maker.handle_events()
+    assert tar_maker.wait_for_jobs(timeout=5)
+
+    tar_maker.s3_client.upload_file.assert_called_once()
+    # only reported files are bundled and removed, the directory isn't listed again
+    assert sorted(os.listdir(tmp_path)) == ['00001-0-10--unreported.json', 'elsewhere']
+    assert tar_maker.indexed_files('00001-0-10') == []
+
+def test_partial_batch_only_bundles_the_rows_it_covers(tmp_path):
+    tar_maker = make_tar_maker(tmp_path)
+    paths = []
+    for i in range(10):
+        path = str(tmp_path / f'00001-0-10--{i}.jpg')
+        Image.new('RGB', (8, 8)).save(path, 'JPEG')
+        paths.append(path)
+    tar_maker.files_written('00001-0-10', paths, 10)
+
+    tar_maker.mark_partial('00001-0-10', '00001-2-6', min_images=0)
+    assert sorted(tar_maker.batch_files('00001-0-10')) == paths[2:6]
+    tar_maker.batch_complete('00001-0-10')
+    tar_maker.handle_events()
+    assert tar_maker.wait_for_jobs(timeout=5)
+
+    # rows past the partial prefix are downloaded again, so their files go with the batch
+    tar_maker.s3_client.upload_file.assert_called_once()
+    assert tar_maker.s3_client.upload_file.call_args.args[2] == 'wds/00001-2-6.tar'
+    assert os.listdir(tmp_path) == []
+
+def test_files_reported_twice_are_counted_once(tmp_path):
+    tar_maker = make_tar_maker(tmp_path)
+    jpg, json_path = str(tmp_path / '00001-0-10--0.jpg'), str(tmp_path / '00001-0-10--0.json')
+    with open(jpg, 'wb') as f:
+        f.write(b'x' * 100)
+    with open(json_path, 'w') as f:
+        f.write('{}')
+
+    # inotify sees the jpg close before the producer reports both files
+    tar_maker._file_event(jpg)
+    tar_maker.files_written('00001-0-10', [jpg, json_path], 102)
+    tar_maker._file_event(json_path)
+    tar_maker.files_written('00001-0-10', [jpg, json_path], 102)
+
+    assert tar_maker.file_bytes['00001-0-10'] == 102
+    tar_maker.update_file_counts()
+    assert tar_maker.file_counts['00001-0-10'] == 2
+
+def test_scan_indexes_leftover_files(tmp_path):
+    tar_maker = make_tar_maker(tmp_path)
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    with open(tmp_path / '00001-10-20.tar.part', 'wb') as f:
+        f.write(b'partial shard')
+
+    tar_maker.scan()
+    assert len(tar_maker.indexed_files('00001-0-10')) == 13
+    assert tar_maker.indexed_files('00001-10-20') == []
+
+def test_stream_uploads(tmp_path):
+    s3 = FakeS3()
+    tar_maker = make_tar_maker(tmp_path)
+    tar_maker.s3_client = s3
+    tar_maker.stream_uploads = True
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    tar_maker.scan()
+
+    tar_maker.bundle_and_upload_files('00001', '0-10')
+
+    with tarfile.open(fileobj=io.BytesIO(s3.objects['wds/00001-0-10.tar'])) as tar:
+        names = tar.getnames()
+    assert len(names) == 10
+    assert '00001-0-10--_invalid.jpg' not in names
+    tar_maker.dd_table.put_item.assert_called_once_with(Item={'parquet_id': '00001', 'batch_id': '0-10', 'uploaded': True})
+    tar_maker.sqs_client.send_message.assert_called_once_with(QueueUrl='tar-queue', MessageBody='s3://bucket/wds/00001-0-10.tar')
+    assert os.listdir(tmp_path) == []
+
+def test_stream_upload_failure_keeps_files(tmp_path):
+    s3 = FakeS3()
+    s3.upload_part = MagicMock(side_effect=IOError('connection reset'))
+    tar_maker = make_tar_maker(tmp_path)
+    tar_maker.s3_client = s3
+    tar_maker.stream_uploads = True
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    tar_maker.scan()
+
+    tar_maker.bundle_and_upload_files('00001', '0-10')
+
+    assert s3.objects == {}
+    assert s3.multipart_uploads == {}
+    tar_maker.sqs_client.send_message.assert_not_called()
+    assert len(os.listdir(tmp_path)) == 13
+    assert len(tar_maker.indexed_files('00001-0-10')) == 13
+
+def test_prefix_is_never_bundled_twice(tmp_path):
+    tar_maker = make_tar_maker(tmp_path)
+    release = threading.Event()
+    tar_maker.s3_client.upload_file.side_effect = lambda *args: release.wait(5)
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    tar_maker.scan()
+
+    assert tar_maker.submit_job('00001', '0-10')
+    deadline = time.time() + 5
+    while tar_maker.job_stages['00001-0-10'] != 'uploading' and time.time() < deadline:
+        time.sleep(0.01)
+    assert tar_maker.job_counts()['uploading'] == 1
+
+    # the batch event and the directory timer both find it ready again while it uploads
+    assert not tar_maker.submit_job('00001', '0-10')
+    release.set()
+    assert tar_maker.wait_for_jobs(timeout=5)
+    assert not tar_maker.submit_job('00001', '0-10')
+
+    tar_maker.s3_client.upload_file.assert_called_once()
+    assert tar_maker.job_counts()['done'] == 1
+
+def test_failed_job_can_be_retried(tmp_path):
+    tar_maker = make_tar_maker(tmp_path)
+    tar_maker.s3_client.upload_file.side_effect = [Exception('slow down'), None]
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    tar_maker.scan()
+
+    tar_maker.submit_job('00001', '0-10')
+    tar_maker.wait_for_jobs(timeout=5)
+    assert tar_maker.job_stages['00001-0-10'] == 'failed'
+    tar_maker.sqs_client.send_message.assert_not_called()
+
+    assert tar_maker.submit_job('00001', '0-10')
+    tar_maker.wait_for_jobs(timeout=5)
+    assert tar_maker.job_stages['00001-0-10'] == 'done'
+    tar_maker.sqs_client.send_message.assert_called_once()
+
+def test_slow_upload_does_not_hold_up_other_prefixes(tmp_path):
+    tar_maker = make_tar_maker(tmp_path)
+    release = threading.Event()
+    uploaded = []
+
+    def upload_file(tar_filename, bucket, key):
+        if '00001-0-10' in key:
+            release.wait(5)
+        uploaded.append(key)
+
+    tar_maker.s3_client.upload_file.side_effect = upload_file
+    for start in range(0, 40, 10):
+        create_test_files(str(tmp_path), f'00001-{start}-{start + 10}--', 10)
+    tar_maker.scan()
+
+    for start in range(0, 40, 10):
+        tar_maker.submit_job('00001', f'{start}-{start + 10}')
+
+    deadline = time.time() + 5
+    while len(uploaded) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert sorted(uploaded) == ['wds/00001-10-20.tar', 'wds/00001-20-30.tar', 'wds/00001-30-40.tar']
+
+    release.set()
+    assert tar_maker.finalize(timeout=5)
+    assert len(uploaded) == 4
+
+def test_finalize_waits_for_jobs_started_by_monitoring(tmp_path):
+    tar_maker = make_tar_maker(tmp_path)
+    tar_maker.s3_client.upload_file.side_effect = lambda *args: time.sleep(0.3)
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+
+    t = threading.Thread(target=tar_maker.keep_monitoring, kwargs={'sleep_time': 0.05})
+    t.start()
+    tar_maker.batch_complete('00001-0-10')
+    time.sleep(0.1)
+
+    assert tar_maker.finalize(timeout=5)
+    tar_maker.sqs_client.send_message.assert_called_once()
+    t.join()
+
+def test_checkpoint_is_deleted_once_the_batch_is_recorded(tmp_path):
+    tar_maker = make_tar_maker(tmp_path)
+    tar_maker.checkpoints = MagicMock()
+    create_test_files(str(tmp_path), '00001-0-10--', 10)
+    tar_maker.scan()
+    tar_maker.dd_table.put_item.side_effect = Exception('throttled')
+
+    assert tar_maker.bundle_and_upload_files('00001', '0-10')
+    tar_maker.checkpoints.uploaded.assert_not_called()
+
+    create_test_files(str(tmp_path), '00001-10-20--', 10)
+    tar_maker.scan()
+    tar_maker.dd_table.put_item.side_effect = None
+    assert tar_maker.bundle_and_upload_files('00001', '10-20')
+    tar_maker.checkpoints.uploaded.assert_called_once_with('00001-10-20')
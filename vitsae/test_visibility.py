@@ -0,0 +1,40 @@
+import time
+from unittest.mock import MagicMock
+
+from visibility import VisibilityExtender
+
+def test_add_extends_immediately():
+    sqs = MagicMock()
+    extender = VisibilityExtender(sqs, 'queue', visibility_timeout=120)
+    extender.add('rh')
+    sqs.change_message_visibility.assert_called_once_with(QueueUrl='queue', ReceiptHandle='rh', VisibilityTimeout=120)
+
+def test_keeps_extending_until_removed():
+    sqs = MagicMock()
+    extender = VisibilityExtender(sqs, 'queue', interval=0.05)
+    extender.add('rh')
+    extender.start()
+    time.sleep(0.3)
+    extender.remove('rh')
+    calls = sqs.change_message_visibility.call_count
+    time.sleep(0.2)
+    extender.stop()
+
+    assert calls > 2
+    assert sqs.change_message_visibility.call_count == calls
+
+def test_stale_handles_are_dropped():
+    sqs = MagicMock()
+    extender = VisibilityExtender(sqs, 'queue')
+    extender.add('rh')
+    sqs.change_message_visibility.side_effect = Exception('receipt handle has expired')
+    extender.extend()
+    assert extender.receipt_handles == set()
+
+def test_give_back_makes_message_visible():
+    sqs = MagicMock()
+    extender = VisibilityExtender(sqs, 'queue')
+    extender.add('rh')
+    extender.give_back('rh')
+    sqs.change_message_visibility.assert_called_with(QueueUrl='queue', ReceiptHandle='rh', VisibilityTimeout=0)
+    assert extender.receipt_handles == set()
@@ -1,8 +1,13 @@
+import io
 import os
 import tarfile
 import boto3
 from collections import defaultdict
+import queue
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 from utils import load_config
 from PIL import Image
@@ -10,33 +15,91 @@ import PIL
 
 
 from constants import COUNTER_BATCH_ID, COUNTER_PQ_ID
+from metrics import REGISTRY
+from multipart import MultipartUploadWriter
+from tarindex import TarIndex, index_path
+from checkpoint import parse_prefix
+from records import RECORD_SUFFIX, write_records, tar_jpgs, file_jpgs
+
+TAR_BUILD_SECONDS = REGISTRY.histogram('vitsae_tar_build_seconds', 'Time to bundle a batch of image files into a tar.')
+RECORD_BUILD_SECONDS = REGISTRY.histogram('vitsae_record_build_seconds', 'Time to decode a batch of images into a record shard.')
+S3_UPLOAD_SECONDS = REGISTRY.histogram('vitsae_s3_upload_seconds', 'Time to upload a tar to S3.')
+S3_UPLOAD_BYTES = REGISTRY.counter('vitsae_s3_upload_bytes_total', 'Bytes of tars uploaded to S3.')
+TARS = REGISTRY.counter('vitsae_tars_total', 'Tars by what happened to them.')
+DISK_BACKLOG_FILES = REGISTRY.gauge('vitsae_disk_backlog_files', 'Per-image files in the watch directory waiting to be bundled.')
+DISK_BACKLOG_BYTES = REGISTRY.gauge('vitsae_disk_backlog_bytes', 'Bytes in the watch directory waiting to be bundled or uploaded.')
+TAR_JOBS = REGISTRY.gauge('vitsae_tar_jobs', 'Tar bundle and upload jobs by stage.')
+
+# stages a tar job moves through, in order, ending in done or failed
+JOB_STAGES = ['queued', 'building', 'uploading', 'recording', 'notifying', 'cleaning', 'done', 'failed']
 
 def non_extension_part(file_path):
     return os.path.splitext(os.path.basename(file_path))[0]
 
-def make_tarfile(watch_dir, prefix):
-    all_files = sorted([os.path.join(watch_dir, f)  for f in os.listdir(watch_dir) if f.startswith(prefix)])
-    tar_filename = os.path.join(watch_dir, f'{prefix}.tar')
+def select_files(watch_dir, prefix, validate=True, files=None):
+    """
+    Return (files_to_bundle, all_files) for prefix. files are the paths indexed
+    for the prefix, watch_dir is only listed if they aren't given.
+    """
+    if files is None:
+        files = [os.path.join(watch_dir, f) for f in os.listdir(watch_dir) if f.startswith(prefix)]
+    all_files = sorted(files)
 
     exclude = set()
     for file_path in all_files:
-        if file_path.split('.')[-1] == 'jpg':
+        if validate and file_path.split('.')[-1] == 'jpg':
             try:
                 _ = Image.open(file_path)
             except PIL.UnidentifiedImageError:
                 exclude.add(non_extension_part(file_path))
 
     files_to_bundle = [f for f in all_files if non_extension_part(f) not in exclude]
+    return files_to_bundle, all_files
+
+def make_tarfile(watch_dir, prefix, validate=True, files=None):
+    files_to_bundle, all_files = select_files(watch_dir, prefix, validate=validate, files=files)
+    tar_filename = os.path.join(watch_dir, f'{prefix}.tar')
 
     if len(files_to_bundle) == 0:
         return None, []
 
+    index = TarIndex()
     with tarfile.open(tar_filename, 'w') as tar:
         for file_path in files_to_bundle:
-            tar.add(file_path, arcname=file_path.split('/')[-1])
+            index.add(tar, file_path.split('/')[-1], file_path=file_path)
+    index.finish(os.path.getsize(tar_filename))
+    index.save(index_path(tar_filename))
     
     return tar_filename, all_files
 
+def stream_tarfile(s3_client, bucket, key, files_to_bundle, part_size=8 * 1024 * 1024, upload_threads=4):
+    """
+    Write a tar of files_to_bundle straight into a multipart upload to
+    s3://bucket/key, without building it on disk first. The upload is only
+    completed once the tar trailer has been written, and aborted if anything
+    fails. Returns the TarIndex of the tar.
+    """
+    writer = MultipartUploadWriter(s3_client, bucket, key, part_size=part_size, upload_threads=upload_threads)
+    index = TarIndex()
+    try:
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            for file_path in files_to_bundle:
+                index.add(tar, file_path.split('/')[-1], file_path=file_path)
+    except Exception:
+        writer.abort()
+        raise
+    writer.complete()
+    index.finish(writer.bytes_written)
+    return index
+
+def row_index(path):
+    """
+    The row of a per-image file, from its {prefix}--{index} name, or None.
+    """
+    try:
+        return int(os.path.basename(path).split('--')[1].split('.')[0])
+    except (IndexError, ValueError):
+        return None
 
 class TarMaker:
     def __init__(self, 
@@ -48,7 +111,17 @@ class TarMaker:
                  ddb_table,
                  sqs_client,
                  tar_queue_url,
-                 wait_after_last_change=300
+                 wait_after_last_change=300,
+                 upload_counter=None,
+                 validate_images=True,
+                 stream_uploads=False,
+                 part_size=8 * 1024 * 1024,
+                 upload_threads=4,
+                 upload_workers=4,
+                 record_shards=False,
+                 min_images_per_partial=None,
+                 dedup=None,
+                 checkpoints=None
         ):
         self.file_counts = defaultdict(int)
         self.previous_file_counts = {}
@@ -61,10 +134,46 @@ class TarMaker:
 
         self.sqs_client = sqs_client
         self.tar_queue_url = tar_queue_url
+        self.upload_counter = upload_counter
+        # a DedupIndex whose keys for a batch are committed once it is uploaded
+        self.dedup = dedup
+        # a CheckpointingSink whose checkpoint of a batch is deleted once it is uploaded
+        self.checkpoints = checkpoints
+        self.validate_images = validate_images
+        self.stream_uploads = stream_uploads
+        self.part_size = part_size
+        self.upload_threads = upload_threads
+        # also upload every batch as pre-decoded records, and announce those instead of the tar
+        self.record_shards = record_shards
+
+        # batches cut short by a drain, uploaded under the prefix of the rows they got to
+        self.partials = {}
+        self.partial_minimums = {}
+        self.min_images_per_partial = min_images_per_partial if min_images_per_partial is not None else min_images_per_tar // 4
 
         self.seconds_since_change = {}
         self.wait_after_last_change = wait_after_last_change
 
+        # batch complete events from the producer, handled as soon as they arrive
+        self.events = queue.Queue()
+
+        # per-image files by batch prefix, reported by the producer through files_written,
+        # with the bytes counted for each so a file reported twice is only counted once
+        self.files = defaultdict(set)
+        self.file_sizes = defaultdict(dict)
+        self.file_bytes = defaultdict(int)
+        self._files_lock = threading.Lock()
+        self.observer = None
+
+        # bundle and upload jobs run upload_workers at a time, each prefix at most once
+        self.executor = ThreadPoolExecutor(max_workers=upload_workers)
+        self.job_stages = {}
+        self._jobs_lock = threading.Lock()
+        self._jobs_idle = threading.Condition(self._jobs_lock)
+        self._running_jobs = 0
+        self._finished = threading.Event()
+        self._monitoring = False
+
         self.stop = False
 
     def _get_ids_from_file(self, file_name):
@@ -81,7 +190,7 @@ class TarMaker:
                 if prefix in self.seconds_since_change:
                     if count > self.min_images_per_tar and time.time() - self.seconds_since_change.get(prefix, 0) > self.wait_after_last_change:
                         pq_id, batch_id = self._get_ids_from_file(prefix)
-                        self.bundle_and_upload_files(pq_id, batch_id)
+                        self.submit_job(pq_id, batch_id)
                 else:
                     self.seconds_since_change[prefix] = time.time()
             else:
@@ -89,18 +198,24 @@ class TarMaker:
 
         self.previous_file_counts = self.file_counts.copy()
         self.file_counts.clear()
+        self.report_jobs()
 
-    def mark_as_uploaded(self, pq_id, batch_id):
+    def mark_as_uploaded(self, pq_id, batch_id, partial=False):
         try:
-            response = self.dd_table.put_item(
-                Item={
-                    'parquet_id': pq_id,
-                    'batch_id': batch_id,
-                    'uploaded': True,
-                }
-            )
+            item = {
+                'parquet_id': pq_id,
+                'batch_id': batch_id,
+                'uploaded': True,
+            }
+            if partial:
+                item['partial'] = True
+            response = self.dd_table.put_item(Item=item)
             print(f'Marked {pq_id}, {batch_id} as uploaded.', response)
 
+            if partial:
+                # the counter estimates images as tars times min_images_per_tar, partial tars would inflate it
+                return True
+
             counter_response = self.dd_table.update_item(
                 Key={
                     'parquet_id': COUNTER_PQ_ID,
@@ -115,67 +230,384 @@ class TarMaker:
         
             print(f'Upload counter incremented. Current count: {counter_response["Attributes"]["upload_count"]}')
 
+            if self.upload_counter is not None:
+                self.upload_counter.increment()
+            return True
+
         except Exception as e:
             print(f'Failed to mark {pq_id}, {batch_id} as uploaded: {e}')
-
-
-    def bundle_and_upload_files(self, pq_id, batch_id):
+            return False
+
+
+    def mark_partial(self, prefix, partial_prefix, min_images=None):
+        """
+        Record that prefix was cut short by a drain, before it is sealed, so it
+        is uploaded as partial_prefix, with only the files of the rows
+        partial_prefix covers, once it has more than min_images files, by
+        default min_images_per_partial.
+        """
+        self.partials[prefix] = partial_prefix
+        self.partial_minimums[prefix] = min_images if min_images is not None else self.min_images_per_partial
+
+    def submit_tar(self, prefix, tar_filename, file_count):
+        """
+        Queue a tar that was already built by a ShardWriter for upload.
+        """
+        self.events.put((prefix, tar_filename, file_count))
+
+    def batch_complete(self, prefix):
+        """
+        Signal that every image for prefix has been written to watch_dir, so it
+        can be bundled now rather than after wait_after_last_change.
+        """
+        self.events.put((prefix, None, None))
+
+    def handle_events(self, timeout=0):
+        """
+        Handle queued batch events, waiting up to timeout seconds for the first one.
+        """
+        while True:
+            try:
+                prefix, tar_filename, file_count = self.events.get(timeout=timeout) if timeout else self.events.get_nowait()
+            except queue.Empty:
+                return
+            timeout = 0
+
+            if tar_filename is None:
+                file_count = len(self.batch_files(prefix))
+
+            minimum = self.partial_minimums.get(prefix, self.min_images_per_tar)
+            if file_count > minimum:
+                print(f'Batch {prefix} is complete with {file_count} files, uploading.')
+                pq_id, batch_id = self._get_ids_from_file(prefix)
+                self.submit_job(pq_id, batch_id, tar_filename=tar_filename)
+                self.seconds_since_change.pop(prefix, None)
+            elif tar_filename is not None:
+                print(f'Only {file_count} files in {tar_filename}. Discarding.')
+                TARS.inc(outcome='discarded')
+                for path in [tar_filename, index_path(tar_filename)]:
+                    if os.path.exists(path):
+                        os.remove(path)
+                if self.dedup is not None:
+                    self.dedup.discard(prefix)
+            else:
+                print(f'Batch {prefix} is complete with only {file_count} files. Not uploading.')
+                if self.dedup is not None:
+                    self.dedup.discard(prefix)
+
+    def submit_job(self, pq_id, batch_id, tar_filename=None):
+        """
+        Queue prefix to be bundled and uploaded by the worker pool. Returns
+        False if a job for the prefix is already queued, running or done. A
+        failed job can be submitted again.
+        """
         prefix = f'{pq_id}-{batch_id}'
+        with self._jobs_lock:
+            if self.job_stages.get(prefix, 'failed') != 'failed':
+                return False
+            self.job_stages[prefix] = 'queued'
+            self._running_jobs += 1
 
-        tar_filename, all_files = make_tarfile(self.watch_dir, prefix)
-        if not tar_filename:
-            print(f'No valid files found for {prefix}. Skipping bundling and uploading.')
-            return
+        self.executor.submit(self._run_job, pq_id, batch_id, tar_filename)
+        return True
 
-        s3_path = self.upload_to_s3(tar_filename, prefix)
-        if s3_path:
-            self.mark_as_uploaded(pq_id, batch_id)
-            self.sqs_client.send_message(QueueUrl=self.tar_queue_url, MessageBody=s3_path)
+    def _run_job(self, pq_id, batch_id, tar_filename):
+        prefix = f'{pq_id}-{batch_id}'
+        succeeded = False
+        try:
+            succeeded = self.bundle_and_upload_files(pq_id, batch_id, tar_filename=tar_filename)
+        except Exception as e:
+            print(f'Failed to bundle and upload {prefix}: {e}')
+        finally:
+            with self._jobs_lock:
+                self.job_stages[prefix] = 'done' if succeeded else 'failed'
+                self._running_jobs -= 1
+                self._jobs_idle.notify_all()
+
+    def _set_stage(self, prefix, stage):
+        with self._jobs_lock:
+            if prefix in self.job_stages:
+                self.job_stages[prefix] = stage
+
+    def job_counts(self):
+        with self._jobs_lock:
+            counts = Counter(self.job_stages.values())
+        return {stage: counts.get(stage, 0) for stage in JOB_STAGES}
+
+    def report_jobs(self):
+        counts = self.job_counts()
+        for stage, count in counts.items():
+            TAR_JOBS.set(count, stage=stage)
+        print('Tar jobs: ' + ', '.join(f'{stage} {count}' for stage, count in counts.items()))
+
+    def wait_for_jobs(self, timeout=None):
+        """
+        Block until every submitted job has finished. Returns False on timeout.
+        """
+        with self._jobs_lock:
+            return self._jobs_idle.wait_for(lambda: self._running_jobs == 0, timeout=timeout)
+
+    def bundle_and_upload_files(self, pq_id, batch_id, tar_filename=None):
+        """
+        Bundle and upload prefix, record it in DynamoDB, announce it on SQS and
+        delete its files. Returns whether the tar was uploaded.
+        """
+        prefix = f'{pq_id}-{batch_id}'
+        upload_prefix = self.partials.get(prefix, prefix)
+
+        all_files = []
+        if tar_filename is not None:
+            self._set_stage(prefix, 'uploading')
+            s3_path = self.upload_to_s3(tar_filename, upload_prefix)
+        elif self.stream_uploads:
+            self._set_stage(prefix, 'building')
+            files_to_bundle, all_files = select_files(self.watch_dir, prefix, validate=self.validate_images, files=self.batch_files(prefix))
+            if not files_to_bundle:
+                print(f'No valid files found for {prefix}. Skipping bundling and uploading.')
+                return False
+            # the tar is built as it uploads
+            self._set_stage(prefix, 'uploading')
+            s3_path = self.stream_to_s3(files_to_bundle, upload_prefix)
+        else:
+            self._set_stage(prefix, 'building')
+            build_start = time.time()
+            tar_filename, all_files = make_tarfile(self.watch_dir, prefix, validate=self.validate_images, files=self.batch_files(prefix))
+            TAR_BUILD_SECONDS.observe(time.time() - build_start)
+            if not tar_filename:
+                print(f'No valid files found for {prefix}. Skipping bundling and uploading.')
+                return False
+            self._set_stage(prefix, 'uploading')
+            s3_path = self.upload_to_s3(tar_filename, upload_prefix)
+
+        if not s3_path:
+            return False
+
+        if self.record_shards:
+            self._set_stage(prefix, 'building')
+            jpgs = file_jpgs(files_to_bundle) if tar_filename is None else tar_jpgs(tar_filename)
+            s3_path = self.upload_records(jpgs, upload_prefix)
+            if not s3_path:
+                return False
+
+        self._set_stage(prefix, 'recording')
+        if prefix in self.partials:
+            recorded = self.mark_as_uploaded(*self._get_ids_from_file(upload_prefix), partial=True)
+        else:
+            recorded = self.mark_as_uploaded(pq_id, batch_id)
+        if recorded and self.dedup is not None:
+            self.dedup.commit(prefix)
+        if recorded and self.checkpoints is not None:
+            self.checkpoints.uploaded(prefix)
+        self._set_stage(prefix, 'notifying')
+        self.sqs_client.send_message(QueueUrl=self.tar_queue_url, MessageBody=s3_path)
+
+        self._set_stage(prefix, 'cleaning')
+        if tar_filename is not None:
+            for path in [tar_filename, index_path(tar_filename)]:
+                if os.path.exists(path):
+                    os.remove(path)
+        # a partial batch also drops the files of rows past its partial prefix, they are downloaded again
+        for file_path in all_files + self.indexed_files(prefix):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        self.forget(prefix)
+        self.partials.pop(prefix, None)
+        self.partial_minimums.pop(prefix, None)
+        return True
+
+    def stream_to_s3(self, files_to_bundle, prefix):
+        s3_key = os.path.join(self.s3_prefix, f'{prefix}.tar')
+        try:
+            upload_start = time.time()
+            index = stream_tarfile(self.s3_client, self.s3_bucket, s3_key, files_to_bundle, part_size=self.part_size, upload_threads=self.upload_threads)
+            S3_UPLOAD_SECONDS.observe(time.time() - upload_start)
+            S3_UPLOAD_BYTES.inc(index.tar_size)
+            TARS.inc(outcome='uploaded')
+            print(f'Successfully streamed {prefix} to s3://{self.s3_bucket}/{s3_key}')
+            self.upload_index(io.BytesIO(index.to_bytes()), s3_key)
 
-            if os.path.exists(tar_filename):
-                os.remove(tar_filename)
-            for file_path in all_files:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
+            return f's3://{self.s3_bucket}/{s3_key}'
+        except Exception as e:
+            print(f'Failed to stream {prefix} to S3: {e}')
+            TARS.inc(outcome='upload_failed')
+            return None
 
-            self.previous_file_counts[prefix] = 0
+    def upload_index(self, fileobj, tar_key):
+        # readers fall back to walking the tar without it, so a failure here doesn't fail the upload
+        try:
+            self.s3_client.upload_fileobj(fileobj, self.s3_bucket, index_path(tar_key))
+        except Exception as e:
+            print(f'Failed to upload the index of {tar_key} to S3: {e}')
 
     def upload_to_s3(self, tar_filename, prefix):
         try:
             s3_key = os.path.join(self.s3_prefix, f'{prefix}.tar')
+            upload_start = time.time()
             self.s3_client.upload_file(tar_filename, self.s3_bucket, s3_key)
+            S3_UPLOAD_SECONDS.observe(time.time() - upload_start)
+            S3_UPLOAD_BYTES.inc(os.path.getsize(tar_filename))
+            TARS.inc(outcome='uploaded')
             print(f'Successfully uploaded {tar_filename} to s3://{self.s3_bucket}/{s3_key}')
+            if os.path.exists(index_path(tar_filename)):
+                with open(index_path(tar_filename), 'rb') as f:
+                    self.upload_index(f, s3_key)
 
             return f's3://{self.s3_bucket}/{s3_key}'
         except Exception as e:
             print(f'Failed to upload {tar_filename} to S3: {e}')
+            TARS.inc(outcome='upload_failed')
             return None
 
-    def update_file_counts(self):
-        for file_name in os.listdir(self.watch_dir):
-            if not os.path.isfile(os.path.join(self.watch_dir, file_name)):
-                continue  # Skip directories
+    def upload_records(self, jpgs, prefix):
+        record_filename = os.path.join(self.watch_dir, f'{prefix}{RECORD_SUFFIX}')
+        try:
+            build_start = time.time()
+            with open(record_filename, 'wb') as f:
+                count = write_records(f, jpgs)
+            RECORD_BUILD_SECONDS.observe(time.time() - build_start)
 
-            prefix = file_name.split('--')[0]
-            self.file_counts[prefix] += 1
+            s3_key = os.path.join(self.s3_prefix, f'{prefix}{RECORD_SUFFIX}')
+            self.s3_client.upload_file(record_filename, self.s3_bucket, s3_key)
+            S3_UPLOAD_BYTES.inc(os.path.getsize(record_filename))
+            print(f'Successfully uploaded {count} records of {prefix} to s3://{self.s3_bucket}/{s3_key}')
 
-    def finalize(self):
+            return f's3://{self.s3_bucket}/{s3_key}'
+        except Exception as e:
+            print(f'Failed to upload records of {prefix} to S3: {e}')
+            return None
+        finally:
+            if os.path.exists(record_filename):
+                os.remove(record_filename)
+
+    def files_written(self, prefix, paths, size=0):
+        """
+        Record per-image files the producer has finished writing to watch_dir.
+        Safe to call from any thread.
+        """
+        with self._files_lock:
+            sizes = self.file_sizes[prefix]
+            new_paths = [p for p in paths if p not in sizes]
+            if not new_paths:
+                return
+            # size covers all of paths, some of which another report (the producer or inotify) may have counted
+            new_bytes = max(0, size - sum(sizes[p] for p in paths if p in sizes))
+            for p in new_paths:
+                sizes[p] = new_bytes / len(new_paths)
+            self.files[prefix].update(new_paths)
+            self.file_bytes[prefix] += new_bytes
+
+    def batch_files(self, prefix):
+        """
+        The indexed files of prefix that go in its tar, for a partial batch
+        only those of the rows its partial prefix covers.
+        """
+        files = self.indexed_files(prefix)
+        if prefix not in self.partials:
+            return files
+        _, start, end = parse_prefix(self.partials[prefix])
+        rows = [(f, row_index(f)) for f in files]
+        return [f for f, index in rows if index is None or start <= index < end]
+
+    def indexed_files(self, prefix):
+        with self._files_lock:
+            return list(self.files.get(prefix, ()))
+
+    def forget(self, prefix):
+        with self._files_lock:
+            self.files.pop(prefix, None)
+            self.file_sizes.pop(prefix, None)
+            self.file_bytes.pop(prefix, None)
+
+    def _file_event(self, path):
+        name = os.path.basename(path)
+        if '--' not in name or name.endswith('.part'):
+            return  # only per-image files are indexed
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        self.files_written(name.split('--')[0], [path], size)
+
+    def scan(self):
+        """
+        Index the per-image files already in watch_dir, left behind by an earlier
+        run. After this the index is kept up to date by files_written.
+        """
+        for entry in os.scandir(self.watch_dir):
+            if entry.is_file():
+                self._file_event(entry.path)
+
+    def start_watching(self):
+        """
+        Index files written to watch_dir by processes that don't report them
+        through files_written, from inotify events.
+        """
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+
+        tar_maker = self
+
+        class Handler(FileSystemEventHandler):
+            def on_closed(self, event):
+                tar_maker._file_event(event.src_path)
+
+            def on_moved(self, event):
+                tar_maker._file_event(event.dest_path)
+
+        self.observer = Observer()
+        self.observer.schedule(Handler(), self.watch_dir, recursive=False)
+        self.observer.start()
+
+    def update_file_counts(self):
+        with self._files_lock:
+            for prefix, files in self.files.items():
+                self.file_counts[prefix] = len(files)
+            backlog_bytes = sum(self.file_bytes.values())
+
+        DISK_BACKLOG_FILES.set(sum(self.file_counts.values()))
+        DISK_BACKLOG_BYTES.set(backlog_bytes)
+
+    def finalize(self, timeout=None):
+        """
+        Stop monitoring and wait until every bundle and upload job, including
+        those for batches still ready when monitoring stops, has finished.
+        """
         self.stop = True
+        if self._monitoring:
+            return self._finished.wait(timeout)
+        finished = self.wait_for_jobs(timeout)
+        self.executor.shutdown(wait=finished)
+        return finished
 
     def keep_monitoring(self, sleep_time=5):
+        self._monitoring = True
         try:
+            self.scan()
+            last_check = 0
             while not self.stop:
-                self.check_directory()
-                time.sleep(sleep_time)  # Wait for 5 seconds before checking again
+                # batch events are handled immediately, the directory timer is a fallback for crashed producers
+                self.handle_events(timeout=sleep_time)
+                if time.time() - last_check >= sleep_time:
+                    self.check_directory()
+                    last_check = time.time()
 
+            self.handle_events()
             self.update_file_counts()
             for prefix, count in self.file_counts.items():
                 if count > self.min_images_per_tar:
                     pq_id, batch_id = self._get_ids_from_file(prefix)
-                    self.bundle_and_upload_files(pq_id, batch_id)
+                    self.submit_job(pq_id, batch_id)
 
         except KeyboardInterrupt:
             print("Stopping the directory monitoring.")
+        finally:
+            self.wait_for_jobs()
+            self.executor.shutdown(wait=True)
+            self.report_jobs()
+            if self.observer is not None:
+                self.observer.stop()
+                self.observer.join()
+            self._finished.set()
 
 if __name__ == "__main__":
     s3_prefix = 'wds/'
@@ -0,0 +1,68 @@
+import threading
+
+class VisibilityExtender:
+    """
+    Keeps the SQS messages a worker is holding invisible to other workers.
+    Every interval seconds the visibility timeout of each held receipt handle
+    is pushed out to visibility_timeout seconds from now, so a parquet that
+    takes longer than the queue's own visibility timeout isn't handed out twice.
+    """
+    def __init__(self, sqs_client, queue_url, visibility_timeout=300, interval=60):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+        self.interval = interval
+        self.receipt_handles = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _change_visibility(self, receipt_handle, timeout):
+        try:
+            self.sqs_client.change_message_visibility(
+                QueueUrl=self.queue_url,
+                ReceiptHandle=receipt_handle,
+                VisibilityTimeout=timeout
+            )
+            return True
+        except Exception as e:
+            print(f"Failed to change message visibility: {e}")
+            return False
+
+    def add(self, receipt_handle):
+        with self._lock:
+            self.receipt_handles.add(receipt_handle)
+        self._change_visibility(receipt_handle, self.visibility_timeout)
+
+    def remove(self, receipt_handle):
+        with self._lock:
+            self.receipt_handles.discard(receipt_handle)
+
+    def give_back(self, receipt_handle):
+        """
+        Stop holding a message and make it visible to other workers straight away.
+        """
+        self.remove(receipt_handle)
+        self._change_visibility(receipt_handle, 0)
+
+    def extend(self):
+        with self._lock:
+            receipt_handles = list(self.receipt_handles)
+
+        for receipt_handle in receipt_handles:
+            if not self._change_visibility(receipt_handle, self.visibility_timeout):
+                # the handle is stale (deleted or expired), there is nothing left to extend
+                self.remove(receipt_handle)
+
+    def _keep_extending(self):
+        while not self._stop.wait(self.interval):
+            self.extend()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._keep_extending, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join()